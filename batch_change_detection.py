@@ -0,0 +1,124 @@
+import os
+import re
+import time
+import argparse
+import multiprocessing
+from concurrent.futures import ProcessPoolExecutor, as_completed
+import cv2
+import pandas as pd
+from threadpoolctl import threadpool_limits
+from PCAKmeans_updated import find_PCAKmeans
+
+"""
+This module runs PCA and K-means change detection (find_PCAKmeans in PCAKmeans_updated) over many image pairs in parallel.
+
+1. Read a manifest of image pairs. This is a CSV file with the columns name, image1 and image2, for example one row per water company
+   with its before and after quicklooks. Relative image paths are taken relative to the manifest file.
+2. Run find_PCAKmeans on each pair in a pool of worker processes. Each pair writes diff.jpg, changemap.jpg and cleanchangemap.jpg to
+   its own directory under the output directory, named after the pair.
+3. Limit the BLAS/OpenMP and OpenCV threads in each worker, so that processes x threads does not oversubscribe the cores.
+4. Report the time taken for each pair as it completes, then print a summary table and save it as summary.csv in the output directory.
+
+An example manifest is given in data_files/change_pairs.csv. From the command line:
+
+    python batch_change_detection.py data_files/change_pairs.csv --output data_files/batch --processes 2
+"""
+
+def read_manifest(manifest_file):
+    """
+    Read a manifest of image pairs for batch change detection.
+
+    Input:
+        manifest_file (str): The file path of the manifest CSV file with the columns name, image1 and image2.
+
+    Output:
+        pd.DataFrame: The manifest, with the image paths made absolute.
+    """
+    manifest = pd.read_csv(manifest_file, dtype=str)
+    missing = {'name', 'image1', 'image2'} - set(manifest.columns)
+    if missing:
+        raise ValueError(f'{manifest_file} is missing the column(s) {sorted(missing)}')
+    if manifest['name'].duplicated().any():
+        raise ValueError(f'{manifest_file} has duplicate names, each pair needs its own output directory')
+
+    base = os.path.dirname(os.path.abspath(manifest_file))
+    for column in ['image1', 'image2']:
+        manifest[column] = [os.path.normpath(os.path.join(base, path)) for path in manifest[column]]
+    return manifest
+
+def _limit_threads(threads_per_process):
+    # Runs once in each worker process. The limits stay in place for the lifetime of the worker
+    global _thread_limits
+    _thread_limits = threadpool_limits(limits=threads_per_process)
+    cv2.setNumThreads(threads_per_process)
+
+def _run_pair(name, imagepath1, imagepath2, output_dir, mode):
+    # Runs in a worker process. Errors are reported in the summary rather than stopping the rest of the batch
+    start = time.perf_counter()
+    try:
+        change_map, clean_change_map = find_PCAKmeans(imagepath1, imagepath2, mode=mode, output_dir=output_dir)
+        status, error = 'ok', ''
+        changed = 100.0 * (change_map == 255).mean()
+        clean_changed = 100.0 * (clean_change_map == 255).mean()
+    except Exception as exc:
+        status, error = 'failed', f'{type(exc).__name__}: {exc}'
+        changed = clean_changed = float('nan')
+    return {'name': name, 'status': status, 'seconds': round(time.perf_counter() - start, 2),
+            'changed_%': round(changed, 3), 'clean_changed_%': round(clean_changed, 3),
+            'output_dir': output_dir, 'error': error}
+
+def run_batch(manifest_file, output_root='data_files/batch', processes=None, threads_per_process=1, mode='exact'):
+    """
+    Run change detection on every image pair in a manifest across a pool of processes.
+
+    Inputs:
+        manifest_file (str): The file path of the manifest CSV file with the columns name, image1 and image2.
+        output_root (str): The directory under which each pair gets its own output directory.
+        processes (int): The number of worker processes. Defaults to the number of cores divided by threads_per_process.
+        threads_per_process (int): The number of BLAS/OpenMP and OpenCV threads each worker may use.
+        mode (str): 'exact' or 'fast', passed to find_PCAKmeans.
+
+    Output:
+        pd.DataFrame: The summary table, with one row per pair giving the status, time taken and percentage of changed pixels.
+    """
+    manifest = read_manifest(manifest_file)
+    if processes is None:
+        processes = max(1, (os.cpu_count() or 1) // threads_per_process)
+    processes = min(processes, len(manifest)) or 1
+    print(f'Running {len(manifest)} image pairs on {processes} processes with {threads_per_process} thread(s) each')
+
+    results = []
+    batch_start = time.perf_counter()
+    # spawn gives each worker a fresh interpreter, so no BLAS thread pool state is inherited from this process
+    context = multiprocessing.get_context('spawn')
+    with ProcessPoolExecutor(max_workers=processes, mp_context=context,
+                             initializer=_limit_threads, initargs=(threads_per_process,)) as pool:
+        futures = [pool.submit(_run_pair, row.name, row.image1, row.image2,
+                               os.path.join(output_root, _safe_name(row.name)), mode)
+                   for row in manifest.itertuples(index=False)]
+        for future in as_completed(futures):
+            result = future.result()
+            results.append(result)
+            print(f"{result['name']}: {result['status']} in {result['seconds']:.2f} s")
+
+    summary = pd.DataFrame(results).sort_values('name').reset_index(drop=True)
+    os.makedirs(output_root, exist_ok=True)
+    summary.to_csv(os.path.join(output_root, 'summary.csv'), index=False)
+
+    print('\n' + summary.drop(columns=['output_dir', 'error']).to_string(index=False))
+    print(f'\n{(summary.status == "ok").sum()} of {len(summary)} pairs completed in {time.perf_counter() - batch_start:.2f} s')
+    return summary
+
+def _safe_name(name):
+    # Make a pair name usable as a directory name
+    return re.sub(r'[^A-Za-z0-9_.-]+', '_', name).strip('_') or 'pair'
+
+if __name__ == '__main__':
+    parser = argparse.ArgumentParser(description='Run PCA and K-means change detection over a manifest of image pairs.')
+    parser.add_argument('manifest', help='CSV file with the columns name, image1 and image2')
+    parser.add_argument('--output', default='data_files/batch', help='directory for the per-pair output directories')
+    parser.add_argument('--processes', type=int, default=None, help='number of worker processes')
+    parser.add_argument('--threads', type=int, default=1, help='BLAS/OpenMP threads per worker process')
+    parser.add_argument('--mode', choices=['exact', 'fast'], default='exact', help='find_PCAKmeans mode')
+    args = parser.parse_args()
+    run_batch(args.manifest, args.output, args.processes, args.threads, args.mode)
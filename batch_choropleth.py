@@ -0,0 +1,181 @@
+import os
+import time
+import argparse
+import multiprocessing
+from concurrent.futures import ProcessPoolExecutor
+import numpy as np
+import shapely
+import matplotlib
+from matplotlib.figure import Figure
+from matplotlib.backends.backend_agg import FigureCanvasAgg
+from matplotlib.collections import PatchCollection
+from matplotlib.colors import Normalize
+from matplotlib.patches import PathPatch
+from matplotlib.path import Path
+import data_loader
+import pcc_store
+
+"""
+This module renders a choropleth map of the per capita consumption (PCC) of the water companies for every period in pr24_hist_pcc.csv,
+as PNG files, and optionally puts them together into an animation of PCC over time.
+
+1. Load the company outlines (the simplified outlines of data_loader.read_companies) and the PCC of every period (pcc_store), joined
+   on the company acronym.
+2. Turn the outlines into matplotlib paths once, with array operations over all rings, and find one colour scale shared by all the
+   periods, so that the maps can be compared.
+3. In each worker process, draw the figure once: the company patches, the colour bar and the title. Each period then only swaps the
+   face colour array of the patches and the title text before the figure is saved, rather than drawing every polygon again.
+4. Spread the periods over a pool of worker processes. Each writes pcc_<period>.png to the output directory.
+5. Optionally read the PNG files back in period order and write an animated GIF or an MP4 (the MP4 needs the imageio-ffmpeg plugin).
+
+Companies without a PCC value for a period are drawn in light grey. From the command line:
+
+    python batch_choropleth.py --output data_files/choropleths --processes 4 --animation gif
+"""
+
+output_dir = 'data_files/choropleths'
+missing_colour = 'lightgrey'
+
+_figure = None   # The figure, patch collection and title of a worker process, drawn once by _start_worker
+
+def render_choropleths(periods=None, output_dir=output_dir, water_areas_file=data_loader.water_supply_areas_file,
+                       history_file=pcc_store.history_file, processes=None, animation=None, fps=2, cmap='viridis', figsize=(8, 10),
+                       dpi=96):
+    """
+    Render a PCC choropleth map of the water companies for each period, optionally with an animation of all the periods.
+
+    Inputs:
+        periods (list of str): The periods to render, such as ['2018-19', '2019-20']. Defaults to all periods of the history file.
+        output_dir (str): The directory for the PNG files and the animation (created if needed).
+        water_areas_file (str): The file path of the water supply areas shapefile.
+        history_file (str): The file path of the PCC history CSV file.
+        processes (int): The number of worker processes. Defaults to the number of cores (at most one per period).
+        animation (str): None for no animation, 'gif' for pcc.gif or 'mp4' for pcc.mp4.
+        fps (float): The frames (periods) per second of the animation.
+        cmap (str): The matplotlib colour map.
+        figsize (tuple of float): The figure width and height in inches.
+        dpi (int): The resolution of the PNG files in dots per inch. With the default figsize and dpi the frames are 768 x 960
+            pixels, a multiple of 16 as MP4 encoders prefer.
+
+    Outputs:
+        list of str, str: The file paths of the PNG files in period order, and the file path of the animation (None without one).
+    """
+    start = time.perf_counter()
+    periods = pcc_store.pcc_periods(history_file) if periods is None else list(periods)
+    companies = data_loader.read_companies(water_areas_file, columns=['Acronym', 'simplified'])
+    values = pcc_store.pcc_by_period(history_file)[periods].reindex(companies['Acronym'].to_numpy()).to_numpy()
+    vertices, codes, bounds = _polygon_paths(companies['simplified'].to_numpy())
+    vmin, vmax = np.nanmin(values), np.nanmax(values)   # One colour scale for all periods
+
+    os.makedirs(output_dir, exist_ok=True)
+    frame_files = [os.path.join(output_dir, f'pcc_{period}.png') for period in periods]
+    initargs = (vertices, codes, bounds, vmin, vmax, cmap, figsize, dpi)
+    processes = min(processes or os.cpu_count() or 1, len(periods)) or 1
+    if processes == 1:
+        _start_worker(*initargs)
+        for period, column, frame_file in zip(periods, values.T, frame_files):
+            _render_period(period, column, frame_file)
+    else:
+        # spawn gives each worker a fresh interpreter without the matplotlib state of this process
+        context = multiprocessing.get_context('spawn')
+        with ProcessPoolExecutor(max_workers=processes, mp_context=context, initializer=_start_worker, initargs=initargs) as pool:
+            list(pool.map(_render_period, periods, values.T, frame_files))
+    print(f'{len(periods)} choropleth maps written to {os.path.abspath(output_dir)} in {time.perf_counter() - start:.2f} s')
+
+    animation_file = None
+    if animation is not None:
+        animation_file = write_animation(frame_files, os.path.join(output_dir, f'pcc.{animation}'), fps)
+    return frame_files, animation_file
+
+def write_animation(frame_files, animation_file, fps=2):
+    """
+    Put image files together into an animated GIF or MP4, one frame per file.
+
+    Inputs:
+        frame_files (list of str): The file paths of the frames in order, all of the same size.
+        animation_file (str): The file path of the animation, ending in .gif or .mp4. MP4 needs the imageio-ffmpeg plugin.
+        fps (float): The frames per second.
+
+    Output:
+        str: The file path of the animation.
+    """
+    import imageio.v3 as iio
+    frames = np.stack([iio.imread(frame_file)[..., :3] for frame_file in frame_files])
+    extension = os.path.splitext(animation_file)[1].lower()
+    if extension == '.gif':
+        iio.imwrite(animation_file, frames, duration=1000 / fps, loop=0)   # Duration of each frame in milliseconds, looped forever
+    elif extension == '.mp4':
+        iio.imwrite(animation_file, frames, fps=fps)
+    else:
+        raise ValueError(f'Unsupported animation format {extension}, use .gif or .mp4')
+    print('Animation written to', os.path.abspath(animation_file))
+    return animation_file
+
+def _polygon_paths(geometries):
+    # Vertices and codes of one compound matplotlib path per (Multi)Polygon, built for all rings at once, and the total bounds. Shells
+    # are turned anticlockwise and holes clockwise, so that holes are left unfilled by the nonzero fill rule
+    parts, part_geometry = shapely.get_parts(geometries, return_index=True)
+    rings, ring_part = shapely.get_rings(parts, return_index=True)
+    coords, coord_ring = shapely.get_coordinates(rings, return_index=True)
+    ring_geometry = part_geometry[ring_part]
+    is_shell = np.r_[True, ring_part[1:] != ring_part[:-1]]   # get_rings gives the exterior of each part first
+
+    # Signed area of each ring by the shoelace formula; reverse the rings that go the wrong way
+    following = np.r_[coords[1:], coords[:1]]
+    last = np.r_[coord_ring[1:] != coord_ring[:-1], True]
+    cross = np.where(last, 0, coords[:, 0] * following[:, 1] - following[:, 0] * coords[:, 1])
+    anticlockwise = np.bincount(coord_ring, weights=cross, minlength=len(rings)) > 0
+    flip = anticlockwise != is_shell
+    ring_start = np.searchsorted(coord_ring, np.arange(len(rings)))
+    ring_end = np.r_[ring_start[1:], len(coords)] - 1
+    index = np.arange(len(coords))
+    coords = coords[np.where(flip[coord_ring], ring_start[coord_ring] + ring_end[coord_ring] - index, index)]
+
+    codes = np.full(len(coords), Path.LINETO, dtype=Path.code_type)
+    codes[ring_start] = Path.MOVETO
+    codes[ring_end] = Path.CLOSEPOLY
+
+    # Split into one path per geometry; empty geometries get an empty path
+    geometry_start = np.searchsorted(ring_geometry[coord_ring], np.arange(len(geometries) + 1))
+    vertices = [coords[first:stop] for first, stop in zip(geometry_start[:-1], geometry_start[1:])]
+    codes = [codes[first:stop] for first, stop in zip(geometry_start[:-1], geometry_start[1:])]
+    return vertices, codes, shapely.total_bounds(geometries)
+
+def _start_worker(vertices, codes, bounds, vmin, vmax, cmap, figsize, dpi):
+    # Runs once in each worker process: draw the figure with all the company patches, ready for _render_period
+    global _figure
+    figure = Figure(figsize=figsize, dpi=dpi)
+    FigureCanvasAgg(figure)
+    ax = figure.add_subplot()
+    colour_map = matplotlib.colormaps[cmap].with_extremes(bad=missing_colour)
+    patches = PatchCollection([PathPatch(Path(path_vertices, path_codes)) for path_vertices, path_codes in zip(vertices, codes)],
+                              cmap=colour_map, norm=Normalize(vmin, vmax), edgecolor='black', linewidth=0.3)
+    patches.set_array(np.ma.masked_all(len(vertices)))
+    ax.add_collection(patches)
+    figure.colorbar(patches, ax=ax, shrink=0.6, label='PCC (litres per head per day)')
+    ax.set_xlim(bounds[0], bounds[2])
+    ax.set_ylim(bounds[1], bounds[3])
+    ax.set_aspect('equal')
+    ax.set_xlabel('Easting')
+    ax.set_ylabel('Northing')
+    ax.grid(True)
+    title = ax.set_title('', fontsize=12, pad=20)
+    _figure = (figure, patches, title)
+
+def _render_period(period, values, frame_file):
+    # Runs in a worker process: colour the patches with the PCC of one period and save the figure
+    figure, patches, title = _figure
+    patches.set_array(np.ma.masked_invalid(values))
+    title.set_text(f'Average per capita consumption per water company area for {period}')
+    figure.savefig(frame_file)
+    return frame_file
+
+if __name__ == '__main__':
+    parser = argparse.ArgumentParser(description='Render a PCC choropleth map of the water companies for every period.')
+    parser.add_argument('--periods', nargs='+', default=None, help='periods to render, such as 2019-20 (default all)')
+    parser.add_argument('--output', default=output_dir, help='directory for the PNG files and animation')
+    parser.add_argument('--processes', type=int, default=None, help='number of worker processes')
+    parser.add_argument('--animation', choices=['gif', 'mp4'], default=None, help='also write an animation of all the periods')
+    parser.add_argument('--fps', type=float, default=2, help='frames per second of the animation')
+    args = parser.parse_args()
+    render_choropleths(args.periods, args.output, processes=args.processes, animation=args.animation, fps=args.fps)
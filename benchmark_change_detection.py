@@ -0,0 +1,202 @@
+import os
+import sys
+import json
+import platform
+import argparse
+import tempfile
+import multiprocessing
+from concurrent.futures import ProcessPoolExecutor
+from datetime import datetime, timezone
+import cv2
+import numpy as np
+import sklearn
+import PCAKmeans_updated
+
+"""
+This module benchmarks the PCA and K-means change detection pipeline in PCAKmeans_updated, so that changes to find_vector_set, find_FVS
+and clustering can be checked for speed, memory and accuracy regressions.
+
+1. Generate a synthetic image pair of each requested size: a smooth textured scene, the same scene with sensor noise, and a number of
+   rectangles and ellipses of changed land cover planted in the second image. The planted regions are the ground truth.
+2. Write the pair to lossless PNG files and run the pipeline through read_image_pair and detect_changes, as find_PCAKmeans does,
+   which time read/resize, diff, vector set, PCA, FVS, K-means and erode separately.
+3. Record the peak resident memory (RSS) of the run. Each size runs in a fresh process so that the peaks do not carry over.
+4. Compare the change map and clean change map with the planted truth (accuracy, precision, recall and F1).
+5. Write all results, with the software versions, to a JSON file so that runs can be compared over time.
+
+The exact mode holds the full float64 feature vector space (rows x columns x channels x 25 values), about 60 GB for a 10k x 10k
+pair, so large sizes need a machine with enough memory. A size that fails, for example by running out of memory, is recorded with
+its error rather than stopping the benchmark. From the command line:
+
+    python benchmark_change_detection.py --sizes 500 1000 2000 --modes exact fast --output bench_results.json
+"""
+
+default_sizes = (500, 1000, 2000, 5000, 10000)
+
+def make_synthetic_pair(size, n_regions=20, seed=0):
+    """
+    Generate a synthetic 3-channel 8-bit image pair with planted change regions.
+
+    Inputs:
+        size (int): The height and width of the images in pixels.
+        n_regions (int): The number of change regions (rectangles and ellipses) planted in the second image.
+        seed (int): The seed for the random scene, noise and regions.
+
+    Outputs:
+        np.ndarray, np.ndarray, np.ndarray: The first image, the second image and the boolean truth mask of changed pixels.
+    """
+    rng = np.random.default_rng(seed)
+
+    # A smooth scene: coarse random colours scaled up, plus fine texture
+    coarse = rng.integers(40, 200, size=(max(size // 50, 2), max(size // 50, 2), 3)).astype(np.float32)
+    scene = cv2.resize(coarse, (size, size), interpolation=cv2.INTER_CUBIC)
+    scene += rng.normal(0, 6, size=scene.shape).astype(np.float32)
+    image1 = np.clip(scene, 0, 255).astype(np.uint8)
+
+    # The same scene with sensor noise, and the planted change regions
+    image2 = np.clip(scene + rng.normal(0, 4, size=scene.shape).astype(np.float32), 0, 255).astype(np.uint8)
+    truth = np.zeros((size, size), dtype=np.uint8)
+    for region in range(n_regions):
+        centre = tuple(int(v) for v in rng.integers(0, size, 2))
+        axes = tuple(int(v) for v in rng.integers(max(size // 80, 3), max(size // 20, 6), 2))
+        colour = tuple(int(v) for v in rng.integers(0, 256, 3))
+        if region % 2:
+            corner = (centre[0] + axes[0], centre[1] + axes[1])
+            cv2.rectangle(image2, centre, corner, colour, thickness=-1)
+            cv2.rectangle(truth, centre, corner, 1, thickness=-1)
+        else:
+            cv2.ellipse(image2, centre, axes, 0, 0, 360, colour, thickness=-1)
+            cv2.ellipse(truth, centre, axes, 0, 0, 360, 1, thickness=-1)
+    return image1, image2, truth.astype(bool)
+
+def score_change_map(change_map, truth):
+    """
+    Compare a change map with the planted truth. A pixel counts as changed if any channel of the change map is 255. The change map
+    starts 2 pixels in from the edge of the images, so the truth is cropped to match.
+
+    Inputs:
+        change_map (np.ndarray): The change map, of shape (rows - 4, columns - 4, channels).
+        truth (np.ndarray): The boolean truth mask, of shape (rows, columns).
+
+    Outputs:
+        dict: The accuracy, precision, recall and F1 score, and the changed fraction of the change map and the truth.
+    """
+    predicted = PCAKmeans_updated.as_channels(change_map).max(axis=2) == 255
+    truth = truth[2:2 + predicted.shape[0], 2:2 + predicted.shape[1]]
+    true_positive = np.count_nonzero(predicted & truth)
+    precision = true_positive / max(np.count_nonzero(predicted), 1)
+    recall = true_positive / max(np.count_nonzero(truth), 1)
+    return {'accuracy': float(np.mean(predicted == truth)),
+            'precision': float(precision),
+            'recall': float(recall),
+            'f1': float(2 * precision * recall / (precision + recall)) if precision + recall else 0.0,
+            'changed_fraction': float(predicted.mean()),
+            'truth_fraction': float(truth.mean())}
+
+def run_case(size, mode='exact', seed=0, sample_size=100000, batch_size=100000, compact=False):
+    """
+    Run the pipeline once on a synthetic pair, timing each stage. See the module docstring for the stages.
+
+    Inputs:
+        size (int): The height and width of the synthetic images in pixels.
+        mode (str): 'exact' or 'fast', as for find_PCAKmeans.
+        seed (int): The seed for the synthetic pair and the fast mode samples.
+        sample_size (int): The fast mode sample size.
+        batch_size (int): The fast mode batch size.
+        compact (bool): Whether to use the compact memory mode of find_PCAKmeans.
+
+    Outputs:
+        dict: The size, mode, stage timings in seconds, total time, peak RSS in MB and the accuracy against the planted truth.
+    """
+    image1, image2, truth = make_synthetic_pair(size, seed=seed)
+    with tempfile.TemporaryDirectory() as tmp:
+        imagepath1, imagepath2 = os.path.join(tmp, 'image1.png'), os.path.join(tmp, 'image2.png')
+        cv2.imwrite(imagepath1, image1)
+        cv2.imwrite(imagepath2, image2)
+        del image1, image2
+
+        stages = {}
+        diff_image, new_size = PCAKmeans_updated.read_image_pair(imagepath1, imagepath2, compact, timings=stages)
+
+    change_map, clean_change_map = PCAKmeans_updated.detect_changes(diff_image, new_size, mode, sample_size, batch_size, seed, compact,
+                                                                    timings=stages)
+    del diff_image
+
+    return {'size': size, 'mode': mode, 'compact': compact, 'seed': seed, 'status': 'ok',
+            'stages_s': {stage: round(seconds, 4) for stage, seconds in stages.items()},
+            'total_s': round(sum(stages.values()), 4),
+            'peak_rss_mb': _peak_rss_mb(),
+            'accuracy': score_change_map(change_map, truth),
+            'clean_accuracy': score_change_map(clean_change_map, truth)}
+
+def run_benchmark(sizes=default_sizes, modes=('exact',), repeats=1, output_file='bench_results.json', seed=0,
+                  sample_size=100000, batch_size=100000, compact=(False,)):
+    """
+    Run the benchmark for every size, mode and repeat, each in a fresh process, and write the results to a JSON file.
+
+    Inputs:
+        sizes (sequence of int): The synthetic image sizes in pixels.
+        modes (sequence of str): The find_PCAKmeans modes to benchmark.
+        repeats (int): The number of runs of each size and mode.
+        output_file (str): The file path of the JSON results.
+        seed (int): The seed for the synthetic pairs.
+        sample_size (int): The fast mode sample size.
+        batch_size (int): The fast mode batch size.
+        compact (sequence of bool): Whether to run without (False) and/or with (True) the compact memory mode.
+
+    Outputs:
+        dict: The results as written to the JSON file.
+    """
+    results = []
+    context = multiprocessing.get_context('spawn')
+    for size in sizes:
+        for mode in modes:
+            for use_compact in compact:
+                label = f"{size} x {size} {mode}{' compact' if use_compact else ''}"
+                for repeat in range(repeats):
+                    # A fresh process for every run, so that the peak RSS is for this run alone
+                    with ProcessPoolExecutor(max_workers=1, mp_context=context) as pool:
+                        try:
+                            result = pool.submit(run_case, size, mode, seed, sample_size, batch_size, use_compact).result()
+                        except Exception as exc:
+                            result = {'size': size, 'mode': mode, 'compact': use_compact, 'seed': seed, 'status': 'failed',
+                                      'error': f'{type(exc).__name__}: {exc}'}
+                    result['repeat'] = repeat
+                    results.append(result)
+                    if result['status'] == 'ok':
+                        print(f"{label}: {result['total_s']:.2f} s, peak RSS {result['peak_rss_mb']:.0f} MB, "
+                              f"F1 {result['clean_accuracy']['f1']:.3f}")
+                    else:
+                        print(f"{label}: {result['error']}")
+
+    report = {'created': datetime.now(timezone.utc).isoformat(timespec='seconds'),
+              'python': platform.python_version(), 'numpy': np.__version__, 'sklearn': sklearn.__version__,
+              'opencv': cv2.__version__, 'platform': platform.platform(), 'cpu_count': os.cpu_count(),
+              'sample_size': sample_size, 'batch_size': batch_size,
+              'results': results}
+    with open(output_file, 'w') as f:
+        json.dump(report, f, indent=2)
+    print('\nResults written to', os.path.abspath(output_file))
+    return report
+
+def _peak_rss_mb():
+    # Peak resident memory of this process in MB. resource is not available on Windows, where psutil gives the peak working set
+    try:
+        import resource
+    except ImportError:
+        import psutil
+        return psutil.Process().memory_info().peak_wset / 2 ** 20
+    peak = resource.getrusage(resource.RUSAGE_SELF).ru_maxrss
+    return peak / 2 ** 20 if sys.platform == 'darwin' else peak / 2 ** 10   # bytes on macOS, kilobytes on Linux
+
+if __name__ == '__main__':
+    parser = argparse.ArgumentParser(description='Benchmark the PCA and K-means change detection pipeline on synthetic image pairs.')
+    parser.add_argument('--sizes', type=int, nargs='+', default=list(default_sizes), help='image sizes in pixels')
+    parser.add_argument('--modes', nargs='+', choices=['exact', 'fast'], default=['exact'], help='find_PCAKmeans modes')
+    parser.add_argument('--repeats', type=int, default=1, help='runs of each size and mode')
+    parser.add_argument('--output', default='bench_results.json', help='JSON results file')
+    parser.add_argument('--seed', type=int, default=0, help='seed for the synthetic image pairs')
+    parser.add_argument('--compact', choices=['off', 'on', 'both'], default='off', help='compact memory mode')
+    args = parser.parse_args()
+    compact = {'off': (False,), 'on': (True,), 'both': (False, True)}[args.compact]
+    run_benchmark(args.sizes, args.modes, args.repeats, args.output, args.seed, compact=compact)
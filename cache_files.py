@@ -0,0 +1,104 @@
+import os
+import threading
+import contextlib
+
+"""
+This module holds the file handling shared by the on-disk caches (the GeoParquet files of data_loader, the change detection results
+of change_cache, the map images of render_cache and the map tiles of tile_server), so that each cache only decides what to store and
+under which name.
+
+1. Write each cached file under a temporary name in the same directory and rename it into place once it is complete (see atomic_file),
+   so that a crash or a concurrent reader never sees a broken file. The rename replaces an existing file in one step.
+2. Record the last use of a cached file in its modification time (see mark_used), which is set when the file is written or read.
+3. Keep a cache directory under a size cap by deleting the least recently used files first (see evict).
+"""
+
+partial_suffix = '.partial'   # The temporary files of atomic_file end with this, so that clearing a cache can remove any left by a crash
+
+@contextlib.contextmanager
+def atomic_file(path):
+    """
+    Write a file atomically: yield a temporary file path to write to, then rename it to path if the block succeeds, or delete it if the
+    block raises.
+
+    Input:
+        path (str): The file path. Its directory is created if needed.
+
+    Output:
+        str: The temporary file path, in the same directory, unique to this process and thread.
+    """
+    os.makedirs(os.path.dirname(path) or '.', exist_ok=True)
+    partial = f'{path}.{os.getpid()}-{threading.get_ident()}{partial_suffix}'
+    try:
+        yield partial
+        os.replace(partial, path)
+    except BaseException:
+        if os.path.exists(partial):
+            os.remove(partial)
+        raise
+
+def mark_used(path):
+    """
+    Record that a cached file was used, for least recently used eviction, by setting its modification time to now.
+
+    Input:
+        path (str): The file path.
+    """
+    os.utime(path)
+
+def cached_files(cache_dir, suffix, recursive=False):
+    """
+    List the files of a cache directory.
+
+    Inputs:
+        cache_dir (str): The cache directory. A missing directory has no files.
+        suffix (str or tuple of str): The ending of the cached file names, such as '.png'.
+        recursive (bool): True to include the files in subdirectories as well.
+
+    Output:
+        list of tuple: The path, size in bytes and modification time of each file, least recently used first.
+    """
+    if not os.path.isdir(cache_dir):
+        return []
+    files = []
+    for directory, _, names in os.walk(cache_dir) if recursive else [(cache_dir, None, os.listdir(cache_dir))]:
+        for name in names:
+            path = os.path.join(directory, name)
+            if name.endswith(suffix) and os.path.isfile(path):
+                stat = os.stat(path)
+                files.append((path, stat.st_size, stat.st_mtime))
+    return sorted(files, key=lambda file: file[2])
+
+def evict(cache_dir, suffix, max_bytes, keep=None, target_bytes=None, recursive=False):
+    """
+    Delete the least recently used files of a cache directory if together they take up more than max_bytes.
+
+    Inputs:
+        cache_dir (str): The cache directory.
+        suffix (str or tuple of str): The ending of the cached file names, see cached_files.
+        max_bytes (int): The size cap in bytes.
+        keep (str): The file path of a file that is never deleted, such as the one just saved.
+        target_bytes (int): The size to delete down to once over the cap. Defaults to max_bytes; a lower target leaves room for new
+            files before the next eviction.
+        recursive (bool): True to include the files in subdirectories as well.
+
+    Outputs:
+        list of str, int: The file paths of the deleted files, and the size in bytes of the files left.
+    """
+    files = cached_files(cache_dir, suffix, recursive)
+    total = sum(size for _, size, _ in files)
+    deleted = []
+    if total <= max_bytes:
+        return deleted, total
+    target_bytes = max_bytes if target_bytes is None else target_bytes
+    keep = None if keep is None else os.path.abspath(keep)
+    for path, size, _ in files:
+        if total <= target_bytes:
+            break
+        if os.path.abspath(path) == keep:
+            continue
+        with contextlib.suppress(FileNotFoundError):   # Already deleted by another process sharing the cache
+            os.remove(path)
+        total -= size
+        deleted.append(path)
+    return deleted, total
@@ -0,0 +1,148 @@
+import os
+import json
+import hashlib
+import zipfile
+import numpy as np
+import cache_files
+
+"""
+This module keeps an on-disk cache of change detection results, so that rerunning find_PCAKmeans (in PCAKmeans_updated) on the same
+image pair with the same parameters, for example while iterating on maps and reports, returns the saved result instead of repeating
+the PCA and K-means.
+
+1. Key each run by a SHA-256 hash of the contents of both images and of the parameters (mode, sample and batch sizes, random state,
+   compact, block size, number of K-means clusters and erode kernel). Renaming or moving an image does not change its key; editing it does.
+2. Remember the content hash of each image file against its path, size and modification time in index.json, so that a repeated run
+   does not read the images again.
+3. Save the difference image, eigenvectors (EVS), K-means cluster labels, change map and clean change map of each run in one
+   compressed .npz file named after its key.
+4. Keep the cache under a size cap by deleting the least recently used results. Loading a result marks it as used. The files are
+   written and evicted through cache_files.
+
+Note that exact mode with random_state=None is not repeatable (K-means starts from random centres), so the cache returns the first
+result for such runs rather than a new draw.
+"""
+
+max_cache_bytes = 2 * 2 ** 30   # Default size cap of a cache directory (2 GB)
+index_file = 'index.json'
+cache_version = 1   # Increase when the stored results change, so that old results are not used
+
+def cache_key(imagepath1, imagepath2, cache_dir, **params):
+    """
+    Find the cache key of a change detection run.
+
+    Inputs:
+        imagepath1 (str): The file path of the first image.
+        imagepath2 (str): The file path of the second image.
+        cache_dir (str): The cache directory, where the content hashes of the images are remembered.
+        **params: The parameters of the run. Values must be JSON serialisable or numpy arrays (such as the erode kernel).
+
+    Output:
+        str: The hexadecimal SHA-256 key.
+    """
+    index = _read_index(cache_dir)
+    known = dict(index)
+    hashes = [_file_hash(imagepath, index) for imagepath in (imagepath1, imagepath2)]
+    if index != known:
+        _write_index(cache_dir, index)
+
+    params = {name: {'dtype': value.dtype.str, 'shape': value.shape, 'values': value.ravel().tolist()}
+              if isinstance(value, np.ndarray) else value for name, value in params.items()}
+    key = hashlib.sha256(json.dumps({'version': cache_version, 'images': hashes, 'params': params}, sort_keys=True).encode())
+    return key.hexdigest()
+
+def load_result(cache_dir, key):
+    """
+    Load a cached change detection result and mark it as recently used.
+
+    Inputs:
+        cache_dir (str): The cache directory.
+        key (str): The cache key from cache_key.
+
+    Output:
+        dict or None: The arrays diff, EVS, labels, change_map and clean_change_map, or None if the result is not cached.
+    """
+    path = os.path.join(cache_dir, key + '.npz')
+    try:
+        with np.load(path) as cached:
+            result = {name: cached[name] for name in cached.files}
+    except (OSError, ValueError, zipfile.BadZipFile):   # Missing or unreadable
+        return None
+    cache_files.mark_used(path)
+    print('Loaded cached result', key[:12])
+    return result
+
+def save_result(cache_dir, key, max_bytes=max_cache_bytes, **arrays):
+    """
+    Save a change detection result to the cache, then delete the least recently used results until the cache is under the size cap.
+
+    Inputs:
+        cache_dir (str): The cache directory (created if needed).
+        key (str): The cache key from cache_key.
+        max_bytes (int): The size cap of the cache directory in bytes.
+        **arrays (np.ndarray): The arrays to save, such as diff, EVS, labels, change_map and clean_change_map.
+
+    Output:
+        str: The file path of the saved result.
+    """
+    path = os.path.join(cache_dir, key + '.npz')
+    with cache_files.atomic_file(path) as partial, open(partial, 'wb') as f:
+        np.savez_compressed(f, **arrays)
+    evict(cache_dir, max_bytes, keep=path)
+    return path
+
+def evict(cache_dir, max_bytes=max_cache_bytes, keep=None):
+    """
+    Delete the least recently used results until the results in a cache directory take up at most max_bytes.
+
+    Inputs:
+        cache_dir (str): The cache directory.
+        max_bytes (int): The size cap in bytes.
+        keep (str): The file path of a result that is never deleted, such as the one just saved.
+
+    Output:
+        list of str: The file paths of the deleted results.
+    """
+    deleted, _ = cache_files.evict(cache_dir, '.npz', max_bytes, keep=keep)
+    if deleted:
+        print(f'Evicted {len(deleted)} cached result(s) from {cache_dir}')
+    return deleted
+
+def clear(cache_dir):
+    """
+    Delete every cached result and the image hash index in a cache directory.
+
+    Input:
+        cache_dir (str): The cache directory.
+    """
+    if not os.path.isdir(cache_dir):
+        return
+    for entry in os.scandir(cache_dir):
+        if entry.is_file() and (entry.name.endswith(('.npz', '.partial')) or entry.name == index_file):
+            os.remove(entry.path)
+
+def _file_hash(path, index):
+    # SHA-256 of the file contents, reused from the index while the file's size and modification time are unchanged
+    stat = os.stat(path)
+    fingerprint = [stat.st_size, stat.st_mtime_ns]
+    entry = index.get(os.path.abspath(path))
+    if entry is not None and entry['fingerprint'] == fingerprint:
+        return entry['sha256']
+
+    digest = hashlib.sha256()
+    with open(path, 'rb') as f:
+        for block in iter(lambda: f.read(2 ** 20), b''):
+            digest.update(block)
+    index[os.path.abspath(path)] = {'fingerprint': fingerprint, 'sha256': digest.hexdigest()}
+    return digest.hexdigest()
+
+def _read_index(cache_dir):
+    try:
+        with open(os.path.join(cache_dir, index_file)) as f:
+            return json.load(f)
+    except (FileNotFoundError, ValueError):
+        return {}
+
+def _write_index(cache_dir, index):
+    with cache_files.atomic_file(os.path.join(cache_dir, index_file)) as partial, open(partial, 'w') as f:
+        json.dump(index, f)
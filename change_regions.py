@@ -0,0 +1,215 @@
+import os
+import numpy as np
+import pandas as pd
+import geopandas as gpd
+import rasterio
+import shapely
+from affine import Affine
+from scipy import ndimage, sparse
+from scipy.sparse import csgraph
+from PCAKmeans_updated import as_channels
+
+"""
+This module turns a change map from PCAKmeans_updated into a table of changed regions that can be counted, located and intersected with
+the water supply areas (WaterSupplyAreas_incNAVs v1_4.shp).
+
+1. Label the connected changed regions of the change map in one pass (8-connected by default). A pixel is changed if any channel is 255.
+2. Drop regions smaller than a minimum area.
+3. Find the area, centroid and bounding box of every region with array operations over all pixels at once, not a loop over regions.
+4. Trace the outlines of all regions into polygons at once, by following the pixel edges around each region with array operations.
+5. Return a GeoDataFrame with one row per region, in the CRS of the change map, and optionally write it to a file.
+
+GeoTIFF change maps (changemap.tif or cleanchangemap.tif) carry their own transform and CRS. For JPEG change maps the coordinates are
+pixel columns and rows of the change map unless a transform is given.
+"""
+
+def change_regions(change_map, transform=None, crs=None, min_area=0, connectivity=8):
+    """
+    Find the connected changed regions of a change map with their area, centroid, bounding box and outline polygon.
+
+    Inputs:
+        change_map (np.ndarray): The change map, of shape (rows, columns) or (rows, columns, channels), with changes set to 255.
+        transform (affine.Affine): The transform of the change map. Defaults to pixel coordinates.
+        crs: The CRS of the transform, for the GeoDataFrame.
+        min_area (float): The smallest region area to keep, in the units of the transform squared (square metres for EPSG:27700).
+        connectivity (int): 8 to join pixels that touch at a corner, 4 to join only pixels that share a side.
+
+    Output:
+        gpd.GeoDataFrame: One row per region with the columns region, pixels, area, centroid_x, centroid_y, minx, miny, maxx, maxy
+        and geometry, sorted by region number.
+    """
+    if connectivity not in (4, 8):
+        raise ValueError(f'connectivity must be 4 or 8, not {connectivity}')
+    transform = Affine.identity() if transform is None else transform
+    pixel_area = abs(transform.a * transform.e - transform.b * transform.d)
+
+    mask = as_channels(change_map).max(axis=2) == 255
+    structure = ndimage.generate_binary_structure(2, 2 if connectivity == 8 else 1)
+    labels, n_regions = ndimage.label(mask, structure=structure)
+
+    # Drop small regions and renumber the rest 1..n with a lookup table
+    pixels = np.bincount(labels.ravel(), minlength=n_regions + 1)
+    keep = pixels * pixel_area >= min_area
+    keep[0] = False
+    lookup = np.zeros(n_regions + 1, dtype=np.int32)
+    lookup[keep] = np.arange(1, np.count_nonzero(keep) + 1, dtype=np.int32)
+    labels = lookup[labels]
+    pixels = pixels[keep]
+    print(f'{n_regions} changed regions found, {len(pixels)} kept with area >= {min_area}')
+
+    # Centroids and bounding boxes from the pixels of all regions at once. The pixels are sorted by region so that the minimum and
+    # maximum of each region can be taken with reduceat over contiguous runs
+    rows, cols = np.nonzero(labels)
+    region = labels[rows, cols]
+    order = np.argsort(region, kind='stable')
+    rows, cols, region = rows[order], cols[order], region[order]
+    starts = np.flatnonzero(np.r_[True, region[1:] != region[:-1]]) if len(region) else np.zeros(0, dtype=int)
+
+    centre_col = np.bincount(region, weights=cols, minlength=len(pixels) + 1)[1:] / np.maximum(pixels, 1) + 0.5
+    centre_row = np.bincount(region, weights=rows, minlength=len(pixels) + 1)[1:] / np.maximum(pixels, 1) + 0.5
+    bounds = [np.minimum.reduceat(cols, starts), np.minimum.reduceat(rows, starts),
+              np.maximum.reduceat(cols, starts) + 1, np.maximum.reduceat(rows, starts) + 1] if len(starts) else [np.zeros(0)] * 4
+
+    centroid_x, centroid_y = transform * (centre_col, centre_row)
+    corner_x, corner_y = [], []
+    for col, row in [(bounds[0], bounds[1]), (bounds[2], bounds[3])]:
+        x, y = transform * (col, row)
+        corner_x.append(np.asarray(x))
+        corner_y.append(np.asarray(y))
+
+    regions = pd.DataFrame({'region': np.arange(1, len(pixels) + 1), 'pixels': pixels, 'area': pixels * pixel_area,
+                            'centroid_x': centroid_x, 'centroid_y': centroid_y,
+                            'minx': np.minimum(*corner_x), 'miny': np.minimum(*corner_y),
+                            'maxx': np.maximum(*corner_x), 'maxy': np.maximum(*corner_y)})
+
+    geometry = _region_polygons(labels, len(pixels), transform)
+    return gpd.GeoDataFrame(regions, geometry=geometry, crs=crs)
+
+def change_regions_from_file(change_map_file, min_area=0, connectivity=8, output_file=None):
+    """
+    Find the changed regions of a change map file written by PCAKmeans_updated and optionally save them.
+
+    Inputs:
+        change_map_file (str): The file path of a change map (changemap.tif, cleanchangemap.tif, changemap.jpg or cleanchangemap.jpg).
+        min_area (float): The smallest region area to keep, in the units of the CRS squared (pixels squared for JPEGs).
+        connectivity (int): 8 or 4, see change_regions.
+        output_file (str): The file path to write the regions to, as GeoParquet (.parquet) or any vector format geopandas writes (.gpkg, .shp).
+
+    Output:
+        gpd.GeoDataFrame: The changed regions, see change_regions.
+    """
+    with rasterio.open(change_map_file) as src:
+        change_map = np.moveaxis(src.read(), 0, -1)
+        georeferenced = src.crs is not None
+        transform, crs = (src.transform, src.crs) if georeferenced else (None, None)
+    if not georeferenced:
+        change_map = np.where(change_map > 127, 255, 0)   # JPEG compression blurs the 0/255 change map
+
+    regions = change_regions(change_map, transform, crs, min_area, connectivity)
+    if output_file is not None:
+        if os.path.splitext(output_file)[1].lower() == '.parquet':
+            regions.to_parquet(output_file)
+        else:
+            regions.to_file(output_file)
+        print('Changed regions written to', os.path.abspath(output_file))
+    return regions
+
+def _region_polygons(labels, n_regions, transform):
+    # Trace the outline of every labelled region at once with array operations and return one Polygon or MultiPolygon per region.
+    #
+    # Every pixel side between a region and anything else is an edge, directed clockwise around the region (on screen, with rows
+    # increasing downwards), so that the region is always on the right. Each edge is followed by the edge of the same region that
+    # starts where it ends. The rings are the cycles of this successor permutation; they are found as connected components and put
+    # in order with pointer jumping. Shells go clockwise and holes anticlockwise, which the sign of the ring area tells apart.
+    #
+    # The polygons are the 4-connected parts of each region, as the interior of a polygon must be connected, so a region whose pixels
+    # only touch at a corner is a MultiPolygon of touching parts. Where two pixels of a region touch at a corner there are two edges to
+    # follow. The ring turns left round the corner if both pixels are in the same part and right otherwise, so every ring goes round
+    # a single part and passes each corner once, and every polygon is valid. Each ring belongs to the part on its right.
+    height, width = labels.shape
+    padded = np.pad(labels, 1)
+    inner = padded[1:-1, 1:-1]
+    parts, n_parts = ndimage.label(labels > 0)   # 4-connected; regions never share a side, so parts never span two regions
+
+    # Edge start vertex (x = column, y = row), direction (0 right, 1 down, 2 left, 3 up), region and part, for the four sides of each pixel
+    starts_x, starts_y, directions, regions, edge_parts = [], [], [], [], []
+    for direction, neighbour, (dx, dy) in [(0, padded[:-2, 1:-1], (0, 0)), (1, padded[1:-1, 2:], (1, 0)),
+                                           (2, padded[2:, 1:-1], (1, 1)), (3, padded[1:-1, :-2], (0, 1))]:
+        rows, cols = np.nonzero((inner > 0) & (inner != neighbour))
+        starts_x.append(cols + dx)
+        starts_y.append(rows + dy)
+        directions.append(np.full(len(rows), direction, dtype=np.int8))
+        regions.append(inner[rows, cols])
+        edge_parts.append(parts[rows, cols])
+    x = np.concatenate(starts_x).astype(np.int64)
+    y = np.concatenate(starts_y).astype(np.int64)
+    direction = np.concatenate(directions)
+    region = np.concatenate(regions).astype(np.int64)
+    part = np.concatenate(edge_parts).astype(np.int64)
+    n_edges = len(x)
+    if n_edges == 0:
+        return gpd.GeoSeries([], dtype='geometry')
+
+    # Successor of each edge: the edge of the same region starting at its end vertex, turning left or right at corner touches
+    step_x = np.array([1, 0, -1, 0])[direction]
+    step_y = np.array([0, 1, 0, -1])[direction]
+    vertex = lambda vx, vy: (region * (height + 1) + vy) * (width + 1) + vx
+    start_key = vertex(x, y)
+    order = np.lexsort((direction, start_key))
+    sorted_keys = start_key[order]
+    first = np.searchsorted(sorted_keys, vertex(x + step_x, y + step_y))
+    second = np.minimum(first + 1, n_edges - 1)
+    two_ways = (sorted_keys[second] == sorted_keys[first]) & (second != first)
+    # At a corner touch the two candidates start from the two touching pixels, one of them the edge's own pixel
+    same_part = part[order[first]] == part[order[second]]
+    turn = np.where(same_part, (direction + 3) % 4, (direction + 1) % 4)
+    take_second = two_ways & (direction[order[first]] != turn)
+    successor = order[np.where(take_second, second, first)]
+
+    # Ring of each edge, and the first edge of each ring
+    links = sparse.coo_matrix((np.ones(n_edges, dtype=np.int8), (np.arange(n_edges), successor)), shape=(n_edges, n_edges))
+    n_rings, ring_index = csgraph.connected_components(links, directed=True, connection='weak')
+    _, ring_ids = np.unique(ring_index, return_index=True)
+    predecessor = np.empty(n_edges, dtype=np.int64)
+    predecessor[successor] = np.arange(n_edges)
+
+    # Position of each edge in its ring: cut each ring before its first edge and count the steps to the cut (list ranking). Only the
+    # edges that have not reached the cut yet take part in each round, so the short rings of small regions drop out after a few rounds
+    tail = np.zeros(n_edges, dtype=bool)
+    tail[predecessor[ring_ids]] = True
+    steps = (~tail).astype(np.int64)
+    jump = np.where(tail, np.arange(n_edges), successor)
+    active = np.flatnonzero(~tail)
+    while len(active):
+        ahead = jump[active]
+        steps[active] += steps[ahead]
+        jump[active] = jump[ahead]
+        active = active[~tail[jump[active]]]
+
+    # Signed area of each ring (shoelace over all its edges, in any order), positive for shells and negative for holes
+    cross = x * (y + step_y) - (x + step_x) * y
+    is_hole = np.bincount(ring_index, weights=cross, minlength=n_rings) < 0
+
+    # Keep only the corners of each ring, in ring order
+    corner = direction != direction[predecessor]
+    corner_order = np.lexsort((-steps[corner], ring_index[corner]))
+    corners = np.flatnonzero(corner)[corner_order]
+    map_x, map_y = transform * (x[corners].astype(float), y[corners].astype(float))
+    rings = shapely.linearrings(np.column_stack([map_x, map_y]), indices=ring_index[corners])
+
+    # One polygon per part, its shell followed by its holes; then one geometry per region, a MultiPolygon where it has several parts
+    ring_part = part[ring_ids] - 1
+    ring_order = np.lexsort((is_hole, ring_part))
+    polygons = shapely.polygons(rings[ring_order], indices=ring_part[ring_order])
+    part_region = np.zeros(n_parts, dtype=np.int64)
+    part_region[part - 1] = region - 1
+    parts_per_region = np.bincount(part_region, minlength=n_regions)
+    geometry = np.empty(n_regions, dtype=object)
+    single = parts_per_region[part_region] == 1
+    geometry[part_region[single]] = polygons[single]
+    multi = np.flatnonzero(~single)
+    if len(multi):
+        multi = multi[np.argsort(part_region[multi], kind='stable')]
+        multi_regions, multi_index = np.unique(part_region[multi], return_inverse=True)
+        geometry[multi_regions] = shapely.multipolygons(polygons[multi], indices=multi_index)
+    return gpd.GeoSeries(geometry)
@@ -0,0 +1,232 @@
+import numpy as np
+import pandas as pd
+import shapely
+import folium
+import branca.colormap
+
+"""
+This module makes compact interactive maps of the water supply areas, as a lighter alternative to GeoDataFrame.explore, which embeds
+the full resolution GeoJSON of every area in the HTML file. The areas are encoded as TopoJSON:
+
+1. Reproject the areas to longitude and latitude and quantise the coordinates to an integer grid over their bounding box (100,000
+   steps across by default, about 10 m for Great Britain), dropping the points that fall on the same grid point as the one before.
+2. Find the junctions: the points where the neighbouring points differ between the rings that pass through them, which is where the
+   border between two areas starts or ends. Cut every ring at its junctions into arcs.
+3. Keep each arc once. A border shared by two areas is one arc, used forwards by one area and backwards by the other, so shared
+   borders are stored once and stay shared when simplified.
+4. Simplify each arc (Douglas-Peucker, keeping its end points) at one or more tolerances in metres, so the areas can be shown in less
+   detail with no gaps or overlaps between neighbours.
+5. Write the arcs as differences between successive grid points, which are short integers, and the areas as lists of arc numbers.
+
+compact_folium_map adds one TopoJSON layer per tolerance to a folium map, with the coarsest shown first and the others available in
+the layer control.
+"""
+
+default_tolerances = (100, 500, 2000)   # Simplification tolerances of compact_folium_map, in metres
+default_quantization = 100000   # Grid steps across the bounding box
+metres_per_degree = 111320   # Along a meridian, and along a parallel at the equator
+
+def to_topojson(gdf, tolerance=0, properties=None, quantization=default_quantization, object_name='areas'):
+    """
+    Encode the polygons of a GeoDataFrame as TopoJSON.
+
+    Inputs:
+        gdf (gpd.GeoDataFrame): The polygons, in any CRS (they are reprojected to EPSG:4326 if needed).
+        tolerance (float): The simplification tolerance in metres. 0 to keep every grid point.
+        properties (list of str): The columns to keep as properties of each geometry. Defaults to none.
+        quantization (int): The number of grid steps across the bounding box.
+        object_name (str): The name of the geometry collection in the TopoJSON objects.
+
+    Output:
+        dict: The TopoJSON topology, ready for json.dump or folium.TopoJson.
+    """
+    return topojson_levels(gdf, [tolerance], properties, quantization, object_name)[tolerance]
+
+def topojson_levels(gdf, tolerances=default_tolerances, properties=None, quantization=default_quantization, object_name='areas'):
+    """
+    Encode the polygons of a GeoDataFrame as TopoJSON at several simplification tolerances, finding the shared arcs only once.
+
+    Inputs:
+        gdf (gpd.GeoDataFrame): The polygons, in any CRS (they are reprojected to EPSG:4326 if needed).
+        tolerances (list of float): The simplification tolerances in metres.
+        properties (list of str): The columns to keep as properties of each geometry. Defaults to none.
+        quantization (int): The number of grid steps across the bounding box.
+        object_name (str): The name of the geometry collection in the TopoJSON objects.
+
+    Output:
+        dict: The TopoJSON topology of each tolerance, keyed by the tolerance.
+    """
+    if gdf.crs is not None and gdf.crs.to_epsg() != 4326:
+        gdf = gdf.to_crs(4326)
+    points, arcs, ring_arcs, ring_part, part_geometry, transform = _topology(gdf.geometry.to_numpy(), quantization)
+
+    records = [{}] * len(gdf)
+    if properties:
+        values = gdf[list(properties)].astype(object)
+        records = values.where(values.notna(), None).to_dict('records')
+    geometries = _geometries(ring_arcs, ring_part, part_geometry, len(gdf), records)
+
+    levels = {}
+    for tolerance in tolerances:
+        encoded = [_delta_encode(arc) for arc in _simplify(points, arcs, tolerance, transform)]
+        levels[tolerance] = {'type': 'Topology', 'bbox': transform['bbox'],
+                             'transform': {'scale': transform['scale'], 'translate': transform['translate']},
+                             'objects': {object_name: {'type': 'GeometryCollection', 'geometries': geometries}},
+                             'arcs': encoded}
+    return levels
+
+def compact_folium_map(gdf, column, tolerances=default_tolerances, caption=None, tooltip_columns=('COMPANY',),
+                       quantization=default_quantization):
+    """
+    Create a Folium map of a column of the water supply areas from compact TopoJSON layers, one per simplification tolerance.
+
+    Inputs:
+        gdf (gpd.GeoDataFrame): The water supply areas, with the column to show.
+        column (str): The numeric column to colour the areas by, such as a PCC period.
+        tolerances (list of float): The simplification tolerances in metres. The layer of the largest is shown first.
+        caption (str): The caption of the colour scale. Defaults to the column name.
+        tooltip_columns (list of str): The columns shown with the value when hovering over an area (those that exist in gdf).
+        quantization (int): The number of grid steps across the bounding box.
+
+    Output:
+        folium.Map: The Folium map object displaying the column.
+    """
+    tooltip_columns = [name for name in tooltip_columns if name in gdf.columns and name != column]
+    levels = topojson_levels(gdf, tolerances, tooltip_columns + [column], quantization)
+    values = pd.to_numeric(gdf[column], errors='coerce')
+    colormap = branca.colormap.linear.YlOrRd_09.scale(np.nanmin(values), np.nanmax(values))
+    colormap.caption = caption or column
+
+    def style(feature):
+        value = feature['properties'].get(column)
+        return {'fillColor': 'lightgrey' if value is None else colormap(value), 'color': 'black', 'weight': 0.5, 'fillOpacity': 0.7}
+
+    west, south, east, north = next(iter(levels.values()))['bbox']
+    m = folium.Map()
+    m.fit_bounds([[south, west], [north, east]])
+    for tolerance in sorted(levels, reverse=True):
+        folium.TopoJson(levels[tolerance], 'objects.areas', style_function=style, name=f'Simplified to {tolerance:g} m',
+                        show=tolerance == max(levels), tooltip=folium.GeoJsonTooltip(fields=tooltip_columns + [column])).add_to(m)
+    colormap.add_to(m)
+    folium.LayerControl().add_to(m)
+    return m
+
+def _topology(geometries, quantization):
+    # Quantise the rings of the (Multi)Polygons, cut them into arcs at the junctions and keep each arc once. Returns the grid points
+    # (x, y), the arcs (arrays of point numbers), the arc references of each ring (~arc for an arc used backwards), the part of each
+    # ring (shells before holes), the geometry of each part and the grid transform
+    parts, part_geometry = shapely.get_parts(geometries, return_index=True)
+    rings, ring_part = shapely.get_rings(parts, return_index=True)
+    coords, coord_ring = shapely.get_coordinates(rings, return_index=True)
+
+    west, south, east, north = shapely.total_bounds(geometries)
+    scale = np.array([max(east - west, 1e-9), max(north - south, 1e-9)]) / (quantization - 1)
+    grid = np.round((coords - [west, south]) / scale).astype(np.int64)
+    transform = {'scale': scale.tolist(), 'translate': [float(west), float(south)], 'bbox': [float(west), float(south), float(east),
+                                                                                          float(north)]}
+
+    # Drop the closing point of each ring and points on the same grid point as the point before, then rings of fewer than 3 points
+    # (and the holes of dropped shells)
+    new_ring = np.r_[True, coord_ring[1:] != coord_ring[:-1]]
+    closing = np.r_[new_ring[1:], True]
+    repeated = ~new_ring & np.r_[False, (grid[1:] == grid[:-1]).all(axis=1)]
+    keep = ~closing & ~repeated
+    grid, coord_ring = grid[keep], coord_ring[keep]
+    ring_start = np.searchsorted(coord_ring, np.arange(len(rings)))
+    ring_length = np.bincount(coord_ring, minlength=len(rings))
+    wraps = ring_length > 1
+    wraps[wraps] = (grid[ring_start[wraps] + ring_length[wraps] - 1] == grid[ring_start[wraps]]).all(axis=1)
+    keep = np.ones(len(grid), dtype=bool)
+    keep[(ring_start + ring_length - 1)[wraps]] = False   # Last point on the grid point of the first
+    grid, coord_ring = grid[keep], coord_ring[keep]
+    ring_length = np.bincount(coord_ring, minlength=len(rings))
+    is_shell = np.r_[True, ring_part[1:] != ring_part[:-1]]
+    valid_part = np.zeros(len(parts), dtype=bool)
+    valid_part[ring_part[is_shell]] = ring_length[is_shell] >= 3
+    valid_ring = (ring_length >= 3) & valid_part[ring_part]
+    keep = valid_ring[coord_ring]
+    grid, coord_ring = grid[keep], coord_ring[keep]
+    ring_index = np.cumsum(valid_ring) - 1
+    coord_ring, ring_part = ring_index[coord_ring], ring_part[valid_ring]
+    ring_start = np.searchsorted(coord_ring, np.arange(len(ring_part)))
+    ring_length = np.bincount(coord_ring, minlength=len(ring_part))
+
+    # Number the distinct grid points
+    points, point_id = np.unique(grid[:, 0] * (quantization + 1) + grid[:, 1], return_inverse=True)
+    points = np.column_stack([points // (quantization + 1), points % (quantization + 1)])
+    point_id = point_id.ravel()
+
+    # A point is a junction if the rings through it do not all pass through the same pair of neighbouring points
+    position = np.arange(len(point_id)) - ring_start[coord_ring]
+    previous = point_id[ring_start[coord_ring] + (position - 1) % ring_length[coord_ring]]
+    following = point_id[ring_start[coord_ring] + (position + 1) % ring_length[coord_ring]]
+    neighbours = np.unique(np.column_stack([point_id, np.minimum(previous, following), np.maximum(previous, following)]), axis=0)
+    junction = (np.bincount(neighbours[:, 0], minlength=len(points)) > 1)[point_id]
+
+    # Cut each ring at its junctions and keep each arc once, in either direction
+    arcs, arc_numbers, ring_arcs = [], {}, []
+    for start, length in zip(ring_start, ring_length):
+        ring = point_id[start:start + length]
+        cuts = np.flatnonzero(junction[start:start + length])
+        if not len(cuts):   # A ring that shares no junction, such as an island, is one closed arc starting at its lowest point
+            lowest = np.argmin(ring)
+            pieces = [np.r_[ring[lowest:], ring[:lowest + 1]]]
+        else:
+            ring = np.r_[ring[cuts[0]:], ring[:cuts[0] + 1]]
+            ends = np.r_[cuts - cuts[0], length]
+            pieces = [ring[first:last + 1] for first, last in zip(ends[:-1], ends[1:])]
+        references = []
+        for arc in pieces:
+            key = arc.tobytes()
+            if key in arc_numbers:
+                references.append(arc_numbers[key])
+                continue
+            reverse_key = arc[::-1].tobytes()
+            if reverse_key in arc_numbers:
+                references.append(~arc_numbers[reverse_key])
+                continue
+            arc_numbers[key] = len(arcs)
+            references.append(len(arcs))
+            arcs.append(arc)
+        ring_arcs.append(references)
+    return points, arcs, ring_arcs, ring_part, part_geometry, transform
+
+def _simplify(points, arcs, tolerance, transform):
+    # Grid points of each arc simplified with a tolerance in metres, keeping its end points. The degrees are scaled to approximate
+    # metres at the middle latitude. Closed arcs that would collapse to fewer than 4 points are kept as they are
+    arcs_points = [points[arc] for arc in arcs]
+    if tolerance <= 0 or not arcs:
+        return arcs_points
+    scale = np.array(transform['scale'])
+    south, north = transform['bbox'][1], transform['bbox'][3]
+    metres = scale * metres_per_degree * np.array([np.cos(np.radians((south + north) / 2)), 1])
+    lengths = np.array([len(arc) for arc in arcs])
+    lines = shapely.linestrings(np.concatenate(arcs_points) * metres, indices=np.repeat(np.arange(len(arcs)), lengths))
+    simplified, arc_index = shapely.get_coordinates(shapely.simplify(lines, tolerance), return_index=True)
+    simplified = np.round(simplified / metres).astype(np.int64)
+    split = np.split(simplified, np.searchsorted(arc_index, np.arange(1, len(arcs))))
+    closed = np.array([arc[0] == arc[-1] for arc in arcs])
+    return [original if is_closed and len(new) < 4 else new for original, new, is_closed in zip(arcs_points, split, closed)]
+
+def _delta_encode(arc):
+    # First grid point of an arc, then the difference from each point to the next
+    return np.r_[arc[:1], np.diff(arc, axis=0)].tolist()
+
+def _geometries(ring_arcs, ring_part, part_geometry, n_geometries, records):
+    # TopoJSON Polygon or MultiPolygon of each geometry from the arc references of its rings, with its properties
+    parts = {}
+    for references, part in zip(ring_arcs, ring_part):
+        parts.setdefault(part, []).append(references)
+    polygons = [[] for _ in range(n_geometries)]
+    for part, part_rings in parts.items():
+        polygons[part_geometry[part]].append(part_rings)
+
+    geometries = []
+    for polygon, record in zip(polygons, records):
+        if not polygon:
+            geometries.append({'type': None, 'properties': record})
+        elif len(polygon) == 1:
+            geometries.append({'type': 'Polygon', 'arcs': polygon[0], 'properties': record})
+        else:
+            geometries.append({'type': 'MultiPolygon', 'arcs': polygon, 'properties': record})
+    return geometries
@@ -0,0 +1,175 @@
+import os
+from concurrent.futures import ThreadPoolExecutor
+import numpy as np
+import pandas as pd
+from scipy import stats
+import pcc_store
+
+"""
+This module correlates every metric of the water companies with every other in one go, for example the per capita consumption (PCC)
+of each period in pr24_hist_pcc.csv against the area of each CORINE land use class and the household metrics in Correlation_Data.csv,
+instead of one pearsonr call per pair.
+
+1. Put the metrics in one table with a row per company (Acronym) and a column per metric (see company_metrics).
+2. Group the pairs of columns by the companies that have a value in both (pairwise deletion of missing values), so that each group is
+   a complete block of data. For Spearman correlations the columns are ranked within each group.
+3. Find the Pearson or Spearman correlation of every pair in a group with one matrix product of the standardised columns, with the
+   two sided p-value of the t-test (as pearsonr and spearmanr give).
+4. Bootstrap the companies (resample them with replacement) to find a percentile confidence interval for each correlation, and
+   shuffle the companies of one column to find a permutation p-value. The resamples of a group are batched into arrays and split into
+   chunks that run in parallel threads. Each chunk draws from its own random generator spawned from one seed, so the results only
+   depend on the seed, not on the number of threads.
+5. Return a tidy table with one row per pair of metrics and method.
+"""
+
+methods = ('pearson', 'spearman')
+pcc_file = pcc_store.history_file
+household_file = 'data_files/Correlation_Data.csv'
+chunk_size = 250   # Resamples per parallel chunk
+
+def company_metrics(pcc_file=pcc_file, household_file=household_file, landuse_areas=None, companies=None, reference=pcc_store.pcc_reference):
+    """
+    Collect the metrics of each water company in one table for correlation_table.
+
+    Inputs:
+        pcc_file (str): The file path of the PCC history CSV file, with the columns Company (the acronym), PR24 PC reference and one
+            column per period (2011-12 to 2021-22).
+        household_file (str): The file path of the household CSV file, with the columns Company (the acronym), pcc, hh_cons and
+            hh_pop. Only the first row of each company (the whole company) is used. None to leave the household metrics out.
+        landuse_areas (pd.DataFrame): The area in hectares of each land use class inside each company, from
+            landuse_overlay.landuse_area_matrix, indexed by company name. None to leave the land use out.
+        companies (gpd.GeoDataFrame): The companies from data_loader.read_companies, to look up the acronym of each company name in
+            landuse_areas. The areas of company names with the same acronym are added together.
+        reference (str): The PR24 PC reference of the PCC rows to use. Some companies report further rows for parts of their area.
+
+    Output:
+        pd.DataFrame: One row per company acronym, with the columns 'PCC <period>' for each period, then pcc, hh_cons and hh_pop,
+        then one column per land use class. Missing values are NaN.
+    """
+    metrics = [pcc_store.pcc_by_period(pcc_file, reference).add_prefix('PCC ')]
+
+    if household_file is not None:
+        households = pd.read_csv(household_file, thousands=',').set_index('Company')
+        households = households[~households.index.duplicated()]   # Later rows of a company are its parts, as in the PCC file
+        metrics.append(households[['pcc', 'hh_cons', 'hh_pop']].apply(pd.to_numeric, errors='coerce'))
+    if landuse_areas is not None:
+        if companies is not None:   # Some acronyms have more than one spelling of the company name, whose areas are added up
+            landuse_areas = landuse_areas.rename(index=companies.set_index('COMPANY')['Acronym']).groupby(level=0).sum()
+        metrics.append(landuse_areas)
+
+    table = pd.concat(metrics, axis=1)
+    table.index.name = 'Acronym'
+    return table
+
+def correlation_table(x, y=None, methods=methods, n_bootstrap=1000, n_permutations=1000, confidence=0.95, seed=0, threads=None,
+                      min_count=3):
+    """
+    Correlate every column of x with every column of y, with bootstrap confidence intervals and permutation p-values.
+
+    Inputs:
+        x (pd.DataFrame): The metrics, one row per observation (such as a company) and one column per metric. Missing values are NaN.
+        y (pd.DataFrame): The metrics to correlate with those of x, with the same index. Defaults to x, in which case each pair of
+            columns is given once.
+        methods (sequence of str): 'pearson' and/or 'spearman'.
+        n_bootstrap (int): The number of bootstrap resamples for the confidence intervals. 0 to skip them.
+        n_permutations (int): The number of permutations for the permutation p-values. 0 to skip them.
+        confidence (float): The confidence level of the intervals.
+        seed (int): The seed of the random generators, so that the intervals and p-values can be repeated.
+        threads (int): The number of threads. Defaults to the number of cores.
+        min_count (int): The smallest number of observations with both values for a pair to be correlated. Pairs with fewer get NaN.
+
+    Output:
+        pd.DataFrame: One row per pair and method with the columns x, y, method, n (the number of observations with both values), r,
+        p_value (from the t-test), ci_low, ci_high and p_permutation.
+    """
+    unknown = set(methods) - {'pearson', 'spearman'}
+    if unknown:
+        raise ValueError(f'unknown correlation method(s) {sorted(unknown)}, use pearson or spearman')
+    same = y is None
+    y = x if same else y.reindex(x.index)
+    x_values = x.to_numpy(dtype=float)
+    y_values = y.to_numpy(dtype=float)
+    x_valid, y_valid = ~np.isnan(x_values), ~np.isnan(y_values)
+
+    # Group the columns by which rows they have values in, so that each pair of groups shares one complete set of rows
+    x_patterns, x_group = np.unique(x_valid.T, axis=0, return_inverse=True)
+    y_patterns, y_group = np.unique(y_valid.T, axis=0, return_inverse=True)
+    x_group, y_group = x_group.ravel(), y_group.ravel()
+    seeds = iter(np.random.SeedSequence(seed).spawn(len(methods) * len(x_patterns) * len(y_patterns)))
+
+    shape = (len(methods), x_values.shape[1], y_values.shape[1])
+    results = {name: np.full(shape, np.nan) for name in ['r', 'p_value', 'ci_low', 'ci_high', 'p_permutation']}
+    count = np.zeros(shape[1:], dtype=int)
+    with ThreadPoolExecutor(max_workers=threads or os.cpu_count() or 1) as pool:
+        for m, method in enumerate(methods):
+            for i, x_pattern in enumerate(x_patterns):
+                for j, y_pattern in enumerate(y_patterns):
+                    rows = np.flatnonzero(x_pattern & y_pattern)
+                    x_columns, y_columns = np.flatnonzero(x_group == i), np.flatnonzero(y_group == j)
+                    block = np.ix_(x_columns, y_columns)
+                    count[block] = len(rows)
+                    group_seed = next(seeds)   # Taken for every group, so that a group's draws do not depend on the groups before it
+                    if len(rows) < min_count:
+                        continue
+                    group = _group_correlations(x_values[np.ix_(rows, x_columns)], y_values[np.ix_(rows, y_columns)],
+                                                method == 'spearman', n_bootstrap, n_permutations, confidence, group_seed, pool)
+                    for name, values in group.items():
+                        results[name][m][block] = values
+
+    # Tidy table, one row per method and pair
+    m, i, j = np.indices(shape).reshape(3, -1)
+    keep = (i < j) if same else np.ones(len(i), dtype=bool)
+    m, i, j = m[keep], i[keep], j[keep]
+    table = pd.DataFrame({'x': x.columns.to_numpy()[i], 'y': y.columns.to_numpy()[j], 'method': np.asarray(methods)[m],
+                          'n': count[i, j]})
+    for name, values in results.items():
+        table[name] = values[m, i, j]
+    if not (n_bootstrap > 0):
+        table = table.drop(columns=['ci_low', 'ci_high'])
+    if not (n_permutations > 0):
+        table = table.drop(columns=['p_permutation'])
+    return table
+
+def _group_correlations(x, y, rank, n_bootstrap, n_permutations, confidence, seed, pool):
+    # Correlations, t-test p-values, bootstrap intervals and permutation p-values of every pair of columns of two complete blocks with
+    # the same rows. The resamples are drawn in chunks of chunk_size, each with its own generator, and run in the thread pool
+    n = len(x)
+    r = _correlate(x, y, rank)
+    with np.errstate(divide='ignore', invalid='ignore'):
+        t = r * np.sqrt((n - 2) / (1 - r ** 2))
+    result = {'r': r, 'p_value': 2 * stats.t.sf(np.abs(t), n - 2)}
+    bootstrap_seed, permutation_seed = seed.spawn(2)
+
+    if n_bootstrap > 0:
+        def bootstrap(chunk_seed, size):
+            samples = np.random.default_rng(chunk_seed).integers(0, n, size=(size, n))
+            return _correlate(x[samples], y[samples], rank)
+        draws = np.concatenate(list(pool.map(bootstrap, *_chunks(bootstrap_seed, n_bootstrap))))
+        with np.errstate(invalid='ignore'):   # Resamples that repeat one company have no variance and give NaN, which is ignored
+            result['ci_low'], result['ci_high'] = np.nanpercentile(draws, [50 * (1 - confidence), 50 * (1 + confidence)], axis=0)
+
+    if n_permutations > 0:
+        def permutation(chunk_seed, size):
+            shuffles = np.random.default_rng(chunk_seed).permuted(np.tile(np.arange(n), (size, 1)), axis=1)
+            return (np.abs(_correlate(x, y[shuffles], rank)) >= np.abs(r) - 1e-12).sum(axis=0)
+        exceed = sum(pool.map(permutation, *_chunks(permutation_seed, n_permutations)))
+        result['p_permutation'] = np.where(np.isnan(r), np.nan, (exceed + 1) / (n_permutations + 1))
+    return result
+
+def _chunks(seed, total):
+    # Generator seeds and sizes of the chunks of total resamples
+    sizes = [min(chunk_size, total - start) for start in range(0, total, chunk_size)]
+    return seed.spawn(len(sizes)), sizes
+
+def _correlate(x, y, rank):
+    # Correlation of every column of x (..., n, a) with every column of y (..., n, b), over the rows (axis -2), as (..., a, b).
+    # Leading axes are resamples; x or y may have none and is then shared by all of them
+    if rank:
+        x, y = stats.rankdata(x, axis=-2), stats.rankdata(y, axis=-2)
+    x = x - x.mean(axis=-2, keepdims=True)
+    y = y - y.mean(axis=-2, keepdims=True)
+    with np.errstate(divide='ignore', invalid='ignore'):
+        x = x / np.sqrt((x ** 2).sum(axis=-2, keepdims=True))
+        y = y / np.sqrt((y ** 2).sum(axis=-2, keepdims=True))
+        r = np.swapaxes(x, -1, -2) @ y
+    return np.clip(r, -1, 1)
@@ -3,23 +3,29 @@ import geopandas as gpd
 import pandas as pd
 from scipy.stats import pearsonr
 from functions import read_water_resource_zones
+import data_loader
+from landuse_overlay import landuse_area_matrix, company_landuse_table
+from correlation_engine import company_metrics, correlation_table
 
 """
 This code performs data processing and analysis on water company data and land use data.
 
 1. Load water company data and filter it based on specific area types.
-2. Perform union operation on the geometries of water company groups.
-3. Create a new GeoDataFrame with the unioned geometries for each company.
+2. Load the water company areas dissolved into one geometry per company (unioned once and cached by data_loader).
+3. Keep the COMPANY and Acronym of each company with its geometry.
 4. Append correlation data to the water company GeoDataFrame.
 5. Convert certain columns to numeric and filter out NaN values.
 6. Calculate the Pearson correlation coefficient between household population and consumption.
-7. Load land use data and merge it with the water company GeoDataFrame.
-8. Perform a spatial join between water companies and land use data.
-9. Group the data by company and land use label, and sum the area column.
-10. Create a new GeoDataFrame with the grouped data and centroid geometry.
+7. Stream the land use data within the extent of the water companies in chunks, and load the legend that maps each CORINE code to
+   its label and class.
+8. Overlay the land use chunks on the water companies, clipping land use polygons that straddle a company boundary.
+9. Find the area of each land use code inside each company.
+10. Create a new GeoDataFrame with the areas, the legend labels and the company centroid geometry.
 11. Filter the rows with 'urban' land use.
 12. Calculate the total area of urban land use for each company.
 13. Calculate the Pearson correlation coefficient between household consumption and urban land use area.
+14. Correlate the PCC of every period and the household metrics with the area of every land use class in one batch, with bootstrap
+    confidence intervals and permutation p-values, and save the table to data_files/correlation_results.csv.
 
 The Pearson's Correlation Coefficient code is contributed by Amiya Rout (ref: https://www.geeksforgeeks.org/python-pearson-correlation-test-between-two-variables/)
 """
@@ -31,29 +37,15 @@ wrz = read_water_resource_zones(water_area_file)
 
 included_area_types = ['regional water and sewerage company', 'regional water only company'] # Filter the GeoDataFrame to select the features with "Northumbrian Water"
 
-wrz['COMPANY'] = wrz['COMPANY'].replace('Northumbrian Water Limited', 'Northumbrian Water') # fix issue with NES record
+wrz['COMPANY'] = wrz['COMPANY'].replace(data_loader.company_name_fixes) # fix issue with NES record
 
 # Filter out features with the specified area types
 wrz_ref = wrz[wrz['CoType'].isin(included_area_types)]
  # len(wrz_ref) # uncomment this to check that all 43 water company areas are included 
 wrz_ref
-# Group the data by the 'Company' column
-grouped_wrz = wrz.groupby('COMPANY')
-
-# Create an empty GeoSeries to store the unioned geometries
-merged_geometries = gpd.GeoSeries()
-acronyms = []
-
-# Iterate over each group and perform the union operation
-for group_name, group_data in grouped_wrz:
-    unioned_geometry = group_data['geometry'].unary_union
-    merged_geometries[group_name] = unioned_geometry
-    acronyms.append(group_data['Acronym'].iloc[0])
-    
-# Create a new GeoDataFrame with the unioned geometries for each company
-merged_wrz_companies = gpd.GeoDataFrame(geometry=merged_geometries.values, index=merged_geometries.index)
-merged_wrz_companies['COMPANY'] = merged_geometries.index
-merged_wrz_companies['Acronym'] = acronyms
+# Load the unioned geometry of each company - the dissolve is done once and cached alongside the source data
+companies = data_loader.read_companies(water_area_file)
+merged_wrz_companies = companies[['COMPANY', 'Acronym', 'geometry']]
 merged_wrz_companies
 
 # Append Correlation data to the wrz geodataframe
@@ -84,36 +76,21 @@ print('Pearsons correlation for household population and household consumption:
 
 # The code for pearsonr() is contributed by Amiya Rout (ref: https://www.geeksforgeeks.org/python-pearson-correlation-test-between-two-variables/)
 
-# Load landuse data
-landuse = gpd.read_file(os.path.abspath('data_files/clc2018_uk.shp'))
+# Stream the landuse data in chunks - only the CORINE code of the polygons within the extent of the companies is read from the
+# GeoParquet cache, the labels come from the legend
+landuse = data_loader.iter_corine('data_files/clc2018_uk.shp', columns=['CODE_18'], bbox=companies)
 
-# Load the CSV file
-landuse_categories = pd.read_csv('data_files/legend.csv')
-# print(landuse_categories.head())  #show a sample of the CSV file 
-
-# merge the csv file with the geodataframe to include the labels for the landuse in the geodataframe
-landuse_categories['CODE'] = landuse_categories['CODE'].astype(str)
-merged_landuse = pd.merge(landuse, landuse_categories, left_on='CODE_18', right_on='CODE')
-# Drop unnecessary columns - this cleans the dataset to make it easier to work with
-merged_landuse = merged_landuse.drop(['CODE_18', 'CODE', 'Unnamed: 4', 'Unnamed: 5'], axis=1)
-merged_landuse
-# Access the 'LABEL' column in the merged DataFrame - LABEL gives the actual landuse description
-label_column = merged_landuse['LABEL']
-merged_wrz_companies = merged_wrz_companies.set_crs(wrz.crs)
-# print(merged_landuse.crs == merged_wrz_companies.crs) # test if the crs is the same 
-
-# Perform spatial join between wrz and merged_landuse
-join = gpd.sjoin(merged_wrz_companies, merged_landuse, how='inner', predicate='intersects')
-# Group by COMPANY and LABEL, and sum the Area_Ha column
-grouped = join.groupby(['COMPANY', 'LABEL'])['Area_Ha'].sum().reset_index()
-
-# Create a new GeoDataFrame from the grouped data
-company_landuse = gpd.GeoDataFrame(grouped, geometry=gpd.GeoSeries(), crs=wrz.crs)
-
-# Set the geometry of the new GeoDataFrame to the centroid of each LABEL
-company_landuse.geometry = company_landuse.apply(lambda x: wrz[wrz['COMPANY'] == x['COMPANY']].geometry.centroid.iloc[0], axis=1)
-# Filter the rows where LABEL includes 'urban'
-urban_company_landuse = company_landuse[company_landuse['LABEL'].str.contains('urban')]
+# Load the legend - the LABEL, level 1 class and urban flag of each CORINE code
+legend = data_loader.read_corine_legend('data_files/legend.csv')
+# print(legend.head())  #show a sample of the legend
+
+# Overlay landuse on wrz - only the part of each land use polygon inside a company counts towards its area
+landuse_areas = landuse_area_matrix(merged_wrz_companies, landuse, 'COMPANY', 'CODE_18')
+
+# One row per COMPANY and CORINE code with the area in hectares and the legend LABEL, located at the centroid of the company
+company_landuse = company_landuse_table(landuse_areas, companies, legend)
+# Filter the rows where LABEL includes 'urban' - the urban flag is set once per code in the legend
+urban_company_landuse = company_landuse[company_landuse['urban']]
 urban_company_landuse
 # Group the rows by the COMPANY column and get the sum of the Area_Ha column for each group
 area_by_company = urban_company_landuse.groupby("COMPANY")["Area_Ha"].sum()
@@ -138,4 +115,11 @@ list3 = correlate_landuse['Area_Ha']
 corr, _ = pearsonr(list2, list3)
 print('Pearsons correlation for household population and area urban landuse: %.3f' % corr)
 
+# Correlate every PCC period and household metric with the area of every land use class, labelled from the legend
+metrics = company_metrics(landuse_areas=landuse_areas.rename(columns=legend['LABEL']), companies=companies)
+demand_columns = [column for column in metrics.columns if column.startswith('PCC ')] + ['pcc', 'hh_cons', 'hh_pop']
+correlation_results = correlation_table(metrics[demand_columns], metrics.drop(columns=demand_columns))
+correlation_results.to_csv('data_files/correlation_results.csv', index=False)
+print(correlation_results.sort_values('p_permutation').head(10))
+
 
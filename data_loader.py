@@ -0,0 +1,339 @@
+import os
+import glob
+import hashlib
+import json
+import numpy as np
+import pandas as pd
+import shapely
+import pyproj
+import geopandas as gpd
+import cache_files
+
+"""
+This module is the shared loader for the vector data sets, so that the water supply areas (WaterSupplyAreas_incNAVs v1_4.shp) and
+the CORINE land cover (clc2018_uk.shp) are parsed from their shapefiles once rather than on every call.
+
+1. On the first read of a source file, parse it with geopandas, drop the unwanted columns (the disclaimer columns of the water supply
+   areas) and save it as a columnar GeoParquet file in the cache directory.
+2. Name the GeoParquet file after the dropped columns and a fingerprint of the source: the size and modification time of each of its
+   files (.shp, .dbf, .shx, .prj, .cpg). If the source changes, the fingerprint changes and the source is converted again; the old
+   GeoParquet file is deleted.
+3. Read later requests from the GeoParquet file, only loading the columns asked for, which is many times faster than parsing the
+   shapefile. This matters most for the national CORINE layer.
+4. Keep each layer in memory once read, and return a copy on repeated calls in the same process, so that callers can add or change
+   columns without affecting each other.
+5. Dissolve the water supply areas into one row per company in a single vectorised union, with the company attributes, centroid,
+   bounds and a simplified outline, and cache it in the same way, so that consumers load ready-made company polygons.
+6. Cache the CORINE polygons in the order of a Hilbert curve, with the bounding box of each polygon, in row groups. A read for an area
+   of interest (such as the extent of the water companies) and/or a subset of CORINE codes then skips the row groups that cannot
+   match, and can stream the rest in chunks, so that memory and read time scale with the area read rather than the whole UK layer.
+
+GeoParquet needs pyarrow. Without it the layers are read from the source files each time, and only the in-memory copy is kept; the
+CORINE bounding box filter is then passed to the shapefile reader instead.
+"""
+
+cache_dir = 'data_files/cache'
+water_supply_areas_file = 'data_files/WaterSupplyAreas_incNAVs v1_4.shp'
+corine_file = 'data_files/clc2018_uk.shp'
+corine_legend_file = 'data_files/legend.csv'
+corine_level1_classes = {'1': 'Artificial surfaces', '2': 'Agricultural areas', '3': 'Forest and semi natural areas', '4': 'Wetlands',
+                         '5': 'Water bodies'}
+disclaimer_columns = ['Disclaimer', 'Disclaim2', 'Disclaim3', 'Provenance', 'Licence', 'WARNINGS', 'Revisions']
+company_name_fixes = {'Northumbrian Water Limited': 'Northumbrian Water'}   # Fix issue with the NES record
+corine_row_group_size = 20000   # Polygons per row group of the CORINE GeoParquet file, the unit that filtered reads skip
+bbox_columns = ['bbox_minx', 'bbox_miny', 'bbox_maxx', 'bbox_maxy']   # Bounding box of each CORINE polygon, for the filters
+
+_layers = {}   # In-process copies of the layers read so far, keyed by source, fingerprint, variant and columns
+
+def read_layer(source_file, drop_columns=(), columns=None, cache_dir=cache_dir):
+    """
+    Read a vector layer through the GeoParquet cache.
+
+    Inputs:
+        source_file (str): The file path of the source layer, such as a shapefile.
+        drop_columns (list of str): Columns to drop from the source before it is cached. Columns that are not in the source are ignored.
+        columns (list of str): The columns to return, besides the geometry. Defaults to all columns.
+        cache_dir (str): The directory for the GeoParquet files (created if needed).
+
+    Output:
+        gpd.GeoDataFrame: A copy of the layer.
+    """
+    read = lambda: gpd.read_file(source_file).drop(columns=list(drop_columns), errors='ignore')
+    return _read_cached(source_file, {'drop_columns': sorted(drop_columns)}, read, columns, cache_dir)
+
+def read_water_supply_areas(water_areas_file=water_supply_areas_file, columns=None, cache_dir=cache_dir):
+    """
+    Read the water supply areas without the disclaimer columns.
+
+    Inputs:
+        water_areas_file (str): The file path of the water supply areas shapefile.
+        columns (list of str): The columns to return, besides the geometry. Defaults to all columns.
+        cache_dir (str): The directory for the GeoParquet files.
+
+    Output:
+        gpd.GeoDataFrame: The water supply areas.
+    """
+    return read_layer(water_areas_file, disclaimer_columns, columns, cache_dir)
+
+def read_companies(water_areas_file=water_supply_areas_file, by='COMPANY', simplify_tolerance=100, columns=None, cache_dir=cache_dir):
+    """
+    Read the water supply areas dissolved into one row per company (see dissolve_companies), through the GeoParquet cache.
+
+    Inputs:
+        water_areas_file (str): The file path of the water supply areas shapefile.
+        by (str): The column to dissolve by, COMPANY, or AreaServed for the areas within each company.
+        simplify_tolerance (float): The tolerance of the simplified outlines, in the units of the CRS (metres for EPSG:27700).
+        columns (list of str): The columns to return, besides the geometry. Defaults to all columns.
+        cache_dir (str): The directory for the GeoParquet files.
+
+    Output:
+        gpd.GeoDataFrame: The companies, see dissolve_companies.
+    """
+    read = lambda: dissolve_companies(read_water_supply_areas(water_areas_file, cache_dir=cache_dir), by, simplify_tolerance)
+    variant = {'dissolve_by': by, 'simplify_tolerance': simplify_tolerance, 'company_name_fixes': company_name_fixes}
+    return _read_cached(water_areas_file, variant, read, columns, cache_dir)
+
+def dissolve_companies(wrz, by='COMPANY', simplify_tolerance=100):
+    """
+    Dissolve the water supply areas into one geometry per company, unioning all companies in one vectorised call.
+
+    Inputs:
+        wrz (gpd.GeoDataFrame): The water supply areas, with the columns COMPANY, Acronym and CoType.
+        by (str): The column to dissolve by. Rows where it is missing are left out.
+        simplify_tolerance (float): The tolerance of the simplified outlines, in the units of the CRS.
+
+    Output:
+        gpd.GeoDataFrame: One row per value of by, indexed by it and sorted, with the columns COMPANY, Acronym and CoType (from the first
+        row of each company), geometry (the union), centroid_x, centroid_y, minx, miny, maxx, maxy and simplified (the outline
+        simplified with the tolerance, keeping its topology). Company names are corrected with company_name_fixes first.
+    """
+    wrz = wrz[wrz[by].notna()].assign(COMPANY=lambda frame: frame['COMPANY'].replace(company_name_fixes))
+    names, group = np.unique(wrz[by].astype(str).to_numpy(), return_inverse=True)
+
+    # Lay the geometries out as a table with one row per company, padded with None (which union_all ignores), and union each row
+    order = np.argsort(group, kind='stable')
+    counts = np.bincount(group, minlength=len(names))
+    starts = np.cumsum(counts) - counts
+    table = np.full((len(names), counts.max(initial=0)), None, dtype=object)
+    table[group[order], np.arange(len(order)) - np.repeat(starts, counts)] = wrz.geometry.to_numpy()[order]
+    geometry = shapely.union_all(table, axis=1)
+
+    attributes = list(dict.fromkeys(column for column in [by, 'COMPANY', 'Acronym', 'CoType'] if column in wrz.columns))
+    companies = pd.DataFrame(wrz.iloc[order[starts]][attributes]).set_axis(names)
+    companies = gpd.GeoDataFrame(companies, geometry=geometry, crs=wrz.crs)
+    centroids = shapely.centroid(geometry)
+    companies['centroid_x'], companies['centroid_y'] = shapely.get_x(centroids), shapely.get_y(centroids)
+    companies[['minx', 'miny', 'maxx', 'maxy']] = shapely.bounds(geometry)
+    companies['simplified'] = gpd.GeoSeries(shapely.simplify(geometry, simplify_tolerance), index=names, crs=wrz.crs)
+    return companies
+
+def read_corine(landuse_file=corine_file, columns=None, cache_dir=cache_dir, bbox=None, codes=None):
+    """
+    Read the CORINE land cover layer, or the part of it in an area of interest and/or with some CORINE codes.
+
+    Inputs:
+        landuse_file (str): The file path of the CORINE shapefile.
+        columns (list of str): The columns to return, besides the geometry, for example ['CODE_18', 'Area_Ha']. Defaults to all columns.
+        cache_dir (str): The directory for the GeoParquet files.
+        bbox (tuple or gpd.GeoDataFrame): The area of interest, as (minx, miny, maxx, maxy) in the CRS of the layer, or as a
+            GeoDataFrame, GeoSeries or geometry whose bounds are used (reprojected to the CRS of the layer if it has a CRS).
+        codes (list of str): The CORINE codes (CODE_18) to read, such as ['111', '112'].
+
+    Output:
+        gpd.GeoDataFrame: The land cover polygons. With bbox, the polygons whose bounding box overlaps it (the overlay clips them).
+    """
+    if bbox is None and codes is None:
+        return _read_cached(landuse_file, _corine_variant, lambda: _read_corine_source(landuse_file), columns, cache_dir,
+                            row_group_size=corine_row_group_size)
+    return next(iter_corine(landuse_file, columns, cache_dir, bbox, codes, chunk_size=None))
+
+def iter_corine(landuse_file=corine_file, columns=None, cache_dir=cache_dir, bbox=None, codes=None, chunk_size=100000):
+    """
+    Read the CORINE land cover layer in chunks, optionally only in an area of interest and/or with some CORINE codes (see read_corine).
+    The chunks can be passed straight to landuse_overlay.landuse_area_matrix.
+
+    Inputs:
+        landuse_file (str): The file path of the CORINE shapefile.
+        columns (list of str): The columns to return, besides the geometry. Defaults to all columns.
+        cache_dir (str): The directory for the GeoParquet files.
+        bbox (tuple or gpd.GeoDataFrame): The area of interest, see read_corine.
+        codes (list of str): The CORINE codes (CODE_18) to read.
+        chunk_size (int): The largest number of polygons in a chunk. None for a single chunk.
+
+    Output:
+        generator of gpd.GeoDataFrame: The chunks of land cover polygons.
+    """
+    source_file = os.path.abspath(landuse_file)
+    try:
+        import pyarrow.dataset as ds
+    except ImportError:
+        yield from _iter_shapefile(source_file, columns, bbox, codes, chunk_size)
+        return
+
+    fingerprint = file_fingerprint(source_file)
+    cache_file, _ = _cache_file(source_file, fingerprint, _variant_hash(_corine_variant), lambda: _read_corine_source(source_file),
+                                cache_dir, row_group_size=corine_row_group_size)
+    dataset = ds.dataset(cache_file, format='parquet')
+    crs = json.loads(dataset.schema.metadata[b'geo'])['columns']['geometry'].get('crs')
+    bounds = _bounds_in(bbox, crs)
+    condition = None
+    if bounds is not None:
+        minx, miny, maxx, maxy = bounds
+        condition = ((ds.field('bbox_maxx') >= minx) & (ds.field('bbox_minx') <= maxx) &
+                     (ds.field('bbox_maxy') >= miny) & (ds.field('bbox_miny') <= maxy))
+    if codes is not None:
+        in_codes = ds.field('CODE_18').isin([str(code) for code in codes])
+        condition = in_codes if condition is None else condition & in_codes
+    if columns is None:
+        columns = [name for name in dataset.schema.names if name not in bbox_columns + ['geometry']]
+    columns = list(columns) + ['geometry']
+
+    if chunk_size is None:
+        yield _from_arrow(dataset.to_table(columns=columns, filter=condition), crs)
+        return
+    for batch in dataset.to_batches(columns=columns, filter=condition, batch_size=chunk_size):
+        if batch.num_rows:
+            yield _from_arrow(batch, crs)
+
+def read_corine_legend(legend_file=corine_legend_file):
+    """
+    Read the CORINE legend as a lookup from land cover code to class, so that codes are mapped to labels and classes once per code
+    rather than once per polygon.
+
+    Input:
+        legend_file (str): The file path of the legend CSV file, with the columns CODE and LABEL.
+
+    Output:
+        pd.DataFrame: Indexed by CODE (as a string, like CODE_18 in the CORINE layer), with the columns LABEL, level1 (the level 1
+        class, such as Artificial surfaces) and urban (True for the labels that include 'urban').
+    """
+    legend = pd.read_csv(legend_file, usecols=['CODE', 'LABEL'], dtype={'CODE': str}).set_index('CODE')
+    legend['level1'] = legend.index.str[0].map(corine_level1_classes)
+    legend['urban'] = legend['LABEL'].str.contains('urban')
+    return legend
+
+def clear_cache(cache_dir=cache_dir):
+    """
+    Forget the in-process copies of the layers and delete the GeoParquet files in the cache directory.
+
+    Input:
+        cache_dir (str): The directory of the GeoParquet files.
+    """
+    _layers.clear()
+    for path in glob.glob(os.path.join(cache_dir, '*.parquet')):
+        os.remove(path)
+
+def file_fingerprint(source_file):
+    """
+    Fingerprint a source file by the size and modification time of each of its files (a shapefile is several files), as used to name
+    the GeoParquet files. Other caches of data read from the source can use it to notice that the source has changed.
+
+    Input:
+        source_file (str): The file path of the source, such as a shapefile.
+
+    Output:
+        str: A 16 character hexadecimal hash, which changes when any file of the source is changed, added or removed.
+    """
+    stem = os.path.splitext(source_file)[0]
+    files = sorted(path for path in glob.glob(glob.escape(stem) + '.*') if not path.endswith('.xml'))
+    if source_file not in files:
+        raise FileNotFoundError(source_file)
+    stats = [(os.path.basename(path), os.stat(path).st_size, os.stat(path).st_mtime_ns) for path in files]
+    return hashlib.sha256(json.dumps(stats).encode()).hexdigest()[:16]
+
+_corine_variant = {'hilbert_order': True, 'bbox_columns': bbox_columns}
+
+def _read_cached(source_file, variant, read, columns, cache_dir, **write_options):
+    # Return a copy of a layer made from a source file by read(), from memory, from its GeoParquet file, or by calling read() and
+    # saving the result. variant describes how the layer is made from the source, such as the dropped columns
+    source_file = os.path.abspath(source_file)
+    fingerprint = file_fingerprint(source_file)
+    variant = _variant_hash(variant)
+    key = (source_file, fingerprint, variant, None if columns is None else tuple(columns))
+    if key not in _layers:
+        _layers[key] = _read_layer(source_file, fingerprint, variant, read, columns, cache_dir, write_options)
+    return _layers[key].copy()
+
+def _read_layer(source_file, fingerprint, variant, read, columns, cache_dir, write_options):
+    # Read a layer from its GeoParquet file, making it with read() first if there is no file for the current fingerprint. The
+    # bounding box columns of the CORINE layer are only used by the filters, and are left out
+    cache_file, layer = _cache_file(source_file, fingerprint, variant, read, cache_dir, **write_options)
+    if cache_file is None:
+        print('pyarrow is not installed, reading', source_file, 'without the GeoParquet cache')
+    if layer is None:
+        layer = gpd.read_parquet(cache_file, columns=None if columns is None else list(columns) + ['geometry'])
+    layer = layer.drop(columns=bbox_columns, errors='ignore')
+    return layer if columns is None else layer[list(columns) + [layer.geometry.name]]
+
+def _cache_file(source_file, fingerprint, variant, read, cache_dir, **write_options):
+    # File path of the GeoParquet file of a layer, making it with read() first if there is no file for the current fingerprint, and
+    # the layer if it was read. Without pyarrow the path is None and the layer is always read
+    try:
+        import pyarrow
+    except ImportError:
+        return None, read()
+
+    stem = os.path.splitext(os.path.basename(source_file))[0]
+    cache_file = os.path.join(cache_dir, f'{stem}-{variant}-{fingerprint}.parquet')
+    if os.path.exists(cache_file):
+        return cache_file, None
+    print('Converting', source_file, 'to GeoParquet')
+    layer = read()
+    with cache_files.atomic_file(cache_file) as partial:
+        layer.to_parquet(partial, **write_options)
+    for old_file in glob.glob(os.path.join(glob.escape(cache_dir), f'{glob.escape(stem)}-{variant}-' + '[0-9a-f]' * 16 + '.parquet')):
+        if old_file != cache_file:   # Converted from an earlier version of the source
+            os.remove(old_file)
+    return cache_file, layer
+
+def _read_corine_source(landuse_file):
+    # Read the CORINE shapefile with the bounding box of each polygon, in the order of a Hilbert curve through the polygon centres,
+    # so that each row group covers a compact area and has tight bounding box statistics
+    layer = gpd.read_file(landuse_file)
+    layer[bbox_columns] = layer.bounds.to_numpy()
+    return layer.iloc[np.argsort(layer.geometry.hilbert_distance().to_numpy(), kind='stable')].reset_index(drop=True)
+
+def _iter_shapefile(source_file, columns, bbox, codes, chunk_size):
+    # Chunks of the CORINE shapefile, read without the GeoParquet cache. The bounding box filter is passed to the reader and the
+    # codes are filtered after reading
+    crs = gpd.read_file(source_file, rows=1).crs
+    bounds = _bounds_in(bbox, crs)
+    bounds = None if bounds is None else tuple(bounds)
+    start = 0
+    while True:
+        rows = None if chunk_size is None else slice(start, start + chunk_size)
+        chunk = gpd.read_file(source_file, bbox=bounds, rows=rows)
+        n_read = len(chunk)
+        if codes is not None:
+            chunk = chunk[chunk['CODE_18'].astype(str).isin([str(code) for code in codes])]
+        if columns is not None:
+            chunk = chunk[list(columns) + [chunk.geometry.name]]
+        if len(chunk) or start == 0:
+            yield chunk
+        if chunk_size is None or n_read < chunk_size:
+            return
+        start += chunk_size
+
+def _bounds_in(bbox, crs):
+    # (minx, miny, maxx, maxy) of an area of interest in the given CRS. GeoDataFrames and GeoSeries with a CRS are reprojected, with
+    # the outline of their bounding box densified so that the reprojected bounds cover it
+    if bbox is None:
+        return None
+    if isinstance(bbox, (gpd.GeoDataFrame, gpd.GeoSeries)):
+        if bbox.crs is not None and crs is not None and bbox.crs != pyproj.CRS.from_user_input(crs):
+            outline = shapely.segmentize(shapely.box(*bbox.total_bounds), max(np.ptp(bbox.total_bounds.reshape(2, 2), axis=0)) / 100)
+            return gpd.GeoSeries([outline], crs=bbox.crs).to_crs(crs).total_bounds
+        return bbox.total_bounds
+    if isinstance(bbox, shapely.Geometry):
+        return shapely.bounds(bbox)
+    return np.asarray(bbox, dtype=float)
+
+def _from_arrow(table, crs):
+    # GeoDataFrame from an Arrow table or record batch of a GeoParquet file, with the geometry stored as WKB
+    frame = table.to_pandas()
+    geometry = shapely.from_wkb(frame.pop('geometry').to_numpy())
+    return gpd.GeoDataFrame(frame, geometry=geometry, crs=crs)
+
+def _variant_hash(variant):
+    # Short hash of the description of how a layer is made from its source
+    return hashlib.sha256(json.dumps(variant, sort_keys=True).encode()).hexdigest()[:8]
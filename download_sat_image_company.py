@@ -1,10 +1,14 @@
 import functions
 import geopandas as gpd
-from sentinelsat import SentinelAPI, make_path_filter
+from sentinelsat import SentinelAPI
+import data_loader
+import product_downloader
+import scene_selection
+import scene_catalog
 from IPython import display
 import os
 
-def download_best_overlap_image(company_detail,date_start,date_end):
+def download_best_overlap_image(company_detail,date_start,date_end,directory='.',download_all=False,band_pattern='*_B*.jp2',coverage=None,offline=False):
     """
     Downloads the best overlapping image for a given water company within a specified date range.
 
@@ -12,23 +16,26 @@ def download_best_overlap_image(company_detail,date_start,date_end):
         company_detail (str): The name of the water company. This is the AreaServed column in the dataset that is provided as example.
         date_start (str): The start date of the date range in the format 'YYYYMMDD'.
         date_end (str): The end date of the date range in the format 'YYYYMMDD'.
+        directory (str): The directory to download the products into.
+        download_all (bool): True to also download every match, not only the one with the best overlap.
+        band_pattern (str): The pattern of the files to download from each match when download_all is True, such as '*_B*.jp2' for
+            the image bands only. None to download whole products.
+        coverage (float): None to download the image with the largest overlap with the company area, or the fraction of the company
+            area to cover, to download the fewest images that together cover it (see scene_selection.select_scenes).
+        offline (bool): True to choose from the images in the local scene catalog only, without connecting to the API. Nothing is
+            downloaded; the chosen images already on disk are returned as downloaded and the others as failed.
 
     Outputs:
-        None
-    The code to download all matches must be uncommented if the results are to be downloaded.
+        dict, dict: The products that were downloaded and the products that failed, by id (see product_downloader.download_products).
+    The downloads run in parallel, resume partial files and are checked against their MD5 checksums (see product_downloader).
+    Searches are kept in a local scene catalog (see scene_catalog), so the API is only searched for dates not searched before.
     """
     
-    # Load water company data as wrz, remove unnecessary columns
-    wrz = gpd.read_file(os.path.abspath('data_files/WaterSupplyAreas_incNAVs v1_4.shp'))
-    
-    # select water company to review in further detail:
-    selected_company_gdf = wrz[wrz['AreaServed'] == company_detail]
-
-    # get the outline of the selected water company:
-    company_outline = selected_company_gdf['geometry']
+    # Load the water supply areas dissolved by AreaServed - the outlines are unioned once and cached by data_loader
+    areas = data_loader.read_companies(by='AreaServed', columns=[])
 
     # create a new GeoDataFrame with the outline of the selected water company:
-    outline_gdf = gpd.GeoDataFrame(geometry=company_outline)
+    outline_gdf = areas.loc[[company_detail]]
 
     # print the GeoDataFrame
     print(outline_gdf)
@@ -36,8 +43,8 @@ def download_best_overlap_image(company_detail,date_start,date_end):
     # ensure that the crs for the the gdf of the water company selected is set to epsg 4326
     outline_gdf = outline_gdf.to_crs(epsg=4326)
 
-    # convert the MULTIPOLYGON to a valid POLYGON
-    polygon = outline_gdf['geometry'].unary_union
+    # the outline of the selected water company, already unioned into one geometry
+    polygon = outline_gdf['geometry'].iloc[0]
     #polygon # to visualise polygon
 
     # get the minimum rotated angle 
@@ -45,61 +52,62 @@ def download_best_overlap_image(company_detail,date_start,date_end):
 
     #search_area # to visual rotated rectangle
 
-    #connect to SentinelAPI
-    api = SentinelAPI(None, None, api_url='https://scihub.copernicus.eu/dhus') # connect to the SentinelAPi using sign on details on .netrc file
+    #connect to SentinelAPI, unless working offline from the scene catalog
+    api = None if offline else SentinelAPI(None, None, api_url='https://scihub.copernicus.eu/dhus') # connect to the SentinelAPi using sign on details on .netrc file
 
-    #retrieve images for 10% cloud cover, date range 1 April 2019 to 31 March 2020 
-    products = api.query(search_area.wkt, # use the WKT representation of our search area
-                     date=(date_start,date_end), # all images from February 2023
-                     platformname='Sentinel-2', # the platform name is Sentinel-2
-                     producttype='S2MSI2A', # surface reflectance product (L2A)
-                     cloudcoverpercentage=(0, 10)) # limit to 10% cloud cover
+    #retrieve images for 10% cloud cover from the scene catalog, searching the API only for the dates not searched before for this area
+    product_geo = scene_catalog.query_scenes(api, search_area, # the search area, in EPSG:4326
+                                             date_start, date_end, # all images from date_start up to date_end
+                                             max_cloud=10, # limit to 10% cloud cover
+                                             platformname='Sentinel-2', # the platform name is Sentinel-2
+                                             producttype='S2MSI2A', # surface reflectance product (L2A)
+                                             offline=offline)
     # Determine the number of images retrieved
-    nresults = len(products) # get the number of results found
+    nresults = len(product_geo) # get the number of results found
     print('Found {} results'.format(nresults)) # show the number of results found 
     if nresults == 0:
         print('No images in this range')   # this is to show that no results were found
+        return {}, {}
 
-    results = next(iter(products)) # gets the second item from the dict
-    products[results] # show the metadata for the second item
+    results = product_geo.index[0] # gets the first item
+    print(product_geo.loc[results]) # show the metadata for the first item
 
-    qlook = api.download_quicklook(results) # download the quicklook image for this first result 
-    display.Image(qlook['path']) # display the image 
-    
-     # Retrieve the downloaded image path
-    qlook = api.download_quicklook(results)
-    image_path = qlook['path']
+    if not offline: # the quicklook needs the API
+        qlook = api.download_quicklook(results, directory) # download the quicklook image for this first result
+        image_path = qlook['path']
+
+        print("Image path:", image_path)  # Print the image path for debugging
+
+        # Check if the image file exists
+        if os.path.exists(image_path):
+            # Display the image
+            display.display(display.Image(image_path))
+        else:
+            print('Image file not found at:', image_path)
 
-    print("Image path:", image_path)  # Print the image path for debugging
-    
-    # Check if the image file exists
-    if os.path.exists(image_path):
-        # Display the image
-        display.Image(image_path)
-    else:
-        print('Image file not found at:', image_path)
-
-    product_geo = SentinelAPI.to_geodataframe(products) # convert the search results to a geodataframe
     product_geo.head() # show the first 5 rows of the geodataframe
 
-    # calculate the % overlay of the image and the rectangle for selection
-    for ind, row in product_geo.iterrows():
-        intersection = search_area.intersection(row['geometry']) # find the intersection of the two polygons
-        product_geo.loc[ind, 'overlap'] = intersection.area / search_area.area # get the fractional overlap
-    
+    # calculate the fraction of the company area inside each image, for all images at once, against the outline itself
+    product_geo['overlap'] = scene_selection.overlap_fractions(product_geo, outline_gdf)
     # print(product_geo.overlap) # show the fractional overlap for each index
 
-    # work out the max overlap and return the index
-    max_index = product_geo.overlap.argmax() # get the integer location of the largest overlap value
-    print(max_index) 
-    
-    best_overlap = product_geo.index[max_index] # get the actual index (image name) with the largest overlap
-    print(product_geo.loc[best_overlap]) # show the metadata for the image with the largest overlap
-
-    api.download(best_overlap) # downloads the first result
-    
-    #uncomment this section only if you want to download the results for all matches
-    #api.download_all(products,
-                 #n_concurrent_dl=5, # allow up to 5 concurrent downloads
-                 #nodefilter=make_path_filter("*_B*.jp2")) # only down the image bands (optional)
-    
\ No newline at end of file
+    # choose the image with the largest overlap, or the fewest images that cover the coverage fraction, preferring less cloud and
+    # more recent images where the overlaps are the same
+    selected = scene_selection.select_scenes(product_geo, outline_gdf, target=coverage or 1,
+                                             max_scenes=None if coverage else 1)
+    print(selected[['title', 'overlap', 'gain', 'coverage', 'cloudcoverpercentage', 'beginposition']]) # show the metadata of the chosen images
+
+    if offline: # report the chosen images already on disk
+        on_disk = selected['path'].notna()
+        downloaded = {product_id: {'id': product_id, 'title': row['title'], 'path': row['path']} for product_id, row in selected[on_disk].iterrows()}
+        failed = {product_id: {'id': product_id, 'title': row['title'], 'error': 'not downloaded (offline)'} for product_id, row in selected[~on_disk].iterrows()}
+        return downloaded, failed
+
+    # download the chosen images, and all matches if asked, over one pooled connection with resume and checksum checks
+    to_download = product_downloader.sentinel_products(api, selected.index)
+    if download_all:
+        nodefilter = None if band_pattern is None else product_downloader.make_path_filter(band_pattern) # only download the image bands (optional)
+        to_download += product_downloader.sentinel_products(api, [product for product in product_geo.index if product not in selected.index], nodefilter)
+    downloaded, failed = product_downloader.download_products(to_download, directory, concurrency=5, auth=api.session.auth) # allow up to 5 concurrent downloads
+    scene_catalog.record_downloads(downloaded) # remember where the images are, for offline use
+    return downloaded, failed
@@ -4,10 +4,14 @@ import geopandas as gpd
 import matplotlib.pyplot as plt
 import cartopy.crs as ccrs
 import folium
+import data_loader
+import pcc_store
+import compact_map
 
 def read_water_resource_zones(water_areas_file):
     """
-    Read water resource zones shapefile and remove unnecessary columns.
+    Read water resource zones shapefile and remove unnecessary columns. The shapefile is only parsed once; later reads come from the
+    GeoParquet cache of data_loader.
 
     Input:
         water_areas_file (str): The file path of the water areas shapefile.
@@ -15,29 +19,23 @@ def read_water_resource_zones(water_areas_file):
     Output:
         gpd.GeoDataFrame: The geodataframe containing water resource zone data.
     """
-    wrz = gpd.read_file(os.path.abspath(water_areas_file))
-    columns_to_remove = ['Disclaimer', 'Disclaim2', 'Disclaim3', 'Provenance', 'Licence', 'WARNINGS', 'Revisions']
-    wrz = wrz.drop(columns=columns_to_remove)
+    wrz = data_loader.read_water_supply_areas(water_areas_file)
     return wrz
 
 def merge_pcc_data(wrz, history_file, pcc_period):
     """
-    Merge per capita consumption (PCC) data with water resource zones based on company identifiers.
+    Merge per capita consumption (PCC) data with water resource zones based on company identifiers. The history file is read once
+    by pcc_store and the PCC is joined on the Acronym of each row, so any number of periods can be merged without reading it again.
 
     Input:
         water_resource_zones (gpd.GeoDataFrame): The geodataframe containing water resource zone data.
         history_file (str): The file path of the history file.
-        pcc_period (str): The specific time period for which the PCC data is being visualized.
+        pcc_period (str or list of str): The specific time period(s) for which the PCC data is being visualized.
 
     Output:
-        gpd.GeoDataFrame: The geodataframe with merged PCC data.
+        gpd.GeoDataFrame: The geodataframe with merged PCC data, one column per period.
     """
-    pcc_data = pd.read_csv(history_file)
-    merged_data = wrz.merge(pcc_data[['Company', pcc_period]], how='left', left_on='Acronym', right_on='Company')
-    merged_data.drop(['Company'], axis=1, inplace=True)
-    merged_data.rename(columns={pcc_period: f'{pcc_period}_from_CSV'}, inplace=True)
-    wrz[f'{pcc_period}'] = merged_data[f'{pcc_period}_from_CSV']
-    return wrz
+    return pcc_store.join_pcc(wrz, pcc_period, history_file)
 
 def plot_chloropleth_map(wrz, pcc_period):
     """
@@ -69,7 +67,7 @@ def plot_chloropleth_map(wrz, pcc_period):
         
     plt.show()
     
-def plot_folium_map(wrz, history_file, pcc_period):
+def plot_folium_map(wrz, history_file, pcc_period, compact=False, tolerances=compact_map.default_tolerances):
     """
     Create a Folium map displaying the per capita consumption (PCC) data on a geographic map.
 
@@ -77,11 +75,17 @@ def plot_folium_map(wrz, history_file, pcc_period):
         water_resource_zones (gpd.GeoDataFrame): The geodataframe containing water resource zone data.
         history_file (str): The file path of the history file.
         pcc_period (str): The specific time period for which the PCC data is being visualized.
+        compact (bool): Whether to embed the areas as simplified, quantised TopoJSON with shared borders stored once (see
+            compact_map), which makes the HTML many times smaller, instead of the full resolution GeoJSON.
+        tolerances (list of float): The simplification tolerances in metres of the compact map, one layer each.
 
     Returns:
         folium.Map: The Folium map object displaying the PCC data.
 
     """
+    if compact:
+        return compact_map.compact_folium_map(wrz, pcc_period, tolerances, caption='PCC Period Selected')
+
      # Create a Folium map using the existing GeoDataFrame
     m = folium.Map()
 
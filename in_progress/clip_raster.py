@@ -1,79 +1,174 @@
-import rasterio
-from rasterio.mask import mask
+import os
+import re
+import time
+import argparse
+import multiprocessing
+from concurrent.futures import ProcessPoolExecutor
+import numpy as np
+import shapely
 import geopandas as gpd
-import matplotlib.pyplot as plt
 import rasterio
-from rasterio.warp import calculate_default_transform, reproject, Resampling
-# Define the paths to the image and shapefile
-image_path = 'data_files/R10m/T30UWB_20230121T111351.tif'
-shapefile_path = 'data_files/WaterSupplyAreas_incNAVs v1_4.shp'
-reprojected_image ='data_files/R10m/T30UWB_20230121_reproj.tif'
-output_path ='data_files/R10m/T30UWB_20230121_cropped.tif'
-# Define the attribute and value to select the desired area
-attribute_field = 'AreaServed'
-attribute_value = 'Bournemouth'
-
-# Read the shapefile using geopandas
-gdf = gpd.read_file(shapefile_path)
-
-# Filter the shapefile to select the desired area
-filtered_gdf = gdf[gdf[attribute_field] == attribute_value]
-# Read the shapefile and raster image
-gdf = gpd.read_file(shapefile_path)
-with rasterio.open(image_path) as src:
-    pass  # We only need to open the raster to access its CRS
-# Check the coordinate reference systems (CRS)
-print("Shapefile CRS:", gdf.crs)
-print("Raster CRS:", src.crs)
-# Open the raster image
-with rasterio.open(image_path) as src:
-    # Define the target CRS
-    target_crs = 'EPSG:27700'
-
-    # Calculate the transformation parameters for reprojection
-    transform, width, height = calculate_default_transform(
-        src.crs, target_crs, src.width, src.height, *src.bounds
-    )
-
-    # Create the reprojected image
-    reprojected_image_path = reprojected_image
-    reprojected_image_meta = src.meta.copy()
-    reprojected_image_meta.update({
-        'crs': target_crs,
-        'transform': transform,
-        'width': width,
-        'height': height
-    })
-
-    with rasterio.open(reprojected_image_path, 'w', **reprojected_image_meta) as dst:
-        for i in range(1, src.count + 1):
-            reproject(
-                source=rasterio.band(src, i),
-                destination=rasterio.band(dst, i),
-                src_transform=src.transform,
-                src_crs=src.crs,
-                dst_transform=transform,
-                dst_crs=target_crs,
-                resampling=Resampling.nearest
-            )
-# Read the raster image
-with rasterio.open(reprojected_image) as src:
-    # Crop the image using the shapefile
-    cropped_image, cropped_transform = mask(src, filtered_gdf.geometry, crop=True)
-    cropped_meta = src.meta.copy()
-
-# Update the metadata of the cropped image
-cropped_meta.update({
-    "height": cropped_image.shape[1],
-    "width": cropped_image.shape[2],
-    "transform": cropped_transform
-})
-# Save the cropped image
-
-with rasterio.open(output_path, 'w', **cropped_meta) as dest:
-    dest.write(cropped_image)
-
-# Display the cropped image (optional)
-plt.imshow(cropped_image[0, :, :])  # Assuming the image is single-band
-plt.axis('off')
-plt.show()
\ No newline at end of file
+from affine import Affine
+from rasterio.enums import Resampling
+from rasterio.features import geometry_mask
+from rasterio.vrt import WarpedVRT
+from rasterio.warp import calculate_default_transform, transform_bounds
+from rasterio.windows import Window
+import data_loader
+
+"""
+This module clips a satellite image (such as a Sentinel-2 tile in UTM) to the water supply areas it covers, reprojected to the British
+National Grid (EPSG:27700), writing one cropped GeoTIFF per area. Only the part of the image under each area is read and warped,
+instead of reprojecting the whole tile to disk first and masking it afterwards.
+
+1. Load the areas once, dissolved by AreaServed (or COMPANY) through data_loader, and keep those that intersect the image.
+2. For each area, work out the output grid: the bounds of the area, cut to the bounds of the image in the target CRS and snapped to
+   the pixel size of the image reprojected to that CRS (so the outputs of neighbouring areas line up).
+3. Read the image through a WarpedVRT with that grid. GDAL then only reads the source window under the area, and reprojects it as it
+   is read. The VRT is read and written in windows, and the pixels outside the area are set to nodata.
+4. Spread the areas over a pool of worker processes. Each worker opens the image once and clips all the areas it is given.
+
+From the command line, for example for the Bournemouth area of a Sentinel-2 tile:
+
+    python -m in_progress.clip_raster data_files/R10m/T30UWB_20230121T111351.tif --areas Bournemouth --output data_files/R10m
+"""
+
+target_crs = 'EPSG:27700'
+window_size = 1024   # Rows and columns read, masked and written at a time
+
+_source = None   # The image opened by a worker process, see _start_worker
+_options = None   # The clip options of a worker process
+
+def clip_to_areas(image_path, areas=None, output_dir=None, by='AreaServed', dst_crs=target_crs, resolution=None,
+                  resampling=Resampling.nearest, processes=None, water_areas_file=data_loader.water_supply_areas_file):
+    """
+    Clip an image to each water supply area it covers, reprojected, with one cropped GeoTIFF per area.
+
+    Inputs:
+        image_path (str): The file path of the image, such as a GeoTIFF of Sentinel-2 bands from in_progress/stack_bands.py.
+        areas (list of str or gpd.GeoDataFrame): The names of the areas to clip to (values of the by column), or a GeoDataFrame of
+            areas, one per row, indexed by name. Defaults to all the areas that intersect the image.
+        output_dir (str): The directory of the output files (created if needed). Defaults to the directory of the image.
+        by (str): The column of the water supply areas to dissolve by, AreaServed or COMPANY.
+        dst_crs: The CRS of the output files.
+        resolution (float): The pixel size of the output files, in the units of dst_crs. Defaults to the pixel size of the image in
+            dst_crs.
+        resampling (Resampling): The resampling method of the reprojection.
+        processes (int): The number of worker processes. Defaults to the number of cores (at most one per area).
+        water_areas_file (str): The file path of the water supply areas shapefile.
+
+    Output:
+        dict: The file path of the cropped GeoTIFF of each area, by area name. Areas that do not intersect the image are left out.
+    """
+    start = time.perf_counter()
+    if areas is None or not isinstance(areas, gpd.GeoDataFrame):
+        companies = data_loader.read_companies(water_areas_file, by=by, columns=[])
+        areas = companies if areas is None else companies.loc[list(areas)]
+    areas = areas.to_crs(dst_crs)
+    output_dir = os.path.dirname(os.path.abspath(image_path)) if output_dir is None else output_dir
+    os.makedirs(output_dir, exist_ok=True)
+
+    with rasterio.open(image_path) as src:
+        tile_bounds = transform_bounds(src.crs, dst_crs, *src.bounds, densify_pts=21)
+        if resolution is None:
+            transform, _, _ = calculate_default_transform(src.crs, dst_crs, src.width, src.height, *src.bounds)
+            resolution = transform.a
+    footprint = shapely.box(*tile_bounds)
+    areas = areas[shapely.intersects(areas.geometry.to_numpy(), footprint)]
+
+    stem = os.path.splitext(os.path.basename(image_path))[0]
+    names = [str(name) for name in areas.index]
+    output_files = [os.path.join(output_dir, f"{stem}_{re.sub(r'[^A-Za-z0-9_-]+', '_', name)}.tif") for name in names]
+    geometries = list(areas.geometry.to_numpy())
+    initargs = (image_path, dst_crs, tile_bounds, resolution, resampling)
+    processes = min(processes or os.cpu_count() or 1, len(names)) or 1
+    if processes == 1:
+        _start_worker(*initargs)
+        results = list(map(_clip_area, geometries, output_files))
+        _source.close()
+    else:
+        # spawn gives each worker a fresh interpreter, so that no GDAL handles are shared with this process
+        context = multiprocessing.get_context('spawn')
+        with ProcessPoolExecutor(max_workers=processes, mp_context=context, initializer=_start_worker, initargs=initargs) as pool:
+            results = list(pool.map(_clip_area, geometries, output_files))
+    print(f'Clipped {image_path} to {len(names)} area(s) in {time.perf_counter() - start:.2f} s')
+    return {name: output_file for name, output_file in zip(names, results) if output_file is not None}
+
+def clip_to_geometry(src, geometry, output_file, dst_crs=target_crs, resolution=None, resampling=Resampling.nearest, tile_bounds=None):
+    """
+    Clip an open image to one area, reprojected, reading only the part of the image under the area.
+
+    Inputs:
+        src (rasterio.DatasetReader): The open image.
+        geometry (shapely geometry): The area, in dst_crs.
+        output_file (str): The file path of the cropped GeoTIFF.
+        dst_crs: The CRS of the output file.
+        resolution (float): The pixel size of the output file, in the units of dst_crs. Defaults to the pixel size of the image in
+            dst_crs.
+        resampling (Resampling): The resampling method of the reprojection.
+        tile_bounds (tuple of float): The bounds of the image in dst_crs, if already known.
+
+    Output:
+        str: The file path of the cropped GeoTIFF, or None if the area does not intersect the image.
+    """
+    if tile_bounds is None:
+        tile_bounds = transform_bounds(src.crs, dst_crs, *src.bounds, densify_pts=21)
+    if resolution is None:
+        transform, _, _ = calculate_default_transform(src.crs, dst_crs, src.width, src.height, *src.bounds)
+        resolution = transform.a
+
+    # Output grid: the bounds of the area within the image, snapped outwards to whole pixels
+    minx, miny, maxx, maxy = shapely.bounds(shapely.intersection(geometry, shapely.box(*tile_bounds)))
+    if not minx < maxx or not miny < maxy:
+        return None
+    minx, miny = np.floor(minx / resolution) * resolution, np.floor(miny / resolution) * resolution
+    maxx, maxy = np.ceil(maxx / resolution) * resolution, np.ceil(maxy / resolution) * resolution
+    width, height = int(round((maxx - minx) / resolution)), int(round((maxy - miny) / resolution))
+    transform = Affine(resolution, 0, minx, 0, -resolution, maxy)
+    nodata = src.nodata if src.nodata is not None else 0
+
+    profile = dict(src.profile, driver='GTiff', crs=dst_crs, transform=transform, width=width, height=height, nodata=nodata,
+                   compress='deflate', tiled=True, blockxsize=256, blockysize=256)
+    profile.pop('photometric', None)
+    shapely.prepare(geometry)
+    with WarpedVRT(src, crs=dst_crs, transform=transform, width=width, height=height, resampling=resampling, nodata=nodata) as vrt, \
+         rasterio.open(output_file, 'w', **profile) as dst:
+        for row in range(0, height, window_size):
+            for column in range(0, width, window_size):
+                window = Window(column, row, min(window_size, width - column), min(window_size, height - row))
+                data = vrt.read(window=window)
+                outside = geometry_mask([geometry], out_shape=data.shape[1:], transform=vrt.window_transform(window))
+                data[:, outside] = nodata
+                dst.write(data, window=window)
+    return output_file
+
+def _start_worker(image_path, dst_crs, tile_bounds, resolution, resampling):
+    # Runs once in each worker process: open the image for all the areas the worker clips
+    global _source, _options
+    _source = rasterio.open(image_path)
+    _options = dict(dst_crs=dst_crs, resolution=resolution, resampling=resampling, tile_bounds=tile_bounds)
+
+def _clip_area(geometry, output_file):
+    # Runs in a worker process: clip the open image to one area
+    output_file = clip_to_geometry(_source, geometry, output_file, **_options)
+    if output_file is not None:
+        print('Written', output_file)
+    return output_file
+
+if __name__ == '__main__':
+    parser = argparse.ArgumentParser(description='Clip an image to the water supply areas it covers, reprojected to EPSG:27700.')
+    parser.add_argument('image', help='file path of the image, such as a Sentinel-2 GeoTIFF')
+    parser.add_argument('--areas', nargs='+', default=None, help='names of the areas to clip to (default all areas in the image)')
+    parser.add_argument('--by', default='AreaServed', help='column of the water supply areas to dissolve by, AreaServed or COMPANY')
+    parser.add_argument('--output', default=None, help='directory of the cropped GeoTIFFs (default the directory of the image)')
+    parser.add_argument('--processes', type=int, default=None, help='number of worker processes')
+    args = parser.parse_args()
+    output_files = clip_to_areas(args.image, args.areas, args.output, args.by, processes=args.processes)
+
+    # Display the first cropped image (optional)
+    if output_files:
+        import matplotlib.pyplot as plt
+        with rasterio.open(next(iter(output_files.values()))) as src:
+            plt.imshow(src.read(1, masked=True))
+        plt.axis('off')
+        plt.show()
@@ -1,4 +1,4 @@
-"""this module creates a standard chloropleth map using a Seaborn colour palette. Inputs are data field = the data colum to map; data_file = the geodataframe data source and title = the figure capture to include in the map. The map is created using TransverseMNercator (27700) and changes the crs of the gdf to that of the outline to ensure they are the same."""
+"""this module creates a standard chloropleth map using a Seaborn colour palette. Inputs are data field = the data colum to map; data_file = the geodataframe data source and title = the figure capture to include in the map. The map is created using TransverseMNercator (27700) and changes the crs of the gdf to that of the outline to ensure they are the same. Maps are cached by render_cache, so drawing the same data with the same title again shows the stored image."""
 
 import os
 import pandas as pd
@@ -8,29 +8,36 @@ import cartopy.crs as ccrs
 import matplotlib.patches as mpatches
 import matplotlib.lines as mlines
 import matplotlib.pyplot as plt
+import data_loader
+import render_cache
 
-def create_chloropleth(data_field,data_file,title):
+outline_file = 'data_files/Outline.shp'
 
-    outline = gpd.read_file(os.path.abspath('data_files/Outline.shp')) # load the outline of UK for a backdrop
-    gdf = data_file # Load data as gdf
-    myFig = plt.figure(figsize=(10, 10))  # create a figure of size 10x10 (representing the page size in inches)
-    myCRS = ccrs.TransverseMercator(27700)  # create a Universal Transverse Mercator reference system to transform our data.
-    gdf = gdf.to_crs(outline.crs) # changes the gdf to the same crs as the outline
-    # print(gdf.crs == outline.crs) # test if the crs is the same, this is commented out but can be uncommented if required
-    gdf.plot(column=data_field, cmap='viridis', linewidth=0.8, edgecolor='black', legend=True, figsize=(10, 10))     # Create the chloropleth map
-    plt.suptitle(title, y=0.1, fontsize=14)     # Set plot title at the bottom of the map 
-    # Add a border around the map
-    for spine in plt.gca().spines.values():
-        spine.set_visible(True)
-        spine.set_color('black')
-        spine.set_linewidth(1) 
-    # Set plot title and axis labels
-    plt.xlabel('Longitude')
-    plt.ylabel('Latitude')
-    # Adjust the spacing between the title and the axis labels
-    plt.subplots_adjust(bottom=0.175)
-    
+def create_chloropleth(data_field,data_file,title,figsize=(10, 10),dpi=100,cache_dir=render_cache.render_cache_dir):
+
+    # The map is kept in a render cache keyed by the data, data field, title and image size (see render_cache), so a repeated call
+    # shows the stored image rather than projecting and plotting the polygons again
+    outline_crs = data_loader.read_layer(outline_file, columns=[]).crs # load the outline of UK (through the GeoParquet cache) for its crs
+    key = render_cache.render_key(data_file, data_field, plot='create_chloropleth', crs=outline_crs.to_wkt(), title=title, cmap='viridis',
+                                  figsize=figsize, dpi=dpi)
+
+    def draw():
+        gdf = render_cache.projected(data_file, outline_crs) # changes the gdf to the same crs as the outline, reused across calls
+        gdf.plot(column=data_field, cmap='viridis', linewidth=0.8, edgecolor='black', legend=True, figsize=figsize)     # Create the chloropleth map
+        plt.suptitle(title, y=0.1, fontsize=14)     # Set plot title at the bottom of the map 
+        # Add a border around the map
+        for spine in plt.gca().spines.values():
+            spine.set_visible(True)
+            spine.set_color('black')
+            spine.set_linewidth(1) 
+        # Set plot title and axis labels
+        plt.xlabel('Longitude')
+        plt.ylabel('Latitude')
+        # Adjust the spacing between the title and the axis labels
+        plt.subplots_adjust(bottom=0.175)
+        return plt.gcf()
+
+    render_cache.cached_figure(key, draw, dpi, cache_dir)
     return plt # Show the plot
     # Save the plot as a JPEG file
     # plt.savefig('data_files/img_chloropleth.jpg', dpi=300)
-    
\ No newline at end of file
@@ -2,22 +2,17 @@ def merge_csv_to_wrz(csv_file_path, column_name):
     import pandas as pd
     import geopandas as gpd
     import os
+    import data_loader
+    import pcc_store
 
-    # Load the CSV file
-    pr24_hist_pcc = pd.read_csv(csv_file_path)
-    wrz = gpd.read_file(os.path.abspath('data_files/WaterSupplyAreas_incNAVs v1_4.shp'))
+    wrz = data_loader.read_water_supply_areas()
 
-    # Perform the merge
-    merged = wrz.merge(pr24_hist_pcc[['Company', column_name]], how='left', left_on='Acronym', right_on='Company')
-
-    # Drop the 'Acronym' and 'Company' columns from merged
-    merged.drop(['Acronym', 'Company'], axis=1, inplace=True)
+    # Join the column on the Acronym of each area - the CSV file is only read once by pcc_store
+    merged = pcc_store.join_pcc(wrz, column_name, csv_file_path)
 
     # Rename the merged column
-    merged.rename(columns={column_name: f'{column_name}_from_CSV'}, inplace=True)
-
-    # Assign the merged column back to the wrz GeoDataFrame
-    wrz[f'{column_name}_from_CSV'] = merged[f'{column_name}_from_CSV']
+    wrz = merged.rename(columns={column_name: f'{column_name}_from_CSV'})
+    return wrz
 
  
 
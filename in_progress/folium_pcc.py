@@ -2,6 +2,8 @@ import os
 import pandas as pd
 import geopandas as gpd
 import folium
+import data_loader
+import pcc_store
 
 def folium_pcc_map(): 
 
@@ -16,27 +18,10 @@ def folium_pcc_map():
     """
 
     # Load water company data as wrz, remove unnecessary columns
-    wrz = gpd.read_file(os.path.abspath('data_files/WaterSupplyAreas_incNAVs v1_4.shp'))
+    wrz = data_loader.read_water_supply_areas()
 
-    # List of columns to be removed
-    columns_to_remove = ['Disclaimer', 'Disclaim2', 'Disclaim3', 'Provenance', 'Licence', 'WARNINGS', 'Revisions']
-
-    # Drop the columns from the GeoDataFrame
-    wrz = wrz.drop(columns=columns_to_remove)
-
-    # Append PCC for 2019 to 2020 to the wrz geodataframe
-    # Load the CSV file
-    pr24_hist_pcc = pd.read_csv('data_files/pr24_hist_pcc.csv')
-
-    # Perform the merge
-    merged = wrz.merge(pr24_hist_pcc[['Company', '2019-20']], how='left', left_on='Acronym', right_on='Company')
-
-    # Drop the unnecessary columns & rename the merged column
-    merged.drop(['Company'], axis=1, inplace=True)
-    merged.rename(columns={'2019-20': '2019-20_from_CSV'}, inplace=True)
-
-    # Update the wrz GeoDataFrame with the merged column
-    wrz['2019-20'] = merged['2019-20_from_CSV']
+    # Append PCC for 2019 to 2020 to the wrz geodataframe, joined on the Acronym of each area
+    wrz = pcc_store.join_pcc(wrz, '2019-20', 'data_files/pr24_hist_pcc.csv')
 
     # Create a Folium map using the existing GeoDataFrame
     m = folium.Map()
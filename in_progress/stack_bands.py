@@ -1,7 +1,15 @@
 import rasterio
 import numpy as np
 
-def stacking_bands_3:
+def stacking_bands_3(band_files, output_tiff, output_jpg):
+    """
+    Stacks single band rasters into one multi-band GeoTIFF, which can be passed to find_PCAKmeans, and saves an 8-bit JPEG copy.
+
+    Inputs:
+        band_files (list of str): The file paths of the band rasters, in band order. They must share a grid.
+        output_tiff (str): The file path of the stacked GeoTIFF.
+        output_jpg (str): The file path of the JPEG copy.
+    """
 
     # Create an empty array to store the band data
     stacked_data = []
@@ -10,13 +10,18 @@ import matplotlib.lines as mlines
 import folium
 import scipy
 import seaborn as sns
+import compact_map
 
 
-def folium_map(data_field,data_file): 
+def folium_map(data_field,data_file,compact=False): 
     
     # Load water company data as wrz, remove unnecessary columns
     gdf = data_file
 
+    # Simplified TopoJSON layers with shared borders stored once, for a much smaller HTML file
+    if compact:
+        return compact_map.compact_folium_map(gdf, data_field, caption='landuse')
+
     # Create a Folium map using the existing GeoDataFrame
     m = folium.Map()
 
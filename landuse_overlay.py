@@ -0,0 +1,134 @@
+import os
+import time
+from concurrent.futures import ThreadPoolExecutor
+import numpy as np
+import pandas as pd
+import shapely
+import geopandas as gpd
+
+"""
+This module finds how much of each land use class (for example the CORINE land cover in clc2018_uk.shp) lies inside each water company
+area, counting only the part of each land use polygon that is inside the company, so that a polygon straddling two companies is
+split between them rather than counted in full in both.
+
+1. Build an STRtree of the land use polygons once, and find the candidate polygons of each company from the tree (bounding boxes
+   that overlap the company).
+2. Split the candidates of each company into interior polygons, which lie wholly inside the company and count with their full area,
+   and boundary polygons, which cross the company boundary. Only the boundary polygons need a true intersection.
+3. Cut each company into pieces of at most max_vertices vertices, so that each boundary polygon is only intersected with the few small
+   pieces it overlaps rather than with the whole (often very detailed) company outline. The pieces do not overlap, so their
+   intersection areas add up to the intersection with the whole company.
+4. Sum the areas by land use class into a company x class matrix, in hectares. The land use can be given in chunks (for example from
+   data_loader.iter_corine), which are overlaid one at a time and their matrices added up, so that only one chunk is held in memory.
+5. Optionally turn the matrix into a table with one row per company and class, with the class labels from the CORINE legend and
+   the company centroid as its geometry, joined by key rather than searched for row by row.
+
+The companies are processed in parallel threads. The shapely operations used release the GIL, so threads run them in parallel without
+copying the land use layer to other processes.
+"""
+
+def landuse_area_matrix(companies, landuse, company_column='COMPANY', class_column='LABEL', threads=None, max_vertices=256):
+    """
+    Find the area of each land use class inside each company, clipping the land use polygons to the company boundaries.
+
+    Inputs:
+        companies (gpd.GeoDataFrame): The company areas, one or more rows per company (rows of the same company are combined).
+        landuse (gpd.GeoDataFrame or iterable of gpd.GeoDataFrame): The land use polygons, with a class column, or chunks of them. They
+            are reprojected to the CRS of the companies if needed.
+        company_column (str): The column of companies that names the company.
+        class_column (str): The column of landuse that names the land use class, for example LABEL or CODE_18.
+        threads (int): The number of threads. Defaults to the number of cores.
+        max_vertices (int): The largest number of vertices in a piece of a company outline, see the module docstring.
+
+    Output:
+        pd.DataFrame: The area in hectares of each land use class (columns) inside each company (rows). Areas are in the units of the
+        company CRS squared divided by 10,000, so the CRS should be projected in metres, such as EPSG:27700.
+    """
+    start = time.perf_counter()
+    company_geometries = companies.geometry.groupby(companies[company_column]).agg(shapely.union_all)
+    chunks = [landuse] if isinstance(landuse, pd.DataFrame) else landuse
+    matrix = pd.DataFrame(index=company_geometries.index, dtype=float)
+    n_polygons = 0
+
+    with ThreadPoolExecutor(max_workers=threads or os.cpu_count() or 1) as pool:
+        # The companies are cut into pieces once and reused for every chunk
+        geometries = company_geometries.to_numpy()
+        shapely.prepare(geometries)
+        pieces = list(pool.map(lambda geometry: _subdivide(geometry, max_vertices), geometries))
+        for chunk in chunks:
+            if chunk.crs is not None and companies.crs is not None and chunk.crs != companies.crs:
+                chunk = chunk.to_crs(companies.crs)
+            classes, class_index = np.unique(chunk[class_column].astype(str).to_numpy(), return_inverse=True)
+            polygons = chunk.geometry.to_numpy()
+            polygon_areas = shapely.area(polygons)
+            tree = shapely.STRtree(polygons)
+            rows = list(pool.map(lambda company, company_pieces: _company_areas(company, company_pieces, tree, polygons, polygon_areas,
+                                                                               class_index, len(classes)), geometries, pieces))
+            areas = pd.DataFrame(np.vstack(rows) / 10000 if rows else np.zeros((0, len(classes))), index=matrix.index, columns=classes)
+            matrix = matrix.add(areas, fill_value=0)
+            n_polygons += len(polygons)
+
+    matrix = matrix.sort_index(axis=1).fillna(0)
+    matrix.columns.name = class_column
+    print(f'{n_polygons} land use polygons overlaid on {len(matrix)} companies in {time.perf_counter() - start:.2f} s')
+    return matrix
+
+def company_landuse_table(landuse_areas, companies, legend=None):
+    """
+    Turn a company x class area matrix into a table with one row per company and land use class, located at the company centroid.
+
+    Inputs:
+        landuse_areas (pd.DataFrame): The area matrix from landuse_area_matrix.
+        companies (gpd.GeoDataFrame): The companies from data_loader.read_companies, indexed by company with the columns centroid_x
+            and centroid_y.
+        legend (pd.DataFrame): The CORINE legend from data_loader.read_corine_legend, indexed by code, to add LABEL, level1 and urban
+            to each row when the matrix columns are CORINE codes.
+
+    Output:
+        gpd.GeoDataFrame: The columns COMPANY (or the name of the matrix index), the class column, Area_Ha and the legend columns,
+        with point geometries at the company centroids. Classes with no area in a company are left out.
+    """
+    company_column = landuse_areas.index.name or 'COMPANY'
+    class_column = landuse_areas.columns.name or 'CLASS'
+    table = landuse_areas.rename_axis(index=company_column, columns=class_column).stack().rename('Area_Ha').reset_index()
+    table = table[table['Area_Ha'] > 0]
+    if legend is not None:
+        table = table.join(legend, on=class_column)
+    centroids = companies[['centroid_x', 'centroid_y']].reindex(table[company_column].to_numpy())
+    geometry = gpd.points_from_xy(centroids['centroid_x'], centroids['centroid_y'])
+    return gpd.GeoDataFrame(table.reset_index(drop=True), geometry=geometry, crs=companies.crs)
+
+def _company_areas(company, pieces, tree, polygons, polygon_areas, class_index, n_classes):
+    # Area of each land use class inside one (prepared) company, cut into pieces by _subdivide. The STRtree is shared by all threads;
+    # querying it does not change it
+    candidates = tree.query(company)
+    interior = shapely.contains_properly(company, polygons[candidates])
+    areas = np.zeros(n_classes)   # np.bincount of an empty selection is int64, which the float areas cannot be added to
+    areas += np.bincount(class_index[candidates[interior]], weights=polygon_areas[candidates[interior]], minlength=n_classes)
+
+    boundary = candidates[~interior]
+    boundary_index, piece_index = shapely.STRtree(pieces).query(polygons[boundary], predicate='intersects')
+    clipped = shapely.area(shapely.intersection(polygons[boundary[boundary_index]], pieces[piece_index]))
+    areas += np.bincount(class_index[boundary[boundary_index]], weights=clipped, minlength=n_classes)
+    return areas
+
+def _subdivide(geometry, max_vertices):
+    # Cut a geometry into non-overlapping pieces of at most max_vertices vertices, halving the bounding box of each piece along its
+    # longer side until the pieces are small enough (or after 32 halvings, for pieces with many vertices in a tiny area)
+    done = []
+    pieces = shapely.get_parts(np.asarray([geometry]))
+    for _ in range(32):
+        small = shapely.get_num_coordinates(pieces) <= max_vertices
+        done.append(pieces[small])
+        pieces = pieces[~small]
+        if not len(pieces):
+            break
+        xmin, ymin, xmax, ymax = shapely.bounds(pieces).T
+        wide = xmax - xmin >= ymax - ymin
+        xmid, ymid = (xmin + xmax) / 2, (ymin + ymax) / 2
+        first = shapely.box(xmin, ymin, np.where(wide, xmid, xmax), np.where(wide, ymax, ymid))
+        second = shapely.box(np.where(wide, xmid, xmin), np.where(wide, ymin, ymid), xmax, ymax)
+        halves = np.concatenate([shapely.intersection(pieces, first), shapely.intersection(pieces, second)])
+        halves = shapely.get_parts(halves[~shapely.is_empty(halves)])
+        pieces = halves[shapely.get_type_id(halves) == shapely.GeometryType.POLYGON]   # Drop lines and points left on the cut lines
+    return np.concatenate(done + [pieces])
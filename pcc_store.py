@@ -0,0 +1,135 @@
+import os
+import pandas as pd
+
+"""
+This module is the shared store of the per capita consumption (PCC) history in pr24_hist_pcc.csv, so that the history is read once
+rather than on every merge, and can be joined onto the water companies by acronym for any number of periods at once.
+
+1. On the first request, read the history file and keep the rows of one PR24 PC reference (PR24_PCC.2, the whole company; some
+   companies have further rows for parts of their area), so that each company has one value per period.
+2. Reshape it into a long table with one row per company and period, indexed by (Acronym, period), with the PCC as float64 and the
+   periods as an ordered categorical, and into a wide table with one column per period.
+3. Keep both tables in memory, keyed by the file path, size and modification time of the history file, so that later requests do not
+   read the file again unless it has changed.
+4. Answer period requests from the wide table (one column lookup) and join periods onto company GeoDataFrames by their Acronym column,
+   so that the result does not depend on the order of the rows.
+"""
+
+history_file = 'data_files/pr24_hist_pcc.csv'
+pcc_reference = 'PR24_PCC.2'
+
+_histories = {}   # The long and wide tables of each history file read so far, keyed by file, size, modification time and reference
+
+def read_pcc_history(history_file=history_file, reference=pcc_reference):
+    """
+    Read the PCC history as a long table.
+
+    Inputs:
+        history_file (str): The file path of the history CSV file, with the columns Company (the acronym), PR24 PC reference and one
+            column per period, such as 2019-20.
+        reference (str): The PR24 PC reference of the rows to use.
+
+    Output:
+        pd.DataFrame: A copy of the history, indexed by (Acronym, period) and sorted, with the column pcc (litres per head per day).
+        Periods without a value are left out.
+    """
+    return _history(history_file, reference)[0].copy()
+
+def pcc_periods(history_file=history_file, reference=pcc_reference):
+    """
+    List the periods of the PCC history.
+
+    Inputs:
+        history_file (str): The file path of the history CSV file.
+        reference (str): The PR24 PC reference of the rows to use.
+
+    Output:
+        list of str: The periods in order, such as ['2011-12', ..., '2021-22'].
+    """
+    return list(_history(history_file, reference)[1].columns)
+
+def pcc_by_period(history_file=history_file, reference=pcc_reference):
+    """
+    Get the PCC history as a wide table with one column per period.
+
+    Inputs:
+        history_file (str): The file path of the history CSV file.
+        reference (str): The PR24 PC reference of the rows to use.
+
+    Output:
+        pd.DataFrame: A copy of the history, indexed by Acronym, with one float64 column per period. Missing values are NaN.
+    """
+    return _history(history_file, reference)[1].copy()
+
+def pcc_for_period(period, history_file=history_file, reference=pcc_reference):
+    """
+    Get the PCC of every company for one period.
+
+    Inputs:
+        period (str): The period, such as 2019-20.
+        history_file (str): The file path of the history CSV file.
+        reference (str): The PR24 PC reference of the rows to use.
+
+    Output:
+        pd.Series: The PCC of each company, indexed by Acronym and named after the period.
+    """
+    wide = _history(history_file, reference)[1]
+    if period not in wide.columns:
+        raise KeyError(f'{period} is not a period of {history_file}, the periods are {list(wide.columns)}')
+    return wide[period].copy()
+
+def join_pcc(companies, periods=None, history_file=history_file, reference=pcc_reference, on='Acronym'):
+    """
+    Join the PCC of one or more periods onto the water companies by their acronym.
+
+    Inputs:
+        companies (gpd.GeoDataFrame): The water companies or water supply areas, with an acronym column. Several rows may have the
+            same acronym, and the rows may be in any order.
+        periods (str or list of str): The period(s) to join, such as '2019-20'. Defaults to all periods.
+        history_file (str): The file path of the history CSV file.
+        reference (str): The PR24 PC reference of the rows to use.
+        on (str): The acronym column of companies.
+
+    Output:
+        gpd.GeoDataFrame: A copy of companies, in the same order and with the same index, with one column per period (NaN for
+        companies without a value). Existing columns with the same names are replaced.
+    """
+    wide = _history(history_file, reference)[1]
+    periods = list(wide.columns) if periods is None else [periods] if isinstance(periods, str) else list(periods)
+    missing = [period for period in periods if period not in wide.columns]
+    if missing:
+        raise KeyError(f'{missing} are not periods of {history_file}, the periods are {list(wide.columns)}')
+    return companies.drop(columns=periods, errors='ignore').join(wide[periods], on=on)
+
+def clear_cache():
+    """
+    Forget the PCC histories read so far, so that the next request reads the history file again.
+    """
+    _histories.clear()
+
+def _history(history_file, reference):
+    # The long and wide tables of a history file, read on the first request and whenever the file changes
+    history_file = os.path.abspath(history_file)
+    stat = os.stat(history_file)
+    key = (history_file, stat.st_size, stat.st_mtime_ns, reference)
+    if key not in _histories:
+        for old_key in [old_key for old_key in _histories if old_key[0] == history_file and old_key[3] == reference]:
+            del _histories[old_key]   # Read from an earlier version of the file
+        _histories[key] = _read_history(history_file, reference)
+    return _histories[key]
+
+def _read_history(history_file, reference):
+    # Read a history file into the long table indexed by (Acronym, period) and the wide table with one column per period
+    history = pd.read_csv(history_file, dtype={'Company': str, 'PR24 PC reference': str})
+    history = history[history['PR24 PC reference'] == reference]
+    if history['Company'].duplicated().any():
+        raise ValueError(f'{history_file} has more than one {reference} row for {sorted(history["Company"][history["Company"].duplicated()])}')
+    periods = [column for column in history.columns if column[:4].isdigit()]
+
+    wide = history.set_index('Company')[periods].apply(pd.to_numeric, errors='coerce').astype('float64').sort_index()
+    wide.index.name = 'Acronym'
+    wide.columns.name = 'period'
+
+    long = wide.stack().rename('pcc').to_frame()   # Leaves out missing values
+    long.index = long.index.set_levels(pd.CategoricalIndex(long.index.levels[1], categories=periods, ordered=True), level='period')
+    return long.sort_index(), wide
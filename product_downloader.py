@@ -0,0 +1,249 @@
+import os
+import random
+import asyncio
+import fnmatch
+import hashlib
+import threading
+import xml.etree.ElementTree as ET
+from concurrent.futures import ThreadPoolExecutor
+from urllib.parse import quote
+import requests
+
+"""
+This module downloads satellite products, such as Sentinel-2 products found with sentinelsat, several at a time, resuming partial
+downloads and checking each file against its MD5 checksum, instead of one api.download call after another.
+
+1. Describe each product as a dict with its id, title, url, size and md5 (see sentinel_products, which makes them from a SentinelAPI).
+   A product can instead list the files (nodes) inside its .SAFE directory, from its manifest, so that a node filter such as
+   make_path_filter('*_B*.jp2') downloads only the image bands.
+2. Download the files in parallel in a pool of `concurrency` threads. The event loop of asyncio schedules the downloads and their
+   retries; each runs its blocking HTTP request in a thread of the pool. requests sessions are not thread safe, so each thread keeps
+   its own session, whose connections stay open from one file to the next.
+3. Write each file under the name <file>.incomplete. If such a file is left by an earlier, interrupted run, ask the server for the
+   remaining bytes only (an HTTP range request) and append them. Servers that do not support range requests send the whole file.
+4. Check the size and the MD5 checksum of each finished file before renaming it to its final name. Files that already exist with the
+   right checksum are not downloaded again.
+5. Retry connection errors, timeouts, server errors (5xx and 429) and checksum mismatches with an exponential backoff, keeping the bytes
+   already downloaded unless the checksum was wrong.
+"""
+
+concurrency = 4   # Downloads at a time
+chunk_size = 2 ** 20   # Bytes read from the connection and written at a time
+max_retries = 5
+backoff = 1   # Seconds before the first retry, doubled for each further retry
+timeout = 60   # Seconds to wait for the server to connect or send data
+partial_suffix = '.incomplete'
+
+def make_path_filter(pattern, exclude=False):
+    """
+    Make a node filter that selects the files of a product by their path, like sentinelsat.make_path_filter, so that either can be
+    passed as the nodefilter of sentinel_products.
+
+    Inputs:
+        pattern (str): A Unix shell-style pattern for the path of the file within the product, such as '*_B*.jp2' for the image bands.
+            The match ignores case.
+        exclude (bool): True to select the files that do not match instead.
+
+    Output:
+        function: A filter that takes the dict of a node (with the key node_path, such as ./GRANULE/.../IMG_DATA/..._B02.jp2) and
+        returns True to download it.
+    """
+    pattern = pattern.lower()
+    def node_filter(node_info):
+        match = fnmatch.fnmatch(node_info['node_path'].lower(), pattern)
+        return match != exclude
+    return node_filter
+
+def sentinel_products(api, product_ids, nodefilter=None):
+    """
+    Describe Sentinel products for download_products, from their metadata on a sentinelsat API.
+
+    Inputs:
+        api (sentinelsat.SentinelAPI): The API the products were found with.
+        product_ids (iterable of str): The product ids (UUIDs), such as the keys of the dict returned by api.query.
+        nodefilter (function): A node filter, such as make_path_filter('*_B*.jp2'), to download only some files of each product into
+            its .SAFE directory. None to download each product as one zip file.
+
+    Output:
+        list of dict: One dict per product, see download_products.
+    """
+    products = []
+    for product_id in product_ids:
+        odata = api.get_product_odata(product_id)
+        product = {'id': product_id, 'title': odata['title'], 'url': odata['url'], 'size': odata.get('size'), 'md5': odata.get('md5')}
+        if nodefilter is not None:
+            product_url = odata['url'].rsplit('/$value', 1)[0]
+            safe_url = f"{product_url}/Nodes('{quote(odata['title'])}.SAFE')"
+            manifest = api.session.get(f"{safe_url}/Nodes('manifest.safe')/$value", timeout=timeout)
+            manifest.raise_for_status()
+            nodes = [{'node_path': './manifest.safe', 'url': f"{safe_url}/Nodes('manifest.safe')/$value", 'size': len(manifest.content),
+                      'md5': hashlib.md5(manifest.content).hexdigest()}]
+            product['nodes'] = [node for node in nodes + _manifest_nodes(manifest.content, safe_url) if nodefilter(node)]
+        products.append(product)
+    return products
+
+def download_products(products, directory='.', concurrency=concurrency, auth=None, max_retries=max_retries, backoff=backoff):
+    """
+    Download products in parallel, resuming partial downloads and checking their checksums. From a notebook, where an event loop is
+    already running, the downloads run in a separate thread; download_products_async can be awaited instead.
+
+    Inputs:
+        products (list of dict): The products, each with the keys id, title, and either url, size (bytes, or None if unknown) and md5
+            (or None to skip the check) to download the product as <title>.zip, or nodes, a list of dicts with the keys node_path, url,
+            size and md5, to download those files into <title>.SAFE.
+        directory (str): The directory to download into (created if needed).
+        concurrency (int): The largest number of files downloaded at a time.
+        auth: The authentication of the requests, such as a (user, password) tuple or api.session.auth of a sentinelsat API.
+        max_retries (int): The number of retries of a file after a connection error, timeout, server error or checksum mismatch.
+        backoff (float): The seconds to wait before the first retry, doubled for each further retry.
+
+    Outputs:
+        dict, dict: The products that were downloaded (or already were), by id, each with the added key path (the zip file or .SAFE
+        directory), and the products that failed, by id, each with the added key error.
+    """
+    coroutine = download_products_async(products, directory, concurrency, auth, max_retries, backoff)
+    try:
+        asyncio.get_running_loop()
+    except RuntimeError:
+        return asyncio.run(coroutine)
+    with ThreadPoolExecutor(max_workers=1) as pool:   # A loop is already running (as in Jupyter), so run a new one in another thread
+        return pool.submit(asyncio.run, coroutine).result()
+
+async def download_products_async(products, directory='.', concurrency=concurrency, auth=None, max_retries=max_retries, backoff=backoff):
+    """
+    Coroutine version of download_products, with the same inputs and outputs.
+    """
+    os.makedirs(directory, exist_ok=True)
+    local = threading.local()
+    sessions = []   # Every session made, to close them at the end
+
+    def thread_session():
+        # The session of the calling thread, made on its first download
+        if not hasattr(local, 'session'):
+            local.session = requests.Session()
+            local.session.auth = auth
+            sessions.append(local.session)
+        return local.session
+
+    # One download per file; the files of a product with nodes are downloaded in parallel as well
+    files, paths = [], {}
+    for product in products:
+        if 'nodes' in product:
+            paths[product['id']] = os.path.join(directory, product['title'] + '.SAFE')
+            files += [(product['id'], node, os.path.join(paths[product['id']], *_node_parts(node['node_path'])))
+                      for node in product['nodes']]
+        else:
+            paths[product['id']] = os.path.join(directory, product['title'] + '.zip')
+            files.append((product['id'], product, paths[product['id']]))
+    # A pool of its own rather than the default executor of the loop, which has at most min(32, cores + 4) threads
+    loop = asyncio.get_running_loop()
+    with ThreadPoolExecutor(max_workers=concurrency) as pool:
+        try:
+            results = await asyncio.gather(*(_download_file(loop, pool, thread_session, file, path, max_retries, backoff)
+                                             for _, file, path in files), return_exceptions=True)
+        finally:
+            for session in sessions:
+                session.close()
+
+    errors = {}
+    for (product_id, _, _), result in zip(files, results):
+        if isinstance(result, Exception):
+            errors.setdefault(product_id, []).append(f'{type(result).__name__}: {result}')
+    downloaded = {product['id']: dict(product, path=paths[product['id']]) for product in products if product['id'] not in errors}
+    failed = {product['id']: dict(product, error='; '.join(errors[product['id']])) for product in products if product['id'] in errors}
+    print(f'Downloaded {len(downloaded)} product(s), {len(failed)} failed')
+    return downloaded, failed
+
+async def _download_file(loop, pool, thread_session, file, path, max_retries, backoff):
+    # Download one file (a product or node dict with url, size and md5) to path, retrying with exponential backoff and jitter. The
+    # blocking request runs in a thread of the pool, so that at most as many files as the pool has threads are downloaded at a time
+    if os.path.exists(path) and _is_complete(path, file.get('size'), file.get('md5')):
+        return path
+    os.makedirs(os.path.dirname(path) or '.', exist_ok=True)
+    for attempt in range(max_retries + 1):
+        try:
+            return await loop.run_in_executor(pool, _fetch, thread_session, file, path)
+        except Exception as error:
+            if attempt == max_retries or not _is_retryable(error):
+                raise
+            delay = backoff * 2 ** attempt * random.uniform(0.5, 1.5)
+            print(f'Retrying {os.path.basename(path)} in {delay:.1f} s after {type(error).__name__}: {error}')
+            await asyncio.sleep(delay)
+
+def _fetch(thread_session, file, path):
+    # Runs in a thread of the pool: download a file into path + partial_suffix with the session of the thread, resuming from the bytes
+    # already there, then check it and rename it to path
+    partial = path + partial_suffix
+    offset = os.path.getsize(partial) if os.path.exists(partial) else 0
+    size, md5 = file.get('size'), file.get('md5')
+    if size is not None and offset > size:   # Not the start of this file
+        os.remove(partial)
+        offset = 0
+
+    if size is None or offset < size:
+        headers = {'Range': f'bytes={offset}-'} if offset else {}
+        with thread_session().get(file['url'], headers=headers, stream=True, timeout=timeout) as response:
+            if response.status_code == 416:   # Nothing left to send; the partial file is checked below
+                pass
+            else:
+                response.raise_for_status()
+                resumed = response.status_code == 206
+                with open(partial, 'ab' if resumed else 'wb') as f:   # 200 means the server ignored the range and sends it all
+                    for chunk in response.iter_content(chunk_size):
+                        f.write(chunk)
+
+    written = os.path.getsize(partial)
+    if size is not None and written < size:
+        raise requests.ConnectionError(f'{os.path.basename(path)} ended after {written} of {size} bytes')   # Retried, resuming
+    if not _is_complete(partial, size, md5):
+        os.remove(partial)
+        raise ValueError(f'{os.path.basename(path)} does not match its MD5 checksum {md5}')
+    os.replace(partial, path)
+    print('Downloaded', path)
+    return path
+
+def _is_complete(path, size, md5):
+    # Whether a file has the expected size and MD5 checksum (each only checked if known)
+    if size is not None and os.path.getsize(path) != size:
+        return False
+    if md5 is None:
+        return True
+    digest = hashlib.md5()
+    with open(path, 'rb') as f:
+        for block in iter(lambda: f.read(chunk_size), b''):
+            digest.update(block)
+    return digest.hexdigest().lower() == md5.lower()
+
+def _is_retryable(error):
+    # Connection errors, timeouts, server errors, rate limits and checksum mismatches are retried; other errors (such as 404) are not
+    if isinstance(error, requests.HTTPError):
+        return error.response is not None and (error.response.status_code >= 500 or error.response.status_code == 429)
+    if isinstance(error, (requests.ConnectionError, requests.Timeout, requests.exceptions.ChunkedEncodingError)):
+        return True
+    return isinstance(error, ValueError) and not isinstance(error, requests.RequestException)   # The checksum check, not a bad URL
+
+def _node_parts(node_path):
+    # The directories and file name of a node path such as ./GRANULE/.../B02.jp2, refusing paths that leave the .SAFE directory
+    parts = [part for part in node_path.split('/') if part not in ('', '.')]
+    if '..' in parts:
+        raise ValueError(f'{node_path} is outside the product')
+    return parts
+
+def _manifest_nodes(manifest, safe_url):
+    # The files listed in the manifest.safe of a product, as node dicts with node_path, url (an OData Nodes path under safe_url), size
+    # and md5
+    nodes = []
+    for data_object in ET.fromstring(manifest).findall('.//{*}dataObject'):   # With or without a namespace
+        location = data_object.find('.//{*}fileLocation')
+        stream = data_object.find('.//{*}byteStream')
+        checksum = data_object.find('.//{*}checksum')
+        if location is None:
+            continue
+        node_path = location.get('href')
+        if not node_path.startswith('./'):
+            node_path = './' + node_path
+        url = safe_url + ''.join(f"/Nodes('{quote(part)}')" for part in _node_parts(node_path)) + '/$value'
+        size = int(stream.get('size')) if stream is not None and stream.get('size') else None
+        md5 = checksum.text.strip() if checksum is not None and checksum.get('checksumName', '').upper() == 'MD5' else None
+        nodes.append({'node_path': node_path, 'url': url, 'size': size, 'md5': md5})
+    return nodes
@@ -0,0 +1,187 @@
+import os
+import io
+import json
+import hashlib
+from collections import OrderedDict
+import pandas as pd
+import shapely
+import pyproj
+import geopandas as gpd
+import matplotlib.pyplot as plt
+import data_loader
+import cache_files
+
+"""
+This module keeps a cache of rendered maps, so that calling a plotting function such as water_company_boundaries.wrz_boundaries or
+create_std_chloropleth.create_chloropleth again with the same data and styling, as notebooks and report builds do, returns the stored
+image instead of reading, projecting and drawing every polygon again.
+
+1. Key each render by a SHA-256 hash of the input data, the column, the styling parameters (colour map, title and so on) and the
+   output size (figure size and dpi). Data given as a file path is hashed by the size and modification time of its files (as
+   data_loader does), and data given as a GeoDataFrame by its CRS, geometry (as WKB) and attribute values.
+2. On a miss, draw the figure and save it as a PNG file named after its key in the cache directory. On a hit, read the PNG file and
+   show it in a new pyplot figure, so that the caller's plt.show() or plt.savefig() works either way.
+3. Keep the most recently used images in memory as well, and keep the cache directory under a size cap by deleting the least recently
+   used PNG files. Reading a file marks it as used.
+4. Keep the GeoDataFrames reprojected by projected in memory, keyed by the hash of the data and the target CRS, so that a new style of
+   the same data does not reproject it again.
+"""
+
+render_cache_dir = 'data_files/render_cache'
+max_memory_images = 16   # Images kept in memory
+max_cache_bytes = 256 * 2 ** 20   # Size cap of the cache directory (256 MB)
+cache_version = 1   # Increase when the look of the maps changes, so that old images are not used
+
+_images = OrderedDict()   # The PNG bytes of the most recently used images, keyed by render key
+_projections = {}   # Reprojected GeoDataFrames, keyed by data hash and target CRS
+
+def data_hash(data):
+    """
+    Hash the input data of a map.
+
+    Input:
+        data (str or gpd.GeoDataFrame): The file path of a vector layer, or a (Geo)DataFrame.
+
+    Output:
+        str: The hexadecimal SHA-256 hash. A file is hashed by the size and modification time of its files, and a GeoDataFrame by its
+        CRS, geometry and attribute values, so a copy of the same data has the same hash.
+    """
+    digest = hashlib.sha256()
+    if isinstance(data, (str, os.PathLike)):
+        digest.update(data_loader.file_fingerprint(os.path.abspath(data)).encode())
+        return digest.hexdigest()
+
+    attributes = pd.DataFrame(data)
+    if isinstance(data, gpd.GeoDataFrame):
+        attributes = attributes.drop(columns=data.geometry.name)
+        digest.update(str(data.crs.to_wkt() if data.crs is not None else None).encode())
+        digest.update(b''.join(shapely.to_wkb(data.geometry.to_numpy(), hex=False, output_dimension=3)))
+    digest.update(json.dumps([str(column) for column in attributes.columns] + [str(dtype) for dtype in attributes.dtypes]).encode())
+    digest.update(pd.util.hash_pandas_object(attributes, index=True).to_numpy().tobytes())
+    return digest.hexdigest()
+
+def render_key(data, column, **style):
+    """
+    Find the cache key of a map.
+
+    Inputs:
+        data (str or gpd.GeoDataFrame): The input data, see data_hash.
+        column (str): The column the map is coloured by.
+        **style: The styling parameters and output size, such as cmap, title, figsize and dpi. Values must be JSON serialisable.
+
+    Output:
+        str: The hexadecimal SHA-256 key.
+    """
+    key = {'version': cache_version, 'data': data_hash(data), 'column': column, 'style': style}
+    return hashlib.sha256(json.dumps(key, sort_keys=True, default=str).encode()).hexdigest()
+
+def cached_figure(key, draw, dpi=100, cache_dir=render_cache_dir, max_bytes=max_cache_bytes):
+    """
+    Return the PNG image of a map from the cache, or draw and cache it. Either way the current pyplot figure shows the map afterwards.
+
+    Inputs:
+        key (str): The cache key from render_key.
+        draw (function): Called without arguments on a miss to draw the map. Returns the matplotlib figure.
+        dpi (int): The resolution of the PNG image in dots per inch.
+        cache_dir (str): The cache directory (created if needed). None to always draw the map and cache nothing.
+        max_bytes (int): The size cap of the cache directory in bytes.
+
+    Output:
+        bytes: The PNG image.
+    """
+    png = _load_image(key, cache_dir)
+    if png is not None:
+        image = plt.imread(io.BytesIO(png), format='png')
+        figure = plt.figure(figsize=(image.shape[1] / dpi, image.shape[0] / dpi), dpi=dpi)
+        figure.add_axes([0, 0, 1, 1]).imshow(image)
+        figure.axes[0].set_axis_off()
+        return png
+
+    buffer = io.BytesIO()
+    draw().savefig(buffer, format='png', dpi=dpi)
+    png = buffer.getvalue()
+    if cache_dir is not None:
+        _save_image(key, png, cache_dir, max_bytes)
+    return png
+
+def save_image(png, output_file):
+    """
+    Write a PNG image to a file, unless the file already holds the same image.
+
+    Inputs:
+        png (bytes): The PNG image, such as from cached_figure.
+        output_file (str): The file path.
+
+    Output:
+        bool: True if the file was written.
+    """
+    if os.path.exists(output_file) and os.path.getsize(output_file) == len(png):
+        with open(output_file, 'rb') as f:
+            if f.read() == png:
+                return False
+    with open(output_file, 'wb') as f:
+        f.write(png)
+    return True
+
+def projected(gdf, crs):
+    """
+    Reproject a GeoDataFrame, reusing the result of an earlier call with the same data and CRS.
+
+    Inputs:
+        gdf (gpd.GeoDataFrame): The data.
+        crs: The target CRS, anything accepted by GeoDataFrame.to_crs, such as 'EPSG:27700' or the crs of another layer.
+
+    Output:
+        gpd.GeoDataFrame: A copy of gdf in the target CRS.
+    """
+    key = (data_hash(gdf), pyproj.CRS.from_user_input(crs).to_wkt())
+    if key not in _projections:
+        _projections[key] = gdf.to_crs(crs)
+    return _projections[key].copy()
+
+def clear_render_cache(cache_dir=render_cache_dir):
+    """
+    Forget the images and projections in memory and delete the PNG files in the cache directory.
+
+    Input:
+        cache_dir (str): The cache directory.
+    """
+    _images.clear()
+    _projections.clear()
+    if not os.path.isdir(cache_dir):
+        return
+    for entry in os.scandir(cache_dir):
+        if entry.is_file() and entry.name.endswith(('.png', '.partial')):
+            os.remove(entry.path)
+
+def _load_image(key, cache_dir):
+    # PNG bytes of a cached image from memory or the cache directory, or None if it is not cached
+    if cache_dir is None:
+        return None
+    if key in _images:
+        _images.move_to_end(key)
+        return _images[key]
+    path = os.path.join(cache_dir, key + '.png')
+    try:
+        with open(path, 'rb') as f:
+            png = f.read()
+    except OSError:
+        return None
+    cache_files.mark_used(path)
+    _remember(key, png)
+    return png
+
+def _save_image(key, png, cache_dir, max_bytes):
+    # Save an image to memory and the cache directory, then delete the least recently used images until the directory is under the cap
+    _remember(key, png)
+    path = os.path.join(cache_dir, key + '.png')
+    with cache_files.atomic_file(path) as partial, open(partial, 'wb') as f:
+        f.write(png)
+    cache_files.evict(cache_dir, '.png', max_bytes, keep=path)
+
+def _remember(key, png):
+    # Keep an image in memory, forgetting the least recently used images beyond max_memory_images
+    _images[key] = png
+    _images.move_to_end(key)
+    while len(_images) > max_memory_images:
+        _images.popitem(last=False)
@@ -0,0 +1,255 @@
+import os
+import json
+import sqlite3
+import contextlib
+import hashlib
+import datetime
+import pandas as pd
+import shapely
+import geopandas as gpd
+
+"""
+This module keeps a local catalog of the satellite scenes found by searches of a sentinelsat SentinelAPI and of the scenes downloaded,
+so that repeating a search for a company and date range is answered from disk in milliseconds, and works offline.
+
+1. Store each scene found (its id, title, date, cloud cover, platform, product type and footprint in EPSG:4326) in a SQLite database,
+   with an R-tree index of the bounding boxes of the footprints.
+2. Record each search that was made: the search area, platform, product type, largest cloud cover and the date range searched.
+3. For a new search, work out which parts of its date range have not been searched already for the same area, platform and product
+   type (with at least the same cloud cover), and only send those ranges to the remote API. Add the scenes found to the catalog.
+4. Answer the search from the catalog: scenes whose bounding box overlaps the area (from the R-tree), then whose footprint intersects it,
+   dated in the range and under the cloud cover limit. Offline, skip step 3 and answer from the catalog as it is.
+5. Record the local path of each scene once it is downloaded, so that searches can show, or be limited to, the scenes on disk.
+
+Date ranges are [start, end): the start day is included and the end day is not, as in the date ranges of SentinelAPI.query.
+"""
+
+catalog_file = 'data_files/scene_catalog.sqlite'
+schema = '''
+CREATE TABLE IF NOT EXISTS scenes (
+    rowid INTEGER PRIMARY KEY,
+    id TEXT UNIQUE NOT NULL,
+    title TEXT,
+    date TEXT,
+    cloud REAL,
+    platformname TEXT,
+    producttype TEXT,
+    footprint BLOB,
+    metadata TEXT,
+    path TEXT
+);
+CREATE INDEX IF NOT EXISTS scenes_date ON scenes (date);
+CREATE VIRTUAL TABLE IF NOT EXISTS scene_bounds USING rtree (rowid, minx, maxx, miny, maxy);
+CREATE TABLE IF NOT EXISTS searches (
+    area TEXT NOT NULL,
+    platformname TEXT,
+    producttype TEXT,
+    max_cloud REAL,
+    start TEXT NOT NULL,
+    end TEXT NOT NULL,
+    searched TEXT
+);
+'''
+
+def query_scenes(api, area, date_start, date_end, max_cloud=10, platformname='Sentinel-2', producttype='S2MSI2A', offline=False,
+                 catalog_file=catalog_file):
+    """
+    Find the scenes covering an area in a date range, searching the remote API only for the parts of the range not searched before.
+
+    Inputs:
+        api (sentinelsat.SentinelAPI): The API to search. Not used (and can be None) offline or when the range was searched before.
+        area (gpd.GeoDataFrame, gpd.GeoSeries or shapely geometry): The search area, such as the outline of a water company or a
+            rectangle around it. A shapely geometry is taken to be in EPSG:4326.
+        date_start (str or date): The first day, such as '20230201'.
+        date_end (str or date): The day after the last day, such as '20230301'.
+        max_cloud (float): The largest cloud cover percentage.
+        platformname (str): The platform, such as Sentinel-2.
+        producttype (str): The product type, such as S2MSI2A (surface reflectance).
+        offline (bool): True to answer from the catalog only, without the remote API.
+        catalog_file (str): The file path of the catalog database (created if needed).
+
+    Output:
+        gpd.GeoDataFrame: The scenes, see find_scenes.
+    """
+    area = _area(area)
+    if not offline:
+        for start, end in uncovered_ranges(area, date_start, date_end, max_cloud, platformname, producttype, catalog_file):
+            print(f'Searching {platformname} {producttype} scenes from {start} to {end}')
+            products = api.query(area.wkt, date=(start.strftime('%Y%m%d'), end.strftime('%Y%m%d')), platformname=platformname,
+                                 producttype=producttype, cloudcoverpercentage=(0, max_cloud))
+            add_scenes(products, catalog_file)
+            record_search(area, start, end, max_cloud, platformname, producttype, catalog_file)
+    return find_scenes(area, date_start, date_end, max_cloud, platformname, producttype, catalog_file=catalog_file)
+
+def find_scenes(area, date_start, date_end, max_cloud=None, platformname=None, producttype=None, downloaded_only=False,
+                catalog_file=catalog_file):
+    """
+    Find the scenes in the catalog that intersect an area in a date range.
+
+    Inputs:
+        area (gpd.GeoDataFrame, gpd.GeoSeries or shapely geometry): The area. A shapely geometry is taken to be in EPSG:4326.
+        date_start (str or date): The first day, such as '20230201'.
+        date_end (str or date): The day after the last day.
+        max_cloud (float): The largest cloud cover percentage. None for any.
+        platformname (str): The platform, such as Sentinel-2. None for any.
+        producttype (str): The product type, such as S2MSI2A. None for any.
+        downloaded_only (bool): True to only return the scenes with a local path.
+        catalog_file (str): The file path of the catalog database.
+
+    Output:
+        gpd.GeoDataFrame: One row per scene, indexed by product id and sorted by date, with the columns title, beginposition (the
+        date), cloudcoverpercentage, platformname, producttype, path (None if not downloaded) and geometry (the footprint, in
+        EPSG:4326), as in SentinelAPI.to_geodataframe.
+    """
+    area = _area(area)
+    minx, miny, maxx, maxy = area.bounds
+    sql = '''SELECT s.id, s.title, s.date, s.cloud, s.platformname, s.producttype, s.path, s.footprint
+             FROM scene_bounds b JOIN scenes s ON s.rowid = b.rowid
+             WHERE b.maxx >= ? AND b.minx <= ? AND b.maxy >= ? AND b.miny <= ? AND s.date >= ? AND s.date < ?'''
+    parameters = [minx, maxx, miny, maxy, _day(date_start).isoformat(), _day(date_end).isoformat()]
+    for condition, value in [('s.cloud <= ?', max_cloud), ('s.platformname = ?', platformname), ('s.producttype = ?', producttype)]:
+        if value is not None:
+            sql += ' AND ' + condition
+            parameters.append(value)
+    if downloaded_only:
+        sql += ' AND s.path IS NOT NULL'
+    with _connect(catalog_file) as connection:
+        rows = connection.execute(sql + ' ORDER BY s.date', parameters).fetchall()
+
+    columns = ['id', 'title', 'beginposition', 'cloudcoverpercentage', 'platformname', 'producttype', 'path']
+    scenes = pd.DataFrame([row[:-1] for row in rows], columns=columns).set_index('id')
+    scenes['beginposition'] = pd.to_datetime(scenes['beginposition'])
+    scenes = gpd.GeoDataFrame(scenes, geometry=shapely.from_wkb([row[-1] for row in rows]), crs='EPSG:4326')
+    shapely.prepare(area)
+    return scenes[shapely.intersects(area, scenes.geometry.to_numpy())]
+
+def uncovered_ranges(area, date_start, date_end, max_cloud=10, platformname='Sentinel-2', producttype='S2MSI2A',
+                     catalog_file=catalog_file):
+    """
+    Find the parts of a date range not searched before for an area, platform and product type.
+
+    Inputs:
+        area (gpd.GeoDataFrame, gpd.GeoSeries or shapely geometry): The search area. A shapely geometry is taken to be in EPSG:4326.
+        date_start (str or date): The first day, such as '20230201'.
+        date_end (str or date): The day after the last day.
+        max_cloud (float): The largest cloud cover percentage. Searches with a lower limit do not count.
+        platformname (str): The platform.
+        producttype (str): The product type.
+        catalog_file (str): The file path of the catalog database.
+
+    Output:
+        list of (datetime.date, datetime.date): The [start, end) ranges not searched yet, in order.
+    """
+    start, end = _day(date_start), _day(date_end)
+    with _connect(catalog_file) as connection:
+        searched = connection.execute('''SELECT start, end FROM searches WHERE area = ? AND platformname IS ? AND producttype IS ?
+                                         AND max_cloud >= ? AND end > ? AND start < ? ORDER BY start''',
+                                      (_area_key(_area(area)), platformname, producttype, max_cloud, start.isoformat(),
+                                       end.isoformat())).fetchall()
+    ranges = []
+    for searched_start, searched_end in searched:
+        searched_start, searched_end = datetime.date.fromisoformat(searched_start), datetime.date.fromisoformat(searched_end)
+        if searched_start > start:
+            ranges.append((start, min(searched_start, end)))
+        start = max(start, searched_end)
+        if start >= end:
+            break
+    if start < end:
+        ranges.append((start, end))
+    return ranges
+
+def record_search(area, date_start, date_end, max_cloud=10, platformname='Sentinel-2', producttype='S2MSI2A', catalog_file=catalog_file):
+    """
+    Record that an area was searched for a date range, after the scenes found were added with add_scenes.
+
+    Inputs:
+        area (gpd.GeoDataFrame, gpd.GeoSeries or shapely geometry): The search area. A shapely geometry is taken to be in EPSG:4326.
+        date_start (str or date): The first day.
+        date_end (str or date): The day after the last day.
+        max_cloud (float): The largest cloud cover percentage of the search.
+        platformname (str): The platform.
+        producttype (str): The product type.
+        catalog_file (str): The file path of the catalog database.
+    """
+    with _connect(catalog_file) as connection:
+        connection.execute('INSERT INTO searches VALUES (?, ?, ?, ?, ?, ?, ?)',
+                           (_area_key(_area(area)), platformname, producttype, max_cloud, _day(date_start).isoformat(),
+                            _day(date_end).isoformat(), datetime.datetime.now().isoformat(timespec='seconds')))
+
+def add_scenes(products, catalog_file=catalog_file):
+    """
+    Add scenes to the catalog, or update them if they are already in it (keeping their local paths).
+
+    Inputs:
+        products (dict or gpd.GeoDataFrame): The scenes, as returned by SentinelAPI.query (product id to properties, with the
+            footprint as WKT) or SentinelAPI.to_geodataframe.
+        catalog_file (str): The file path of the catalog database.
+
+    Output:
+        int: The number of scenes added or updated.
+    """
+    if isinstance(products, gpd.GeoDataFrame):
+        frame = products.to_crs('EPSG:4326')
+        properties = pd.DataFrame(frame.drop(columns=frame.geometry.name)).to_dict('index')
+        products = {product_id: dict(properties[product_id], footprint=footprint) for product_id, footprint in frame.geometry.items()}
+    scenes, bounds = [], []
+    for product_id, properties in products.items():
+        footprint = properties['footprint']
+        footprint = shapely.from_wkt(footprint) if isinstance(footprint, str) else footprint
+        metadata = {key: value for key, value in properties.items() if key not in ('footprint', 'gmlfootprint')}
+        date = pd.Timestamp(properties.get('beginposition')).tz_localize(None).isoformat()
+        scenes.append((product_id, properties.get('title'), date, properties.get('cloudcoverpercentage'), properties.get('platformname'),
+                       properties.get('producttype'), shapely.to_wkb(footprint), json.dumps(metadata, default=str)))
+        bounds.append(shapely.bounds(footprint)[[0, 2, 1, 3]].tolist())   # minx, maxx, miny, maxy as the R-tree has them
+
+    with _connect(catalog_file) as connection:
+        connection.executemany('''INSERT INTO scenes (id, title, date, cloud, platformname, producttype, footprint, metadata)
+                                  VALUES (?, ?, ?, ?, ?, ?, ?, ?)
+                                  ON CONFLICT (id) DO UPDATE SET title = excluded.title, date = excluded.date, cloud = excluded.cloud,
+                                  platformname = excluded.platformname, producttype = excluded.producttype,
+                                  footprint = excluded.footprint, metadata = excluded.metadata''', scenes)
+        rowids = dict(connection.execute(f'SELECT id, rowid FROM scenes WHERE id IN ({", ".join("?" * len(scenes))})',
+                                         [scene[0] for scene in scenes]).fetchall())
+        connection.executemany('INSERT OR REPLACE INTO scene_bounds VALUES (?, ?, ?, ?, ?)',
+                               [(rowids[scene[0]], *box) for scene, box in zip(scenes, bounds)])
+    return len(scenes)
+
+def record_downloads(downloaded, catalog_file=catalog_file):
+    """
+    Record the local paths of downloaded scenes.
+
+    Inputs:
+        downloaded (dict): Product id to product dict with the key path, as returned first by product_downloader.download_products,
+            or product id to path.
+        catalog_file (str): The file path of the catalog database.
+    """
+    paths = [(os.path.abspath(product['path'] if isinstance(product, dict) else product), product_id)
+             for product_id, product in downloaded.items()]
+    with _connect(catalog_file) as connection:
+        connection.executemany('UPDATE scenes SET path = ? WHERE id = ?', paths)
+
+@contextlib.contextmanager
+def _connect(catalog_file):
+    # Connection to a catalog database, creating its tables if needed, that commits (or rolls back after an error) and closes
+    os.makedirs(os.path.dirname(catalog_file) or '.', exist_ok=True)
+    connection = sqlite3.connect(catalog_file)
+    try:
+        connection.executescript(schema)
+        with connection:
+            yield connection
+    finally:
+        connection.close()
+
+def _area(area):
+    # Search area as one shapely geometry in EPSG:4326
+    if isinstance(area, (gpd.GeoDataFrame, gpd.GeoSeries)):
+        return shapely.union_all(area.to_crs('EPSG:4326').geometry.to_numpy())
+    return area
+
+def _area_key(area):
+    # Hash of a search area, so that searches of the same area match (to 7 decimal places of a degree, about 1 cm)
+    return hashlib.sha256(shapely.to_wkt(area, rounding_precision=7).encode()).hexdigest()
+
+def _day(date):
+    # A date given as a string (such as '20230201' or '2023-02-01'), date or datetime, as a datetime.date
+    return pd.Timestamp(date).date()
@@ -0,0 +1,96 @@
+import numpy as np
+import pandas as pd
+import shapely
+import geopandas as gpd
+
+"""
+This module chooses which satellite scenes to download for a water company, from the footprints of the scenes found by a search (such
+as the GeoDataFrame of sentinelsat's SentinelAPI.to_geodataframe), measured against the company outline itself rather than a rectangle
+around it.
+
+1. Reproject the footprints and the company area to the British National Grid (EPSG:27700), so that areas are in square metres rather
+   than square degrees.
+2. Find the fraction of the company area inside each footprint, for all the footprints in one vectorised intersection.
+3. Choose scenes greedily: at each step take the scene that covers the most of the company area not yet covered, until the chosen
+   scenes cover the target fraction of the area, or no scene adds any more. Scenes whose gain is within a small tolerance of the best
+   (such as the same tile on different dates) are tied, and the tie goes to the lowest cloud cover, then the most recent date.
+"""
+
+equal_area_crs = 'EPSG:27700'   # Metres in Great Britain
+cloud_column = 'cloudcoverpercentage'
+date_column = 'beginposition'
+tie_tolerance = 1e-4   # Gains within this fraction of the company area are tied
+
+def overlap_fractions(footprints, area, crs=equal_area_crs):
+    """
+    Find the fraction of an area inside each scene footprint.
+
+    Inputs:
+        footprints (gpd.GeoDataFrame or gpd.GeoSeries): The scene footprints, with a CRS.
+        area (gpd.GeoDataFrame, gpd.GeoSeries or shapely geometry): The area, such as the outline of a water company. A GeoDataFrame
+            or GeoSeries with several rows is unioned. A shapely geometry is taken to be in the CRS of the footprints.
+        crs: The CRS the areas are measured in.
+
+    Output:
+        pd.Series: The fraction (0 to 1) of the area inside each footprint, with the index of footprints.
+    """
+    geometries, area = _projected(footprints, area, crs)
+    shapely.prepare(area)
+    return pd.Series(shapely.area(shapely.intersection(geometries, area)) / area.area, index=footprints.index, name='overlap')
+
+def select_scenes(footprints, area, target=0.95, max_scenes=None, crs=equal_area_crs, cloud_column=cloud_column,
+                  date_column=date_column):
+    """
+    Choose the fewest scenes that together cover a target fraction of an area, greedily, with ties broken on cloud cover and date.
+
+    Inputs:
+        footprints (gpd.GeoDataFrame): The scenes, one row per scene with its footprint, and optionally cloud cover and date columns.
+        area (gpd.GeoDataFrame, gpd.GeoSeries or shapely geometry): The area to cover, see overlap_fractions.
+        target (float): The fraction of the area to cover. The selection stops sooner if no scene covers any more of it.
+        max_scenes (int): The largest number of scenes to choose. 1 gives the scene with the largest overlap.
+        crs: The CRS the areas are measured in.
+        cloud_column (str): The cloud cover column, lower is better. Ignored if footprints has no such column.
+        date_column (str): The date column, more recent is better. Ignored if footprints has no such column.
+
+    Output:
+        gpd.GeoDataFrame: The chosen scenes in the order they were chosen, with the added columns overlap (the fraction of the area in
+        the scene), gain (the fraction that the scene adds to the scenes before it) and coverage (the fraction covered so far).
+    """
+    geometries, area = _projected(footprints, area, crs)
+    total = area.area
+    remaining = area
+    order = pd.DataFrame({'cloud': footprints[cloud_column].to_numpy(dtype=float) if cloud_column in footprints else 0.0,
+                          'date': pd.to_datetime(footprints[date_column]).to_numpy() if date_column in footprints else pd.NaT},
+                         index=range(len(footprints)))
+
+    candidates = np.arange(len(footprints))
+    chosen, gains = [], []
+    covered = 0.0
+    while candidates.size and covered < target and (max_scenes is None or len(chosen) < max_scenes):
+        shapely.prepare(remaining)
+        gain = shapely.area(shapely.intersection(geometries[candidates], remaining)) / total
+        useful = gain > tie_tolerance
+        candidates, gain = candidates[useful], gain[useful]   # Scenes that add nothing now never will
+        if not candidates.size:
+            break
+        tied = candidates[gain >= gain.max() - tie_tolerance]
+        best = order.iloc[tied].sort_values(['cloud', 'date'], ascending=[True, False], na_position='last').index[0]
+        chosen.append(best)
+        gains.append(gain[candidates == best][0])
+        covered += gains[-1]
+        remaining = shapely.difference(remaining, geometries[best])
+        candidates = candidates[candidates != best]
+
+    selected = footprints.iloc[chosen].copy()
+    selected['overlap'] = shapely.area(shapely.intersection(geometries[chosen], area)) / total
+    selected['gain'] = gains
+    selected['coverage'] = np.cumsum(gains)
+    return selected
+
+def _projected(footprints, area, crs):
+    # Footprint geometries and the unioned area as shapely objects in crs
+    if isinstance(area, (gpd.GeoDataFrame, gpd.GeoSeries)):
+        area = area.to_crs(crs).geometry if isinstance(area, gpd.GeoDataFrame) else area.to_crs(crs)
+    else:
+        area = gpd.GeoSeries([area], crs=footprints.crs).to_crs(crs)
+    return footprints.geometry.to_crs(crs).to_numpy(), shapely.union_all(area.to_numpy())
@@ -0,0 +1,33 @@
+import os
+import pytest
+import cache_files
+
+def _write(path, size, mtime):
+    with cache_files.atomic_file(str(path)) as partial, open(partial, 'wb') as f:
+        f.write(b'x' * size)
+    os.utime(path, (mtime, mtime))
+
+def test_atomic_file_leaves_nothing_on_error(tmp_path):
+    path = tmp_path / 'sub' / 'result.npz'
+    with pytest.raises(RuntimeError):
+        with cache_files.atomic_file(str(path)) as partial, open(partial, 'wb') as f:
+            f.write(b'half')
+            raise RuntimeError('crash')
+    assert os.listdir(tmp_path / 'sub') == []
+
+def test_evict_least_recently_used_first(tmp_path):
+    for name, mtime in [('a.png', 100), ('b.png', 300), ('c.png', 200), ('d.png', 400)]:
+        _write(tmp_path / name, 10, mtime)
+    cache_files.mark_used(tmp_path / 'a.png')   # Now the most recently used
+    deleted, total = cache_files.evict(str(tmp_path), '.png', max_bytes=30, keep=str(tmp_path / 'c.png'))
+    assert [os.path.basename(path) for path in deleted] == ['b.png']
+    assert total == 30
+    assert sorted(os.listdir(tmp_path)) == ['a.png', 'c.png', 'd.png']
+
+def test_evict_down_to_target_in_subdirectories(tmp_path):
+    for name, mtime in [('1/a.png', 100), ('2/b.png', 200), ('2/c.png', 300), ('d.txt', 50)]:
+        _write(tmp_path / name, 10, mtime)
+    assert cache_files.evict(str(tmp_path), '.png', max_bytes=30, recursive=True) == ([], 30)
+    deleted, total = cache_files.evict(str(tmp_path), '.png', max_bytes=25, target_bytes=10, recursive=True)
+    assert [os.path.relpath(path, tmp_path) for path in deleted] == [os.path.join('1', 'a.png'), os.path.join('2', 'b.png')]
+    assert total == 10
@@ -0,0 +1,20 @@
+import os
+import numpy as np
+import pandas as pd
+from correlation_engine import company_metrics
+
+data_files = os.path.join(os.path.dirname(__file__), os.pardir, 'data_files')
+
+def test_company_names_sharing_an_acronym():
+    # The water supply areas spell some companies two ways, such as ICW and LEP, with one acronym
+    companies = pd.DataFrame({'COMPANY': ['Anglian Water', 'Icosa Water Services Ltd', 'Icosa Water Services Limited',
+                                          'Leep Networks (Water) Ltd', 'Leep Networks (Water) Ltd (formerly SSE Water Ltd)'],
+                              'Acronym': ['ANH', 'ICW', 'ICW', 'LEP', 'LEP']})
+    landuse_areas = pd.DataFrame({'Forest': [1.0, 2.0, 3.0, 4.0, 5.0], 'Pasture': [0.5, 0.0, 1.5, 0.0, 0.0]},
+                                 index=companies['COMPANY'].to_numpy())
+    metrics = company_metrics(os.path.join(data_files, 'pr24_hist_pcc.csv'), os.path.join(data_files, 'Correlation_Data.csv'),
+                              landuse_areas, companies)
+    assert metrics.index.is_unique
+    np.testing.assert_array_equal(metrics.loc[['ANH', 'ICW', 'LEP'], 'Forest'], [1.0, 5.0, 9.0])
+    np.testing.assert_array_equal(metrics.loc[['ANH', 'ICW', 'LEP'], 'Pasture'], [0.5, 1.5, 0.0])
+    assert metrics.loc['ANH', 'hh_cons'] == 626.4
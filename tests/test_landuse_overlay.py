@@ -0,0 +1,34 @@
+import numpy as np
+import pandas as pd
+import shapely
+import geopandas as gpd
+from landuse_overlay import landuse_area_matrix
+
+def _companies():
+    # One company inside a single land use polygon, one crossing the edge between two polygons and one around a whole polygon
+    return gpd.GeoDataFrame({'COMPANY': ['Inside', 'Across', 'Around']},
+                            geometry=[shapely.box(10, 10, 20, 20), shapely.box(90, 40, 110, 60), shapely.box(140, 140, 170, 170)],
+                            crs='EPSG:27700')
+
+def _landuse():
+    return gpd.GeoDataFrame({'LABEL': ['Forest', 'Pasture', 'Forest']},
+                            geometry=[shapely.box(0, 0, 100, 100), shapely.box(100, 0, 200, 100), shapely.box(150, 150, 160, 160)],
+                            crs='EPSG:27700')
+
+def test_company_inside_landuse_polygon():
+    # The company contains no land use polygon whole, so all its area comes from clipping
+    companies = _companies().iloc[:1]
+    matrix = landuse_area_matrix(companies, _landuse(), threads=1)
+    assert matrix.loc['Inside', 'Forest'] == 100 / 10000
+    assert matrix.loc['Inside', 'Pasture'] == 0
+
+def test_company_across_landuse_polygons():
+    matrix = landuse_area_matrix(_companies(), _landuse(), threads=2)
+    np.testing.assert_allclose(matrix.loc['Across', ['Forest', 'Pasture']].to_numpy(), [200 / 10000, 200 / 10000])
+
+def test_chunks_match_single_read():
+    # Each chunk holds one polygon, so that most chunks have no polygon whole inside a company, or no polygon of some classes
+    companies, landuse = _companies(), _landuse()
+    single = landuse_area_matrix(companies, landuse, threads=1)
+    chunked = landuse_area_matrix(companies, (landuse.iloc[[i]] for i in range(len(landuse))), threads=1)
+    pd.testing.assert_frame_equal(chunked, single)
@@ -0,0 +1,57 @@
+import os
+import numpy as np
+from sklearn.decomposition import PCA
+from PCAKmeans_updated import read_image_pair, find_vector_set, find_FVS
+
+test_data = os.path.join(os.path.dirname(__file__), os.pardir, 'data_files', 'test_data')
+
+def _find_vector_set_loop(diff_image, new_size):
+    # find_vector_set before it was vectorised, block by block
+    block_size = 5
+    num_blocks = (new_size[0] // block_size) * (new_size[1] // block_size)
+    vector_set = np.empty((num_blocks, block_size * block_size), dtype=np.int16)
+    idx = 0
+    for i in range(new_size[0] // block_size):
+        for j in range(new_size[1] // block_size):
+            block = diff_image[i * block_size:(i + 1) * block_size, j * block_size:(j + 1) * block_size]
+            feature = block.flatten()
+            vector_set[idx, :] = feature[:vector_set.shape[1]]
+            idx += 1
+    mean_vec = np.mean(vector_set, axis=0)
+    return vector_set, mean_vec
+
+def _find_FVS_loop(EVS, diff_image, mean_vec, new):
+    # find_FVS before it was vectorised, pixel by pixel
+    i = 2
+    feature_vector_set = []
+    while i < new[0] - 2:
+        j = 2
+        while j < new[1] - 2:
+            block = diff_image[i - 2:i + 3, j - 2:j + 3]
+            feature = block.flatten()
+            feature_vector_set.append(feature)
+            j = j + 1
+        i = i + 1
+    feature_vector_set = np.array(feature_vector_set)
+    feature_vector_set = feature_vector_set.reshape((-1, 25))
+    FVS = np.dot(feature_vector_set, EVS)
+    FVS = FVS - mean_vec
+    return FVS
+
+def _diff_image():
+    return read_image_pair(os.path.join(test_data, '20200327.jpeg'), os.path.join(test_data, '20230208.jpeg'))
+
+def test_find_vector_set_matches_loop():
+    diff_image, new_size = _diff_image()
+    vector_set, mean_vec = find_vector_set(diff_image, new_size)
+    expected_set, expected_mean = _find_vector_set_loop(diff_image, new_size)
+    assert vector_set.dtype == expected_set.dtype
+    np.testing.assert_array_equal(vector_set, expected_set)
+    np.testing.assert_array_equal(mean_vec, expected_mean)
+
+def test_find_FVS_matches_loop():
+    diff_image, new_size = _diff_image()
+    vector_set, mean_vec = find_vector_set(diff_image, new_size)
+    EVS = PCA().fit(vector_set).components_
+    FVS = find_FVS(EVS, diff_image, mean_vec, new_size)
+    np.testing.assert_allclose(FVS, _find_FVS_loop(EVS, diff_image, mean_vec, new_size), rtol=1e-12)
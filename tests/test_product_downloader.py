@@ -0,0 +1,77 @@
+import os
+import hashlib
+import threading
+from http.server import BaseHTTPRequestHandler, ThreadingHTTPServer
+import pytest
+import product_downloader
+
+products = {'/resume': os.urandom(300000), '/corrupt': os.urandom(200000), '/flaky': os.urandom(100000)}
+
+class _Handler(BaseHTTPRequestHandler):
+    # Serves the fake products with range requests. /corrupt sends wrong bytes the first time and /flaky fails with 503 the first time
+    protocol_version = 'HTTP/1.1'
+    requests = []
+
+    def log_message(self, *args):
+        pass
+
+    def do_GET(self):
+        first = self.path not in [path for path, _ in self.requests]
+        self.requests.append((self.path, self.headers.get('Range')))
+        if self.path == '/flaky' and first:
+            self.send_response(503)
+            self.send_header('Content-Length', '0')
+            self.end_headers()
+            return
+        body = products[self.path]
+        if self.path == '/corrupt' and first:
+            body = bytes(len(body))
+        start = int(self.headers['Range'][len('bytes='):-1]) if self.headers.get('Range') else 0
+        self.send_response(206 if start else 200)
+        self.send_header('Content-Length', str(len(body) - start))
+        self.end_headers()
+        self.wfile.write(body[start:])
+
+@pytest.fixture
+def server():
+    _Handler.requests = []
+    httpd = ThreadingHTTPServer(('127.0.0.1', 0), _Handler)
+    thread = threading.Thread(target=httpd.serve_forever, daemon=True)
+    thread.start()
+    yield f'http://127.0.0.1:{httpd.server_port}'
+    httpd.shutdown()
+    httpd.server_close()
+
+def _product(url, path):
+    return {'id': path[1:], 'title': path[1:], 'url': url + path, 'size': len(products[path]),
+            'md5': hashlib.md5(products[path]).hexdigest()}
+
+def _download(url, directory, paths):
+    return product_downloader.download_products([_product(url, path) for path in paths], str(directory), concurrency=2,
+                                                max_retries=2, backoff=0)
+
+def test_resume_partial_download(server, tmp_path):
+    with open(tmp_path / ('resume.zip' + product_downloader.partial_suffix), 'wb') as f:
+        f.write(products['/resume'][:123456])
+    downloaded, failed = _download(server, tmp_path, ['/resume'])
+    assert not failed and list(downloaded) == ['resume']
+    assert (tmp_path / 'resume.zip').read_bytes() == products['/resume']
+    assert _Handler.requests == [('/resume', 'bytes=123456-')]
+
+def test_checksum_mismatch_downloads_again(server, tmp_path):
+    downloaded, failed = _download(server, tmp_path, ['/corrupt'])
+    assert not failed
+    assert (tmp_path / 'corrupt.zip').read_bytes() == products['/corrupt']
+    assert _Handler.requests == [('/corrupt', None), ('/corrupt', None)]   # The bad file is not resumed
+    assert not os.path.exists(tmp_path / ('corrupt.zip' + product_downloader.partial_suffix))
+
+def test_retry_after_server_error(server, tmp_path):
+    downloaded, failed = _download(server, tmp_path, ['/flaky', '/resume'])
+    assert not failed and sorted(downloaded) == ['flaky', 'resume']
+    assert (tmp_path / 'flaky.zip').read_bytes() == products['/flaky']
+    assert [path for path, _ in _Handler.requests].count('/flaky') == 2
+
+def test_existing_file_is_not_downloaded_again(server, tmp_path):
+    (tmp_path / 'flaky.zip').write_bytes(products['/flaky'])
+    downloaded, failed = _download(server, tmp_path, ['/flaky'])
+    assert not failed and _Handler.requests == []
@@ -0,0 +1,319 @@
+import os
+import io
+import re
+import hashlib
+import argparse
+import threading
+from collections import OrderedDict
+from http.server import BaseHTTPRequestHandler, ThreadingHTTPServer
+from urllib.parse import quote, unquote
+import numpy as np
+import shapely
+import matplotlib
+from matplotlib.colors import Normalize
+from PIL import Image, ImageDraw
+import data_loader
+import cache_files
+import pcc_store
+
+"""
+This module serves choropleth map tiles of the water supply areas (256 x 256 pixel PNG files in the XYZ scheme of web maps), so that a
+dashboard or Leaflet map can show any company metric, such as the PCC of each period or the area of a land use class, without drawing
+the whole map for every zoom or pan.
+
+1. Prepare the tile layer once: reproject the water supply areas to Web Mercator (EPSG:3857), build an STRtree of them, and join the
+   metrics table (one row per company acronym, one column per metric, such as 'PCC 2019-20') onto the areas. Each metric gets one
+   colour scale over all its periods, so that tiles of different periods can be compared.
+2. To render a tile, query the STRtree for the areas that intersect it, clip them to the tile, simplify them to the pixel size, and
+   fill each with the colour of its value (light grey where there is none), with black outlines.
+3. Keep the rendered tiles in a least recently used cache in memory and another on disk, keyed by (metric, period, z, x, y) and by a
+   version of the data, so that a change to the water supply areas or the metrics does not serve old tiles.
+4. Serve the tiles over HTTP at /tiles/<metric>/<period>/<z>/<x>/<y>.png, with '-' as the period of metrics without one. The root
+   page is a Leaflet map of the tiles, for example http://127.0.0.1:8000/?metric=PCC&period=2019-20.
+
+From the command line:
+
+    python tile_server.py --port 8000
+"""
+
+tile_size = 256
+tile_cache_dir = 'data_files/tile_cache'
+max_memory_tiles = 2048   # Tiles kept in memory
+max_disk_bytes = 512 * 2 ** 20   # Size cap of the disk cache (512 MB)
+renderer_version = 1   # Increase when the look of the tiles changes, so that old tiles are not served
+web_mercator_extent = 20037508.342789244   # Half the width of the Web Mercator world in metres
+missing_colour = (211, 211, 211, 160)   # Light grey for areas without a value
+fill_alpha = 180
+
+_memory_tiles = OrderedDict()   # The most recently used tiles in memory, keyed by data version, metric, period, z, x and y
+_disk_bytes = {}   # The size of each disk cache directory, counted on first use
+_lock = threading.Lock()   # The server renders tiles in several threads
+
+def tile_layer(water_areas_file=data_loader.water_supply_areas_file, metrics=None, cmap='viridis'):
+    """
+    Prepare the water supply areas and metrics for rendering tiles.
+
+    Inputs:
+        water_areas_file (str): The file path of the water supply areas shapefile.
+        metrics (pd.DataFrame): The metrics, indexed by company acronym, with one column per metric and period named '<metric> <period>'
+            (such as 'PCC 2019-20') or '<metric>' for metrics without periods, for example from correlation_engine.company_metrics.
+            Defaults to the PCC of every period from pcc_store.
+        cmap (str): The matplotlib colour map.
+
+    Output:
+        dict: The tile layer, with the geometries in EPSG:3857, their STRtree, the metric values of each area, the colour scale of
+        each metric and the data version.
+    """
+    metrics = pcc_store.pcc_by_period().add_prefix('PCC ') if metrics is None else metrics
+    areas = data_loader.read_water_supply_areas(water_areas_file, columns=['Acronym']).to_crs(3857)
+    areas = areas[areas.geometry.notna() & ~areas.geometry.is_empty]
+    geometries = areas.geometry.to_numpy()
+    values = metrics.apply(lambda column: column.astype(float)).reindex(areas['Acronym'].to_numpy())
+
+    # One colour scale per metric over all its periods
+    ranges = {}
+    for column in values.columns:
+        metric = _split_column(column)[0]
+        column_values = values[column].to_numpy()
+        column_values = column_values[~np.isnan(column_values)]
+        low, high = ranges.get(metric, (np.inf, -np.inf))
+        if len(column_values):
+            ranges[metric] = (min(low, column_values.min()), max(high, column_values.max()))
+        else:
+            ranges.setdefault(metric, (low, high))
+
+    # The data version changes with the water supply areas, the metrics or the look of the tiles
+    digest = hashlib.sha256(repr((renderer_version, cmap, data_loader.file_fingerprint(os.path.abspath(water_areas_file)))).encode())
+    digest.update(values.to_numpy(dtype=float).tobytes())
+    digest.update(repr((list(values.index), list(values.columns))).encode())
+    return {'geometries': geometries, 'tree': shapely.STRtree(geometries), 'values': values, 'ranges': ranges,
+            'cmap': matplotlib.colormaps[cmap], 'version': digest.hexdigest()[:16]}
+
+def render_tile(layer, metric, period, z, x, y):
+    """
+    Render one map tile of a metric.
+
+    Inputs:
+        layer (dict): The tile layer from tile_layer.
+        metric (str): The metric, such as PCC.
+        period (str): The period, such as 2019-20, or None for metrics without periods.
+        z (int): The zoom level.
+        x (int): The tile column, from 0 at the west.
+        y (int): The tile row, from 0 at the north.
+
+    Output:
+        bytes: The PNG file of the tile.
+    """
+    column = _column(layer, metric, period)
+    n_tiles = 2 ** z
+    if not (0 <= x < n_tiles and 0 <= y < n_tiles):
+        raise ValueError(f'tile {z}/{x}/{y} is outside the map')
+    size = 2 * web_mercator_extent / n_tiles
+    minx, maxy = -web_mercator_extent + x * size, web_mercator_extent - y * size
+    resolution = size / tile_size
+
+    image = Image.new('RGBA', (tile_size, tile_size), (0, 0, 0, 0))
+    candidates = layer['tree'].query(shapely.box(minx, maxy - size, minx + size, maxy), predicate='intersects')
+    if len(candidates):
+        # Clip a little outside the tile, so that the outlines of the clipped edges fall outside it, then drop detail below a pixel
+        margin = 2 * resolution
+        clipped = shapely.clip_by_rect(layer['geometries'][candidates], minx - margin, maxy - size - margin, minx + size + margin,
+                                       maxy + margin)
+        clipped = shapely.simplify(clipped, resolution / 2)
+        colours = _colours(layer, metric, layer['values'][column].to_numpy()[candidates])
+        draw = ImageDraw.Draw(image)
+        for geometry, colour in zip(clipped, colours):
+            for polygon in shapely.get_parts(geometry):
+                if shapely.get_type_id(polygon) != shapely.GeometryType.POLYGON:
+                    continue
+                rings = [(np.column_stack(((ring[:, 0] - minx) / resolution, (maxy - ring[:, 1]) / resolution))).ravel().tolist()
+                         for ring in (shapely.get_coordinates(ring) for ring in shapely.get_rings(polygon))]
+                if len(rings[0]) < 6:
+                    continue
+                # Fill through a mask, so that the holes are left as they were
+                mask = Image.new('L', (tile_size, tile_size), 0)
+                mask_draw = ImageDraw.Draw(mask)
+                mask_draw.polygon(rings[0], fill=255)
+                for hole in rings[1:]:
+                    if len(hole) >= 6:
+                        mask_draw.polygon(hole, fill=0)
+                image.paste(Image.new('RGBA', (tile_size, tile_size), colour), mask=mask)
+                for ring in rings:
+                    draw.line(ring, fill=(0, 0, 0, 255), width=1)
+
+    png = io.BytesIO()
+    image.save(png, format='PNG', optimize=False)
+    return png.getvalue()
+
+def get_tile(layer, metric, period, z, x, y, cache_dir=tile_cache_dir, max_bytes=max_disk_bytes):
+    """
+    Get one map tile of a metric from the memory or disk cache, rendering and caching it if it is in neither.
+
+    Inputs:
+        layer (dict): The tile layer from tile_layer.
+        metric (str): The metric, such as PCC.
+        period (str): The period, such as 2019-20, or None for metrics without periods.
+        z (int): The zoom level.
+        x (int): The tile column.
+        y (int): The tile row.
+        cache_dir (str): The disk cache directory, or None to cache in memory only.
+        max_bytes (int): The size cap of the disk cache in bytes.
+
+    Output:
+        bytes: The PNG file of the tile.
+    """
+    key = (layer['version'], metric, period, z, x, y)
+    with _lock:
+        if key in _memory_tiles:
+            _memory_tiles.move_to_end(key)
+            return _memory_tiles[key]
+
+    path = None
+    if cache_dir is not None:
+        path = os.path.join(cache_dir, layer['version'], quote(metric, safe=''), quote(period or '-', safe=''), str(z), str(x),
+                            f'{y}.png')
+        try:
+            with open(path, 'rb') as f:
+                tile = f.read()
+            cache_files.mark_used(path)
+        except OSError:
+            tile = None
+    if path is None or tile is None:
+        tile = render_tile(layer, metric, period, z, x, y)
+        if path is not None:
+            _save_tile(cache_dir, path, tile, max_bytes)
+
+    with _lock:
+        _memory_tiles[key] = tile
+        while len(_memory_tiles) > max_memory_tiles:
+            _memory_tiles.popitem(last=False)
+    return tile
+
+def clear_tile_cache(cache_dir=tile_cache_dir):
+    """
+    Forget the tiles in memory and delete the tiles in the disk cache directory.
+
+    Input:
+        cache_dir (str): The disk cache directory.
+    """
+    with _lock:
+        _memory_tiles.clear()
+        _disk_bytes.pop(os.path.abspath(cache_dir), None)
+    for root, _, files in os.walk(cache_dir, topdown=False):
+        for name in files:
+            if name.endswith(('.png', '.partial')):
+                os.remove(os.path.join(root, name))
+        if root != cache_dir and not os.listdir(root):
+            os.rmdir(root)
+
+def serve(layer=None, host='127.0.0.1', port=8000, cache_dir=tile_cache_dir, max_bytes=max_disk_bytes):
+    """
+    Serve the tiles of a tile layer over HTTP until interrupted, at /tiles/<metric>/<period>/<z>/<x>/<y>.png, with a Leaflet map of
+    them at the root.
+
+    Inputs:
+        layer (dict): The tile layer from tile_layer. Defaults to the PCC of every period on the water supply areas.
+        host (str): The address to listen on. The default only accepts connections from this machine.
+        port (int): The port to listen on.
+        cache_dir (str): The disk cache directory, or None to cache in memory only.
+        max_bytes (int): The size cap of the disk cache in bytes.
+    """
+    layer = tile_layer() if layer is None else layer
+
+    class TileHandler(BaseHTTPRequestHandler):
+        def do_GET(self):
+            path = self.path.split('?')[0]
+            if path in ('/', '/index.html'):
+                return self._send(200, 'text/html; charset=utf-8', _index_page().encode())
+            match = re.fullmatch(r'/tiles/([^/]+)/([^/]+)/(\d+)/(\d+)/(\d+)\.png', path)
+            if match is None:
+                return self._send(404, 'text/plain', b'Not found')
+            metric, period = unquote(match[1]), unquote(match[2])
+            try:
+                tile = get_tile(layer, metric, None if period == '-' else period, *map(int, match.groups()[2:]), cache_dir, max_bytes)
+            except (KeyError, ValueError) as exc:
+                return self._send(404, 'text/plain', str(exc).encode())
+            self._send(200, 'image/png', tile)
+
+        def _send(self, status, content_type, body):
+            self.send_response(status)
+            self.send_header('Content-Type', content_type)
+            self.send_header('Content-Length', str(len(body)))
+            if status == 200:
+                self.send_header('Cache-Control', 'max-age=3600')
+            self.end_headers()
+            self.wfile.write(body)
+
+        def log_message(self, format, *args):
+            pass   # Tile requests are too many to log
+
+    server = ThreadingHTTPServer((host, port), TileHandler)
+    print(f'Serving tiles at http://{host}:{port}/ (metrics: {", ".join(sorted(layer["ranges"]))})')
+    try:
+        server.serve_forever()
+    except KeyboardInterrupt:
+        pass
+    finally:
+        server.server_close()
+
+def _column(layer, metric, period):
+    # The column of the values of a metric and period, raising KeyError for unknown ones
+    column = metric if period is None else f'{metric} {period}'
+    if column not in layer['values'].columns:
+        raise KeyError(f'Unknown metric {metric!r} for period {period!r}')
+    return column
+
+def _split_column(column):
+    # The metric and period of a metrics column. A column is '<metric> <period>' if its last word looks like a period (such as 2019-20)
+    metric, _, period = column.rpartition(' ')
+    if metric and re.fullmatch(r'\d{4}(-\d{2})?', period):
+        return metric, period
+    return column, None
+
+def _colours(layer, metric, values):
+    # RGBA colour of each value on the colour scale of the metric, light grey where there is no value
+    low, high = layer['ranges'][metric]
+    if low > high:   # (inf, -inf) for a metric without values, whose areas are all grey
+        return [missing_colour] * len(values)
+    rgba = layer['cmap'](Normalize(low, high)(values), bytes=True)
+    rgba[:, 3] = fill_alpha
+    return [missing_colour if np.isnan(value) else tuple(int(channel) for channel in colour) for value, colour in zip(values, rgba)]
+
+def _save_tile(cache_dir, path, tile, max_bytes):
+    # Write a tile to the disk cache, then delete the least recently used tiles if the cache is over its size cap
+    with cache_files.atomic_file(path) as partial, open(partial, 'wb') as f:
+        f.write(tile)
+
+    root = os.path.abspath(cache_dir)
+    with _lock:
+        if root not in _disk_bytes:   # The running total saves walking the cache directory for every new tile
+            _disk_bytes[root] = sum(size for _, size, _ in cache_files.cached_files(root, '.png', recursive=True))
+        else:
+            _disk_bytes[root] += len(tile)
+        if _disk_bytes[root] > max_bytes:
+            # Evict down to 90% of the cap, so that eviction does not run for every new tile
+            _, _disk_bytes[root] = cache_files.evict(root, '.png', max_bytes, keep=path, target_bytes=0.9 * max_bytes, recursive=True)
+
+def _index_page():
+    # A Leaflet map of the tiles over OpenStreetMap. The metric and period come from the query string of the page
+    return """<!DOCTYPE html>
+<html><head><meta charset="utf-8"><title>Water supply area tiles</title>
+<link rel="stylesheet" href="https://unpkg.com/leaflet@1.9.4/dist/leaflet.css">
+<script src="https://unpkg.com/leaflet@1.9.4/dist/leaflet.js"></script>
+<style>html, body, #map {height: 100%; margin: 0}</style></head>
+<body><div id="map"></div><script>
+var query = new URLSearchParams(window.location.search);
+var metric = encodeURIComponent(query.get('metric') || 'PCC'), period = encodeURIComponent(query.get('period') || '2019-20');
+var map = L.map('map').setView([52.5, -1.5], 6);
+L.tileLayer('https://tile.openstreetmap.org/{z}/{x}/{y}.png', {attribution: '&copy; OpenStreetMap contributors'}).addTo(map);
+L.tileLayer('/tiles/' + metric + '/' + period + '/{z}/{x}/{y}.png', {maxZoom: 14}).addTo(map);
+</script></body></html>
+"""
+
+if __name__ == '__main__':
+    parser = argparse.ArgumentParser(description='Serve choropleth map tiles of the water supply areas.')
+    parser.add_argument('--host', default='127.0.0.1', help='address to listen on')
+    parser.add_argument('--port', type=int, default=8000, help='port to listen on')
+    parser.add_argument('--cache', default=tile_cache_dir, help='disk cache directory')
+    args = parser.parse_args()
+    serve(host=args.host, port=args.port, cache_dir=args.cache)
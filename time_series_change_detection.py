@@ -0,0 +1,126 @@
+import os
+import json
+import cv2
+import numpy as np
+from sklearn.cluster import KMeans
+from sklearn.decomposition import PCA
+from PCAKmeans_updated import (find_vector_set, find_FVS, read_geotiff, write_geotiff, erode_kernel,
+                               absdiff, as_channels, is_geotiff, stratified_sample)
+
+"""
+This module extends the PCA and K-means change detection in PCAKmeans_updated from a pair of images to a sequence of acquisitions
+of the same area, for example the quicklooks or clipped GeoTIFFs of one water company on several dates.
+
+1. Read each image once, in date order. Only the previous image is kept, and the difference with it is found as each image is read.
+2. Fit PCA on the first pair only and reuse its eigenvectors for every later pair.
+3. Fit K-means on the first pair, then warm-start each later pair from the previous pair's cluster centres, so that only a few
+   iterations are needed and the clusters keep the same meaning from one step to the next.
+4. Stream the change map and clean change map of each consecutive pair into memory-mapped stacks, and record for every pixel the
+   first date on which it changed in the clean change map.
+
+JPEGs are resized to the first image rounded up to a multiple of 5, as in find_PCAKmeans. GeoTIFFs are read with all their bands in
+their own dtype and warped onto the grid of the first image if needed, and the first changed date raster is also written as a
+georeferenced GeoTIFF.
+"""
+
+def find_PCAKmeans_series(imagepaths, dates, output_dir='data_files/time_series', mode='exact', sample_size=100000,
+                          batch_size=100000, components=3, random_state=0):
+    """
+    Find changes between each consecutive pair of a sequence of images with PCA and K-means, reusing the fitted basis across steps.
+
+    Inputs:
+        imagepaths (list of str): The file paths of the images, all JPEGs or all GeoTIFFs of the same area.
+        dates (list of str): The acquisition date of each image in the format 'YYYYMMDD'. The images are processed in date order.
+        output_dir (str): The directory for the outputs (created if needed):
+            changemaps.npy and cleanchangemaps.npy, stacks of shape (pairs, rows - 4, columns - 4, channels) with changes set to 255;
+            first_changed.npy (and first_changed.tif for GeoTIFFs), the date (as YYYYMMDD) on which each pixel first changed, 0 if never;
+            dates.json, the date pair of each layer of the stacks.
+        mode (str): 'exact' fits PCA and K-means on every vector. 'fast' fits them on stratified samples of at most sample_size vectors
+            and labels the pixels in batches of batch_size, as in find_PCAKmeans.
+        sample_size (int): The fast mode sample size.
+        batch_size (int): The fast mode batch size.
+        components (int): The number of K-means clusters.
+        random_state (int): The seed for the samples and the first K-means fit.
+
+    Outputs:
+        np.memmap, np.memmap, np.ndarray: The change map stack, the clean change map stack and the first changed date raster.
+    """
+    if len(imagepaths) != len(dates):
+        raise ValueError(f'{len(imagepaths)} images were given with {len(dates)} dates')
+    if len(imagepaths) < 2:
+        raise ValueError('At least two images are needed to find changes')
+    if mode not in ('exact', 'fast'):
+        raise ValueError(f"mode must be 'exact' or 'fast', not {mode!r}")
+
+    order = np.argsort([int(date) for date in dates], kind='stable')
+    imagepaths = [imagepaths[i] for i in order]
+    dates = [str(dates[i]) for i in order]
+    os.makedirs(output_dir, exist_ok=True)
+    rng = np.random.default_rng(random_state)
+
+    previous, new_size, profile = _read_image(imagepaths[0], imagepaths[0], None)
+    shape = (len(imagepaths) - 1, int(new_size[0]) - 4, int(new_size[1]) - 4, previous.shape[2])
+    change_maps = np.lib.format.open_memmap(os.path.join(output_dir, 'changemaps.npy'), mode='w+', dtype=np.uint8, shape=shape)
+    clean_change_maps = np.lib.format.open_memmap(os.path.join(output_dir, 'cleanchangemaps.npy'), mode='w+', dtype=np.uint8, shape=shape)
+    first_changed = np.zeros(shape[1:3], dtype=np.int32)
+
+    EVS = None
+    centres = None
+    for step in range(1, len(imagepaths)):
+        print(f'\n{dates[step - 1]} to {dates[step]}')
+        image, _, _ = _read_image(imagepaths[step], imagepaths[0], new_size)
+        diff_image = absdiff(previous, image)
+        previous = image
+
+        vector_set, mean_vec = find_vector_set(diff_image, new_size)
+        if EVS is None:   # The eigenvectors of the first pair are reused for every later pair
+            fit_rows = stratified_sample(len(vector_set), sample_size, rng) if mode == 'fast' else slice(None)
+            EVS = PCA().fit(vector_set[fit_rows]).components_
+        FVS = find_FVS(EVS, diff_image, mean_vec, new_size)
+        del vector_set, diff_image
+
+        if centres is None:
+            kmeans = KMeans(n_clusters=components, n_init=10, random_state=random_state)
+        else:   # Warm start from the previous pair's cluster centres
+            kmeans = KMeans(n_clusters=components, init=centres, n_init=1)
+        fit_rows = stratified_sample(len(FVS), sample_size, rng) if mode == 'fast' else slice(None)
+        kmeans.fit(FVS[fit_rows])
+        centres = kmeans.cluster_centers_
+        print('k means converged in', kmeans.n_iter_, 'iterations')
+
+        output = np.empty(len(FVS), dtype=np.int32)
+        for start in range(0, len(FVS), batch_size):
+            output[start:start + batch_size] = kmeans.predict(FVS[start:start + batch_size])
+        least_index = np.argmin(np.bincount(output, minlength=components))
+        del FVS
+
+        change_map = np.where(output == least_index, 255, 0).astype(np.uint8).reshape(shape[1:])
+        clean_change_map = as_channels(cv2.erode(change_map, erode_kernel))
+        change_maps[step - 1] = change_map
+        clean_change_maps[step - 1] = clean_change_map
+
+        newly_changed = (clean_change_map.max(axis=2) == 255) & (first_changed == 0)
+        first_changed[newly_changed] = int(dates[step])
+
+    change_maps.flush()
+    clean_change_maps.flush()
+    np.save(os.path.join(output_dir, 'first_changed.npy'), first_changed)
+    if profile is not None:   # The change maps start 2 pixels in from the top left of the images
+        write_geotiff(os.path.join(output_dir, 'first_changed.tif'), first_changed, profile, offset=2)
+    with open(os.path.join(output_dir, 'dates.json'), 'w') as f:
+        json.dump([[dates[step - 1], dates[step]] for step in range(1, len(dates))], f, indent=2)
+    print('\nchange maps written to', os.path.abspath(output_dir))
+    return change_maps, clean_change_maps, first_changed
+
+def _read_image(imagepath, first_imagepath, new_size):
+    # Read one image of the sequence on the grid of the first image. JPEGs are resized to new_size (the first image rounded up to a
+    # multiple of 5) and converted to int16 as in find_PCAKmeans. GeoTIFFs keep their dtype and are warped onto the first image if needed
+    if is_geotiff(imagepath):
+        image, profile = read_geotiff(imagepath, reference=first_imagepath)
+        return image, np.asarray(image.shape), profile
+
+    image = cv2.imread(imagepath)
+    if new_size is None:
+        new_size = (np.ceil(np.asarray(image.shape) / 5) * 5).astype(int)   # Round up to the nearest multiple of 5
+    image = as_channels(cv2.resize(image, (new_size[1], new_size[0])).astype(np.int16))
+    return image, new_size, None
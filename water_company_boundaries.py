@@ -2,8 +2,11 @@ import os
 import geopandas as gpd
 import matplotlib.pyplot as plt
 import cartopy.crs as ccrs
+import data_loader
+import render_cache
 
-def wrz_boundaries(company_data):
+def wrz_boundaries(company_data, column='COMPANY', cmap='viridis', figsize=(20, 20), dpi=100, output_file='data_files/wrz.png',
+                   cache_dir=render_cache.render_cache_dir):
 
     """
     Generates a plot displaying the boundaries of water companies in England and Wales based on the provided company data.
@@ -12,12 +15,20 @@ def wrz_boundaries(company_data):
     companies on a map. Each company is represented by a different color. The resulting plot provides a visual representation of the
     geographic distribution of water companies.
     
-    The column to plot is hardcoded to COMPANY. A refinement to this code would be to create a variable for the volumn to plot.
+    The plot is kept in a render cache (see render_cache), keyed by the company data file, the column, the styling and the image size.
+    A repeated call with the same inputs shows the stored image instead of reading and plotting the polygons again, and only writes
+    the output file if it does not already hold the image.
 
-    Input:
+    Inputs:
         company_data (str): The file path or name of the company data file. The file should contain the necessary information to
         define the boundaries of water companies. Example is given in waterdemand Github repository 
         (WaterSupplyAreas_incNAVs v1_4.shp)
+        column (str): The column to colour the areas by.
+        cmap (str): The matplotlib colour map.
+        figsize (tuple of float): The figure width and height in inches.
+        dpi (int): The resolution of the image in dots per inch.
+        output_file (str): The file path of the saved image.
+        cache_dir (str): The render cache directory. None to always plot the map.
 
     Output:
         plt: The plot object representing the boundaries of water companies in England and Wales.
@@ -27,26 +38,28 @@ def wrz_boundaries(company_data):
         wrz_boundaries(company_data)
     """
 
-    # Load water company data
-    wrz = gpd.read_file(os.path.abspath(company_data))
+    title = 'Figure 2: Boundaries for Water companies in England and Wales'
+    key = render_cache.render_key(company_data, column, plot='wrz_boundaries', cmap=cmap, title=title, figsize=figsize, dpi=dpi)
 
-    myFig = plt.figure(figsize=(10, 10))
-    myCRS = ccrs.TransverseMercator(27700)
+    def draw():
+        # Load water company data
+        wrz = data_loader.read_layer(company_data, columns=[column])
 
-    wrz.plot(column='COMPANY', cmap='viridis', linewidth=0.8, edgecolor='black', legend=True, label='COMPANY', figsize=(20,20))
-    plt.suptitle('Figure 2: Boundaries for Water companies in England and Wales', y=0.1, fontsize=14)
-    # Add a border around the map
-    for spine in plt.gca().spines.values():
-        spine.set_visible(True)
-        spine.set_color('black')
-        spine.set_linewidth(1) 
+        wrz.plot(column=column, cmap=cmap, linewidth=0.8, edgecolor='black', legend=True, label=column, figsize=figsize)
+        plt.suptitle(title, y=0.1, fontsize=14)
+        # Add a border around the map
+        for spine in plt.gca().spines.values():
+            spine.set_visible(True)
+            spine.set_color('black')
+            spine.set_linewidth(1) 
 
-    plt.xlabel('Longitude')
-    plt.ylabel('Latitude')
-    plt.subplots_adjust(bottom=0.15)
-    
-    # Save the plot as an image file
-    output_file = 'data_files/wrz.png'  # Specify the desired file path and name
-    plt.savefig(output_file)
+        plt.xlabel('Longitude')
+        plt.ylabel('Latitude')
+        plt.subplots_adjust(bottom=0.15)
+        return plt.gcf()
+
+    # Save the plot as an image file, unless it already holds the same image
+    png = render_cache.cached_figure(key, draw, dpi, cache_dir)
+    render_cache.save_image(png, output_file)
  
     return plt